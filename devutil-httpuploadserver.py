@@ -2,12 +2,259 @@
 
 # Inspired by https://gist.github.com/touilleMan/eb02ea40b93e52604938
 # Reduced to _only_ handle file uploads
+#
+# Besides multipart form POST uploads, files can be uploaded in chunks with
+# resumable PUT requests to /FILENAME:
+#  - HEAD /FILENAME with an Upload-Sha256 header (SHA-256 hex digest of the
+#    whole file) responds with an Upload-Offset header telling how many bytes
+#    of the file have been received
+#  - PUT /FILENAME with Upload-Sha256 and 'Content-Range: bytes
+#    START-END/TOTAL' headers appends a chunk at offset START and responds
+#    with the new Upload-Offset. A chunk not starting at the received offset
+#    is refused with status 409 and the received offset. The file is
+#    checked against Upload-Sha256 and stored once all bytes are received.
+# Bytes of a chunk received before a connection drops are kept.
+#
+# Requests are handled concurrently. Uploads with the same contents as an
+# earlier upload are not stored again. With --event-log, the MTR log lines
+# of all uploads are merged into one log file with one line per (MTR-id,
+# package number).
 
+import gzip
+import hashlib
 import os
 import http.server
 import re
+import threading
+import urllib.parse
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import mtrlog
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is optional, only needed for zstd encoded uploads
+    zstandard = None
+
+# Errors decoding a request body with Content-Encoding
+DECODING_ERRORS = (EOFError, OSError, ValueError) + (
+        (zstandard.ZstdError,) if zstandard is not None else ())
+
+# Size of reads of request bodies
+READ_SIZE = 64 * 1024
+# Maximum size of the headers of a multipart part
+MAX_PART_HEADER_SIZE = 8 * 1024
+
+
+# Reads at most length bytes from rfile, so that reading does not run into
+# the next request on the connection
+class LimitedReader:
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+# Reads a request body in large chunks. The buffer never holds much more
+# than one read.
+class BodyReader:
+
+    def __init__(self, rfile, length=None):
+        # length None reads until the end of rfile
+        self.rfile = rfile
+        self.remaining = length
+        self.buffer = bytearray()
+
+    def fill(self):
+        # Returns False if there is no more data
+        if self.remaining is None:
+            data = self.rfile.read(READ_SIZE)
+        elif self.remaining > 0:
+            data = self.rfile.read(min(READ_SIZE, self.remaining))
+            self.remaining -= len(data)
+        else:
+            return False
+        if not data:
+            self.remaining = 0
+            return False
+        self.buffer += data
+        return True
+
+    def read_until(self, delimiter, max_size):
+        # Returns the data up to and including delimiter, None if the
+        # delimiter is not found within max_size bytes
+        while True:
+            index = self.buffer.find(delimiter)
+            if index >= 0:
+                data = bytes(self.buffer[:index + len(delimiter)])
+                del self.buffer[:index + len(delimiter)]
+                return data
+            if len(self.buffer) > max_size or not self.fill():
+                return None
+
+    def copy_until(self, delimiter, out):
+        # Writes the data up to delimiter to out and skips the delimiter.
+        # Returns False if the body ends before the delimiter.
+        while True:
+            index = self.buffer.find(delimiter)
+            if index >= 0:
+                out.write(self.buffer[:index])
+                del self.buffer[:index + len(delimiter)]
+                return True
+            # the end of the buffer could be the start of the delimiter
+            num_bytes_safe = len(self.buffer) - (len(delimiter) - 1)
+            if num_bytes_safe > 0:
+                out.write(self.buffer[:num_bytes_safe])
+                del self.buffer[:num_bytes_safe]
+            if not self.fill():
+                return False
+
+    def copy_all(self, out):
+        # Returns the number of bytes written to out
+        num_bytes = 0
+        while self.buffer or self.fill():
+            out.write(self.buffer)
+            num_bytes += len(self.buffer)
+            self.buffer.clear()
+        return num_bytes
+
+    def discard(self):
+        while self.fill():
+            self.buffer.clear()
+        self.buffer.clear()
+
+
+# Writes to a file and hashes what is written
+class HashingWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+
+# Log lines of all uploads merged into one MTR log file, one line per
+# (MTR-id, package number). The first line received for a package is kept.
+class EventLog:
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.packages = set()
+        if os.path.exists(file_name):
+            with open(file_name, 'r') as f:
+                self.packages.update(
+                        mtrlog.mtr_id_and_packet_num_of(log_line)
+                        for log_line in f)
+
+    def merge_file(self, file_name):
+        # Returns the number of new lines
+        if file_name.endswith('.gz'):
+            f = gzip.open(file_name, 'rt')
+        elif file_name.endswith('.zst') and zstandard is not None:
+            f = zstandard.open(file_name, 'rt')
+        else:
+            f = open(file_name, 'r')
+        with f:
+            return self.merge(f)
+
+    def merge(self, log_lines):
+        new_log_lines = []
+        with self.lock:
+            for log_line in log_lines:
+                package = mtrlog.mtr_id_and_packet_num_of(log_line)
+                if package is None or package in self.packages:
+                    continue
+                self.packages.add(package)
+                new_log_lines.append(log_line.rstrip('\r\n') + '\n')
+            with open(self.file_name, 'a') as f:
+                f.writelines(new_log_lines)
+        return len(new_log_lines)
+
+
+# State shared by the requests of a server: content hashes of the stored
+# uploads and the optional event log
+class UploadCollector:
+
+    def __init__(self, directory, event_log=None):
+        self.event_log = event_log
+        self.lock = threading.Lock()
+        # SHA-256 -> file name and back
+        self.file_names = {}
+        self.sha256s = {}
+        for file_name in os.listdir(directory):
+            file_name = os.path.join(directory, file_name)
+            if (os.path.isfile(file_name)
+                    and not file_name.endswith(('.tmp', '.part'))):
+                self.add(file_name, sha256_of_file(file_name))
+        # locks of resumable uploads in progress by part file name
+        self.part_locks = {}
+
+    def add(self, file_name, sha256):
+        old_sha256 = self.sha256s.pop(file_name, None)
+        if self.file_names.get(old_sha256) == file_name:
+            del self.file_names[old_sha256]
+        self.file_names[sha256] = file_name
+        self.sha256s[file_name] = sha256
+
+    def store(self, temp_file_name, file_name, sha256):
+        # Moves a complete upload in place unless the same contents have
+        # been stored before. Returns the name the contents are stored as.
+        with self.lock:
+            stored_file_name = self.file_names.get(sha256)
+            if stored_file_name is not None and os.path.exists(
+                    stored_file_name):
+                os.remove(temp_file_name)
+                return stored_file_name
+            os.replace(temp_file_name, file_name)
+            self.add(file_name, sha256)
+        if self.event_log is not None:
+            try:
+                num_new_lines = self.event_log.merge_file(file_name)
+                print("Merged %d new lines of '%s' into event log"
+                      % (num_new_lines, file_name))
+            except (UnicodeDecodeError,) + DECODING_ERRORS as e:
+                print("Could not merge '%s' into event log: %s"
+                      % (file_name, e))
+        return file_name
+
+    def part_lock(self, part_file_name):
+        with self.lock:
+            return self.part_locks.setdefault(
+                    part_file_name, threading.Lock())
+
+
+def part_file_name_of(file_name, sha256):
+    # partial uploads of different contents do not mix
+    return '%s.%s.part' % (file_name, sha256[:16])
+
+
+def sha256_of_file(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+# Server with an UploadCollector shared by its requests
+class CollectorHTTPServer(ThreadingHTTPServer):
+
+    collector = None
+    # many extractors connect at the same time at big events
+    request_queue_size = 128
 
 
 class UploadHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -19,66 +266,179 @@ class UploadHTTPRequestHandler(BaseHTTPRequestHandler):
             self.directory = directory
         super().__init__(*args, **kwargs)
 
+    @property
+    def collector(self):
+        # None unless served by a CollectorHTTPServer
+        return getattr(self.server, 'collector', None)
+
     def do_POST(self):
         r, info = self.handle_post_data()
         print((r, info, "by: ", self.client_address))
-        self.send_response(200)
+        if not r:
+            # the rest of the body could still be unread
+            self.close_connection = True
+        self.send_empty_response(200 if r else 400)
+
+    def do_HEAD(self):
+        upload = self.resumable_upload()
+        if upload is None:
+            # e.g. a client checking the server is reachable
+            self.send_empty_response(200)
+            return
+        self.send_empty_response(
+                200, {'Upload-Offset': self.received_offset(*upload)})
+
+    def do_PUT(self):
+        r, info = self.handle_put_data()
+        print((r, info, "by: ", self.client_address))
+
+    def send_empty_response(self, code, headers={}):
+        self.send_response(code)
         self.send_header("Content-type", "text/html")
         self.send_header("Content-Length", str(0))
+        for (name, value) in headers.items():
+            self.send_header(name, str(value))
         self.end_headers()
 
     def handle_post_data(self):
         content_type = self.headers['content-type']
-        if not content_type:
+        if not content_type or '=' not in content_type:
             return (False, "Content-Type header doesn't contain boundary")
         boundary = content_type.split("=")[1].encode()
-        remainbytes = int(self.headers['content-length'])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        if boundary not in line:
+        rfile, remainbytes = self.decoded_body()
+        if rfile is None:
+            return (False, "Unsupported Content-Encoding")
+        body = BodyReader(rfile, remainbytes)
+        try:
+            return self.handle_multipart(body, boundary)
+        except DECODING_ERRORS as e:
+            return (False, "Can't decode body: %s" % e)
+
+    def handle_multipart(self, body, boundary):
+        part_header = body.read_until(b'\r\n\r\n', MAX_PART_HEADER_SIZE)
+        if part_header is None or boundary not in part_header:
             return (False, "Content NOT begin with boundary")
-        line = self.rfile.readline()
-        remainbytes -= len(line)
         fn = re.findall(
                 r'Content-Disposition.*name="file"; filename="(.*)"',
-                line.decode())
+                part_header.decode())
         if not fn:
             return (False, "Can't find out file name...")
-        fn = os.path.join(self.directory, fn[0])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        fn2 = re.findall(b'Content-Type:.*', line)
-        if fn2:
-            line = self.rfile.readline()
-            remainbytes -= len(line)
+        fn = os.path.join(self.directory, os.path.basename(fn[0]))
+        # the file only gets its name when it is complete, concurrent
+        # uploads of the same file name do not share the temporary file
+        temp_fn = '%s.%d.tmp' % (fn, threading.get_ident())
         try:
-            out = open(fn, 'wb')
+            with open(temp_fn, 'wb') as f:
+                out = HashingWriter(f)
+                is_complete = body.copy_until(b'\r\n--' + boundary, out)
         except IOError:
+            self.remove_file(temp_fn)
             return (False,
                     "Can't create file to write, do you have permission to "
                     "write?")
+        except BaseException:
+            self.remove_file(temp_fn)
+            raise
+        if not is_complete:
+            self.remove_file(temp_fn)
+            return (False, "Unexpect Ends of data.")
+        body.discard()
+        stored_fn = self.store(temp_fn, fn, out.sha256.hexdigest())
+        if stored_fn != fn:
+            return (True, "File '%s' already uploaded as '%s'"
+                    % (fn, stored_fn))
+        return (True, "File '%s' upload success!" % fn)
+
+    def store(self, temp_file_name, file_name, sha256):
+        if self.collector is None:
+            os.replace(temp_file_name, file_name)
+            return file_name
+        return self.collector.store(temp_file_name, file_name, sha256)
 
-        preline = self.rfile.readline()
-        remainbytes -= len(preline)
-        while remainbytes > 0:
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            if boundary in line:
-                preline = preline[0:-1]
-                if preline.endswith(b'\r'):
-                    preline = preline[0:-1]
-                out.write(preline)
-                out.close()
-                return (True, "File '%s' upload success!" % fn)
-            else:
-                out.write(preline)
-                preline = line
-        return (False, "Unexpect Ends of data.")
+    def handle_put_data(self):
+        upload = self.resumable_upload()
+        content_range = re.fullmatch(
+                r'bytes (\d+)-(\d+)/(\d+)',
+                self.headers.get('content-range', ''))
+        body = BodyReader(self.rfile, int(self.headers['content-length']))
+        if upload is None or content_range is None:
+            body.discard()
+            self.send_empty_response(400)
+            return (False, "Missing or invalid upload headers")
+        (file_name, sha256) = upload
+        (start, end, total) = (int(n) for n in content_range.groups())
+        part_file_name = part_file_name_of(file_name, sha256)
+        if self.collector is None:
+            part_lock = threading.Lock()
+        else:
+            part_lock = self.collector.part_lock(part_file_name)
+        # a retried chunk could arrive while the dropped one is still read
+        with part_lock:
+            offset = self.received_offset(file_name, sha256)
+            if start != offset:
+                body.discard()
+                self.send_empty_response(409, {'Upload-Offset': offset})
+                return (False, "Chunk at %d but received %d" % (start, offset))
+            with open(part_file_name, 'ab') as out:
+                offset += body.copy_all(out)
+            if offset < total:
+                self.send_empty_response(200, {'Upload-Offset': offset})
+                return (True, "Received %d of %d bytes" % (offset, total))
+            if sha256_of_file(part_file_name) != sha256:
+                self.remove_file(part_file_name)
+                self.send_empty_response(400)
+                return (False, "File '%s' does not match hash" % file_name)
+            self.store(part_file_name, file_name, sha256)
+        self.send_empty_response(201, {'Upload-Offset': offset})
+        return (True, "File '%s' upload success!" % file_name)
+
+    def resumable_upload(self):
+        # Returns (file name, SHA-256) of a resumable upload request, None
+        # if it is not one
+        sha256 = self.headers.get('upload-sha256')
+        file_name = os.path.basename(
+                urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        if (sha256 is None
+                or not re.fullmatch('[0-9a-f]{64}', sha256)
+                or not file_name
+                or file_name.startswith('.')):
+            return None
+        return (os.path.join(self.directory, file_name), sha256)
+
+    def received_offset(self, file_name, sha256):
+        part_file_name = part_file_name_of(file_name, sha256)
+        if os.path.exists(part_file_name):
+            return os.path.getsize(part_file_name)
+        if (os.path.exists(file_name)
+                and sha256_of_file(file_name) == sha256):
+            return os.path.getsize(file_name)
+        return 0
+
+    def remove_file(self, file_name):
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+
+    def decoded_body(self):
+        # Returns the request body as a file and its decoded length (None if
+        # not known before decoding), or (None, 0) if the Content-Encoding is
+        # not supported. Encoded bodies are decoded while they are read.
+        content_length = int(self.headers['content-length'])
+        content_encoding = self.headers.get('content-encoding', 'identity')
+        if content_encoding == 'identity':
+            return (self.rfile, content_length)
+        rfile = LimitedReader(self.rfile, content_length)
+        if content_encoding == 'gzip':
+            return (gzip.GzipFile(fileobj=rfile, mode='rb'), None)
+        if content_encoding == 'zstd' and zstandard is not None:
+            return (zstandard.ZstdDecompressor().stream_reader(rfile), None)
+        return (None, 0)
 
 
 def test(
         HandlerClass=UploadHTTPRequestHandler,
-        ServerClass=HTTPServer,
+        ServerClass=CollectorHTTPServer,
         port=8080,
         bind=""):
     http.server.test(
@@ -101,10 +461,18 @@ if (__name__ == '__main__'):
     parser.add_argument(
             '--directory', '-d', default=os.getcwd(),
             help='Specify alternate directory (default: current directory)')
+    parser.add_argument(
+            '--event-log', metavar='FILE',
+            help=(
+                'Merge the MTR log lines of all uploads into FILE, one line '
+                'per MTR-id and package number'))
     parser.add_argument(
             'port', action='store', default=8000, type=int,
             nargs='?', help='Specify alternate port (default: %(default)s)')
     args = parser.parse_args()
 
+    CollectorHTTPServer.collector = UploadCollector(
+            args.directory,
+            EventLog(args.event_log) if args.event_log else None)
     handler_class = partial(UploadHTTPRequestHandler, directory=args.directory)
     test(HandlerClass=handler_class, port=args.port, bind=args.bind)
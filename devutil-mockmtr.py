@@ -5,13 +5,15 @@ import random
 import serial
 from datetime import datetime, timedelta
 from tests.testmtrreader import MtrDataBytesBuilder
-import csv
+
+import mtrlog
 
 
 def create_argparser():
     argparser = argparse.ArgumentParser(
             description=(
-                "Mock MTR supporting spool-all command ('/SA'). "
+                "Mock MTR supporting status ('/ST'), spool-all ('/SA') and "
+                "spool-from-package-number ('/SB') commands. "
                 "Responds with data messages in binary file to serial port."))
     argparser.add_argument('port', help='Serial port identifier')
     argparser.add_argument(
@@ -35,7 +37,7 @@ def create_argparser():
 
 
 def is_command(cmd_bytes):
-    return cmd_bytes == b'/ST' or cmd_bytes == b'/SA'
+    return cmd_bytes in (b'/ST', b'/SA', b'/SB')
 
 
 def listen(serial_port):
@@ -47,11 +49,14 @@ def listen(serial_port):
             # make room for incoming byte by removing oldest
             command_buffer.pop(0)
         command_buffer.extend(serial_port.read())
+    if command_buffer == b'/SB':
+        # package number to spool from follows the command
+        command_buffer.extend(serial_port.read(4))
     print("Received command {}".format(command_buffer))
     return command_buffer
 
 
-def respond_status(serial_port, mtr_id):
+def respond_status(serial_port, mtr_id, recent_package_num):
     now = datetime.now()
     data = bytearray()
     data.extend(b'\xFF\xFF\xFF\xFF')  # preamble
@@ -66,9 +71,11 @@ def respond_status(serial_port, mtr_id):
     data.append(now.second)
     data.extend(b'\x00\x00')  # ms
     data.append(0)  # battery status (0=ok, 1=low)
-    data.extend(b'\x00\x00\x00\x00')  # recent pkgnum
-    data.extend(b'\x00\x00\x00\x00')  # oldest pkgnum
-    data.extend(b'\x00\x00\x00\x00')  # curr sess start
+    data.extend(recent_package_num.to_bytes(4, 'little'))  # recent pkgnum
+    data.extend((1).to_bytes(4, 'little'))  # oldest pkgnum
+    # one session with all packages, if any
+    current_session_start = 1 if recent_package_num > 0 else 0
+    data.extend(current_session_start.to_bytes(4, 'little'))  # curr sess start
     data.extend(b'\x00\x00\x00\x00')  # prev1 sess start
     data.extend(b'\x00\x00\x00\x00')  # prev2 sess start
     data.extend(b'\x00\x00\x00\x00')  # prev3 sess start
@@ -103,59 +110,16 @@ def respond_with_file_mtrbinary(serial_port, source_filename):
 def respond_with_file_mtrlogfile(serial_port, source_filename):
     with open(source_filename, 'r', encoding='ascii') as source_file:
         print("Opened MTR log file {}".format(source_filename))
-        parsed_data = csv.DictReader(
-            source_file,
-            fieldnames=[
-                'package_type',
-                'zero',
-                'mtr_id',
-                'card_id_string',
-                'datetime_extracted_string',
-                'datetime_read_string',
-                'card_id',
-                'product_week',
-                'product_year'
-            ], restkey='splits_and_more')
-        line_num = 0
-        for parsed_data_line in parsed_data:
-            line_num = line_num + 1
-            package_type = parsed_data_line['package_type']
-            if package_type != 'M':
-                print(
-                    "Encountered unknown package type {} at line {}"
-                    .format(package_type, line_num))
-                continue
-            mtr_id = int(parsed_data_line['mtr_id'].strip())
-            card_id = int(parsed_data_line['card_id'].strip())
-            datetime_read = datetime.strptime(
-                parsed_data_line['datetime_read_string'],
-                '%d.%m.%y %H:%M:%S.%f')
-            splits_and_more = parsed_data_line['splits_and_more']
-            if len(splits_and_more) < 100:
-                print(
-                    "Expected 50 split control/time pairs; found {} at line {}"
-                    .format(len(splits_and_more), line_num))
-                continue
-
-            splits = []
-            for i in range(0, 98, 2):
-                control = int(splits_and_more[i])
-                time = int(splits_and_more[i+1])
-                splits.append((control, time))
-
-            package_num = int(splits_and_more[100])
-
-            num_bytes_written = serial_port.write(
-                mtr_bytes(
-                    mtr_id=mtr_id, card_id=card_id, splits=splits,
-                    datetime_read=datetime_read, package_num=package_num))
+        # lines that are not data message log lines are logged and skipped
+        for msg in mtrlog.MtrLogParser().iter_parse(source_file):
+            num_bytes_written = serial_port.write(msg.message_bytes)
             print(
-                "Wrote message at line {} (package number {}, {} bytes)"
-                .format(line_num, package_num, num_bytes_written))
+                "Wrote message (package number {}, {} bytes)"
+                .format(msg.packet_num(), num_bytes_written))
 
 
-def respond_with_generated(serial_port, mtr_id, n):
-    print("Generating {} messages".format(n))
+def respond_with_generated(serial_port, mtr_id, n, start_package_num=1):
+    print("Generating messages {} to {}".format(start_package_num, n))
 
     now = datetime.now()
     course_a = [0, 31, 32, 33, 34, 35, 102, 103, 104, 249]
@@ -163,7 +127,7 @@ def respond_with_generated(serial_port, mtr_id, n):
     course_c = [0, 65, 66, 67, 60, 61, 62, 249]
     courses = [course_a, course_b, course_c]
 
-    for i in range(1, n+1):
+    for i in range(start_package_num, n+1):
         card_id = random.randint(
                 1, int.from_bytes(bytes(b'\xFF\xFF\xFF'), 'little'))
         splits = random_splits_for_course(random.choice(courses))
@@ -192,13 +156,21 @@ def random_splits_for_course(course):
 args = create_argparser().parse_args()
 is_verbose = args.verbose
 test_serial = serial.Serial(port=args.port, baudrate=9600)
+mtr_id = random.randint(1, int.from_bytes(bytes(b'\xFF\xFF'), 'little'))
 while True:
     cmd = listen(test_serial)
-    mtr_id = random.randint(1, int.from_bytes(bytes(b'\xFF\xFF'), 'little'))
     if cmd == b'/ST':
-        respond_status(test_serial, mtr_id)
+        # package numbers are only known when generating messages
+        respond_status(test_serial, mtr_id, 0 if args.file else args.n)
     elif cmd == b'/SA':
         if args.file:
             respond_with_file(test_serial, args.file, args.file_format)
         else:
             respond_with_generated(test_serial, mtr_id, args.n)
+    elif cmd.startswith(b'/SB'):
+        start_package_num = int.from_bytes(cmd[3:7], 'little')
+        if args.file:
+            print("Spooling from package number not supported for files")
+        else:
+            respond_with_generated(
+                    test_serial, mtr_id, args.n, start_package_num)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+import mtrlog
+
+
+def create_argparser():
+    argparser = argparse.ArgumentParser(
+            description=(
+                "Load test of an upload server. Simulated extractors upload "
+                "MTR log files at the same time over (optionally) slow "
+                "links. Starts devutil-httpuploadserver.py with an event "
+                "log unless --url is given."))
+    argparser.add_argument(
+            '-n', '--num-uploaders', type=int, default=100,
+            help='Number of concurrent uploaders')
+    argparser.add_argument(
+            '-u', '--uploads-per-uploader', type=int, default=2,
+            help=(
+                'Number of uploads by each uploader. Each upload holds the '
+                'packages of the previous one and --packages new ones.'))
+    argparser.add_argument(
+            '-p', '--packages', type=int, default=50,
+            help='Number of new packages in each upload')
+    argparser.add_argument(
+            '-r', '--rate', type=int, default=50000,
+            help='Upload rate of each uploader in bytes/s, 0 for unlimited')
+    argparser.add_argument(
+            '--url', help='URL of a running upload server to test')
+    return argparser
+
+
+def log_content(mtr_id, num_packages):
+    formatter = mtrlog.MtrLogFormatter()
+    datetime_extracted_str = datetime.now().strftime(
+            mtrlog.DATETIME_EXTRACTED_FORMAT)
+    flat_splits = (31, 60, 32, 120, 249, 180) + 94 * (0,)
+    return ''.join(
+            formatter.format_fields(
+                mtr_id, package_num, datetime_extracted_str,
+                (1, 1, 20, 10, 0, 0, 0), flat_splits, 3, package_num,
+                False) + '\n'
+            for package_num in range(1, num_packages + 1)).encode()
+
+
+def multipart_body(file_name, content):
+    return (b'--LoadTestBoundary\r\n'
+            b'Content-Disposition: form-data; name="file"; '
+            b'filename="' + file_name.encode() + b'"\r\n\r\n'
+            + content
+            + b'\r\n--LoadTestBoundary--\r\n')
+
+
+def upload(url, file_name, content, rate):
+    # Returns the response status
+    parsed_url = urllib.parse.urlsplit(url)
+    body = multipart_body(file_name, content)
+    connection = http.client.HTTPConnection(
+            parsed_url.hostname, parsed_url.port, timeout=600)
+    try:
+        connection.putrequest('POST', parsed_url.path or '/')
+        connection.putheader(
+                'Content-Type',
+                'multipart/form-data; boundary=LoadTestBoundary')
+        connection.putheader('Content-Length', str(len(body)))
+        connection.endheaders()
+        chunk_size = 4096
+        for offset in range(0, len(body), chunk_size):
+            connection.send(body[offset:offset + chunk_size])
+            if rate > 0:
+                time.sleep(chunk_size / rate)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run_uploader(url, mtr_id, args, latencies, errors):
+    for upload_num in range(args.uploads_per_uploader):
+        content = log_content(mtr_id, (upload_num + 1) * args.packages)
+        start_time = time.monotonic()
+        try:
+            status = upload(
+                    url, 'mtr-%d-%d.log' % (mtr_id, upload_num), content,
+                    args.rate)
+            if status != 200:
+                errors.append("Status %d" % status)
+        except OSError as e:
+            errors.append(str(e))
+        latencies.append(time.monotonic() - start_time)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(work_dir):
+    upload_dir = os.path.join(work_dir, 'uploaded')
+    os.makedirs(upload_dir)
+    event_log_file_name = os.path.join(work_dir, 'event.log')
+    port = free_port()
+    server = subprocess.Popen(
+            [sys.executable,
+             os.path.join(os.path.dirname(__file__),
+                          'devutil-httpuploadserver.py'),
+             '-b', '127.0.0.1', '-d', upload_dir,
+             '--event-log', event_log_file_name, str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    return (server, 'http://127.0.0.1:%d/' % port, event_log_file_name)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(p / 100 * len(sorted_values)))]
+
+
+args = create_argparser().parse_args()
+with tempfile.TemporaryDirectory() as work_dir:
+    if args.url is None:
+        (server, url, event_log_file_name) = start_server(work_dir)
+    else:
+        (server, url, event_log_file_name) = (None, args.url, None)
+    latencies = []
+    errors = []
+    uploaders = [
+            threading.Thread(
+                target=run_uploader,
+                args=(url, mtr_id, args, latencies, errors))
+            for mtr_id in range(1, args.num_uploaders + 1)]
+    start_time = time.monotonic()
+    for uploader in uploaders:
+        uploader.start()
+    for uploader in uploaders:
+        uploader.join()
+    total_secs = time.monotonic() - start_time
+    if server is not None:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    print("%d uploaders, %d uploads in %.2f s (%.1f uploads/s)"
+          % (args.num_uploaders, len(latencies), total_secs,
+             len(latencies) / total_secs))
+    print("Upload latency: median %.2f s, 95th percentile %.2f s, "
+          "max %.2f s"
+          % (percentile(latencies, 50), percentile(latencies, 95),
+             latencies[-1]))
+    print("%d errors%s"
+          % (len(errors), (": %s" % errors[0]) if errors else ''))
+    if event_log_file_name is not None:
+        with open(event_log_file_name, 'r') as f:
+            num_lines = sum(1 for line in f)
+        print("Event log has %d lines, expected %d"
+              % (num_lines,
+                 args.num_uploaders * args.uploads_per_uploader
+                 * args.packages))
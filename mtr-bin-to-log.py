@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import os
+import sys
+from datetime import datetime
+
+import mtrbatch
+import mtrlog
+import mtrreader
+
+
+def create_argparser():
+    argparser = argparse.ArgumentParser(
+            description=(
+                "Convert binary MTR captures (as recorded by "
+                "devutil-recordmtrdata.py) to MTR log files like the ones "
+                "written by mtr-log-extractor.py, without a serial port. "
+                "Captures are converted in parallel."))
+    argparser.add_argument(
+            'capture_files', nargs='+', metavar='CAPTURE_FILE',
+            help='Binary capture file')
+    argparser.add_argument(
+            '-o', '--output-dir',
+            help=(
+                "Directory to write log files to (default: the directory of "
+                "each capture). The log file of capture NAME.bin is named "
+                "NAME.log."))
+    argparser.add_argument(
+            '-j', '--jobs', type=int, default=os.cpu_count(),
+            help='Number of captures converted at the same time')
+    return argparser
+
+
+def log_file_name_of(capture_file_name, output_dir):
+    (root, ext) = os.path.splitext(os.path.basename(capture_file_name))
+    return os.path.join(
+            output_dir or os.path.dirname(capture_file_name), root + '.log')
+
+
+def convert(capture_file_name, log_file_name):
+    # Returns the number of log lines written. The capture's modification
+    # time (when recording finished) is used as extraction time.
+    datetime_extracted = datetime.fromtimestamp(
+            os.path.getmtime(capture_file_name))
+    with open(capture_file_name, 'rb') as capture_file:
+        capture = capture_file.read()
+    # the same parsing as when reading from the MTR
+    decoder = mtrreader.MtrDecoder()
+    data_messages = [
+            msg for msg in decoder.feed(capture)
+            if isinstance(msg, mtrreader.MtrDataMessage)]
+    formatter = mtrlog.MtrLogFormatter()
+    if mtrbatch.is_available():
+        log_lines = formatter.format_batch(
+                mtrbatch.MtrBatch.from_messages(data_messages),
+                datetime_extracted)
+    else:
+        log_lines = formatter.format_all(data_messages, datetime_extracted)
+    with open(log_file_name, 'wb') as log_file:
+        log_file.write(''.join(
+            "%s\n" % log_line for log_line in log_lines).encode('utf-8'))
+    return len(log_lines)
+
+
+if __name__ == '__main__':
+    args = create_argparser().parse_args()
+    num_failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        futures = {
+                executor.submit(
+                    convert, capture_file_name,
+                    log_file_name_of(capture_file_name, args.output_dir)):
+                capture_file_name
+                for capture_file_name in args.capture_files}
+        for future in concurrent.futures.as_completed(futures):
+            capture_file_name = futures[future]
+            try:
+                num_log_lines = future.result()
+            except Exception as e:
+                # any failed capture is reported, the others are still
+                # converted
+                print(
+                        "%s: %s: %s" % (
+                            capture_file_name, type(e).__name__, e),
+                        file=sys.stderr)
+                num_failed += 1
+                continue
+            print("%s: %d log lines written to %s" % (
+                capture_file_name, num_log_lines,
+                log_file_name_of(capture_file_name, args.output_dir)))
+    sys.exit(1 if num_failed > 0 else 0)
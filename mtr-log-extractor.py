@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import functools
+import glob
 import logging
 import logging.handlers
 import os
 import serial
 import socket
 import sys
+import threading
 from datetime import datetime, timedelta
-import requests
-import dropbox
 import time
 
+import mtrdevice
 import mtrreader
 import mtrlog
+import mtrstate
+import mtrupload
 
 
 def create_argparser():
@@ -22,17 +27,34 @@ def create_argparser():
     argparser.add_argument(
             '-p',
             '--serial-port',
-            default='/dev/ttyMTR',
-            help="Serial port device of MTR")
+            nargs='+',
+            default=['/dev/ttyMTR'],
+            help=(
+                "Serial port device of MTR. The MTRs at several serial "
+                "ports, or at the ports matching a glob pattern like "
+                "'/dev/ttyUSB*', are extracted at the same time. With "
+                "'auto', all USB serial ports ({}) are sent the status "
+                "command at the same time and the MTRs that answer are "
+                "extracted.".format(' '.join(auto_serial_port_patterns))))
     argparser.add_argument(
             '-t',
             '--serial-port-polling-timeout',
             metavar='TIMEOUT',
             type=int,
             help=(
-                'Number of seconds to spend polling MTR for status before '
-                'giving up. (Exits with status code {} on timeout.)'.format(
-                    exit_code_serial_port_unresponsive)))
+                'Number of seconds to spend polling each MTR for status '
+                'before giving up. (Exits with status code {} on '
+                'timeout.)'.format(exit_code_serial_port_unresponsive)))
+    argparser.add_argument(
+            '--daemon',
+            action='store_true',
+            help=(
+                "Keep running and extract every MTR connected to the serial "
+                "ports instead of exiting after the first ones. "
+                "A serial port is expected to appear when an MTR is "
+                "connected and disappear when it is disconnected (like the "
+                "/dev/ttyMTR symlink created by udev). A polling TIMEOUT "
+                "applies to each connection."))
     argparser.add_argument(
             '-f',
             '--output-file-name',
@@ -42,16 +64,92 @@ def create_argparser():
                 'tTime (See http://ttime.no. Format described at '
                 'http://ttime.no/rs232.pdf.) '
                 'A {} in the filename will be replaced with a timestamp in '
-                'the ISO 8601 combined date and time basic format.'))
+                'the ISO 8601 combined date and time basic format. '
+                'A {mtr_id} will be replaced with the ID of the MTR. There '
+                'is one log file per MTR: if several serial ports or a glob '
+                'pattern are given and there is no {mtr_id}, -MTR_ID is '
+                'added before the file extension.'))
+    argparser.add_argument(
+            '-i',
+            '--incremental',
+            metavar='STATE_FILE',
+            help=(
+                "Only extract packages not extracted in previous runs. The "
+                "last extracted package number of each MTR is kept in "
+                "STATE_FILE. All packages are extracted if the last "
+                "extracted package is no longer in the MTR's memory."))
+    argparser.add_argument(
+            '--archive',
+            metavar='ARCHIVE_FILE',
+            help=(
+                "Also append the raw data messages read from the MTR to "
+                "ARCHIVE_FILE (indexed in ARCHIVE_FILE.idx, see "
+                "mtrarchive), so that they can be exported again without "
+                "the MTR."))
+    argparser.add_argument(
+            '--result-db',
+            metavar='DB_FILE',
+            help=(
+                "Also store the data messages read from the MTR in the "
+                "SQLite database DB_FILE, for queries with "
+                "mtr-result-query.py. Messages already in the database are "
+                "skipped."))
     argparser.add_argument(
             '-d',
             '--destination',
+            action='append',
             nargs='+',
             metavar='DEST_ARG',
             help=(
                 "Send MTR log file to a destination. Supported destinations: "
-                "an HTTP URL (accepting POST form uploads) or "
-                "'dropbox path/to/apitokenfile [/upload/dir]'"))
+                "an HTTP URL (accepting POST form uploads), "
+                "'dropbox path/to/apitokenfile [/upload/dir]' or "
+                "'local /path/to/dir' (e.g. a USB stick). Can be given "
+                "multiple times to upload to several destinations "
+                "concurrently. A 'timeout=SECS' argument sets the upload "
+                "timeout of a destination."))
+    argparser.add_argument(
+            '--compress',
+            choices=sorted(mtrupload.COMPRESSION_EXTENSIONS),
+            help=(
+                "Compress uploads. HTTP uploads are sent with a "
+                "Content-Encoding header, Dropbox uploads are stored with a "
+                "'.gz' or '.zst' file name extension. zstd requires the "
+                "zstandard module."))
+    argparser.add_argument(
+            '--upload-mode',
+            choices=['delta', 'full'],
+            default='delta',
+            help=(
+                "'delta' uploads only the log lines of packages the "
+                "destination has not received in earlier uploads (as a "
+                "file named like the log file with a '-delta' suffix), "
+                "'full' uploads the whole log file, e.g. to re-sync a "
+                "destination."))
+    argparser.add_argument(
+            '--ack-file',
+            metavar='FILE',
+            default='mtr-upload-acks.json',
+            help=(
+                "File where the packages uploaded to each destination are "
+                "kept for delta uploads."))
+    argparser.add_argument(
+            '--outbox',
+            metavar='DIR',
+            default='mtr-upload-outbox',
+            help=(
+                "Directory where pending uploads are kept until they "
+                "succeed. Failed uploads are retried with increasing delays, "
+                "also by later runs."))
+    argparser.add_argument(
+            '--upload-timeout',
+            metavar='TIMEOUT',
+            type=int,
+            default=120,
+            help=(
+                "Number of seconds to keep retrying failed uploads to a "
+                "destination without a 'timeout=SECS' argument before "
+                "exiting. Uploads still pending are retried by the next run."))
     argparser.add_argument(
             '-l',
             '--log',
@@ -71,7 +169,10 @@ def create_argparser():
                 "Local network port that -- if given -- status messages "
                 "will be sent to. Intended for simple output of status to "
                 "LED, display, sound device etc. States reported are "
-                "AWAITING_MTR, READING_MTR, UPLOADING and DONE."))
+                "AWAITING_MTR, READING_MTR, UPLOADING and DONE. While "
+                "uploading, 'UPLOADED DEST', 'UPLOAD_PENDING DEST' or "
+                "'UPLOAD_FAILED DEST' (not retried until the next run) is "
+                "reported for each destination."))
     return argparser
 
 
@@ -120,8 +221,19 @@ def is_status_response(messages):
             and isinstance(messages[0], mtrreader.MtrStatusMessage))
 
 
+def remaining_secs(timeout_uptime):
+    if timeout_uptime is None:
+        return None
+    return max(0, (timeout_uptime - uptime()).total_seconds())
+
+
 def serial_port_with_live_mtr(
-        port, polling_timeout_secs, retry_wait_time_secs, serial_timeout_secs):
+        port, polling_timeout_secs, retry_wait_time_secs, serial_timeout_secs,
+        while_connected=False):
+    # Sends the status command as soon as the serial port device appears.
+    # Failed status polls are retried with wait times and read timeouts
+    # doubling up to retry_wait_time_secs and serial_timeout_secs. Gives up
+    # when the device disappears if while_connected.
     if polling_timeout_secs is None:
         polling_timeout_uptime = None
         logger.info("Polling serial port %s forever", port)
@@ -133,88 +245,176 @@ def serial_port_with_live_mtr(
                 "uptime is %s)",
                 port, polling_timeout_secs, polling_timeout_uptime)
 
-    while should_poll_mtr_for_status(polling_timeout_uptime):
-        try:
-            serial_port = serial.Serial(
-                    port=port, baudrate=9600, timeout=serial_timeout_secs)
-
+    with mtrdevice.DeviceWatcher(port) as device_watcher:
+        retry_wait_times = None
+        while should_poll_mtr_for_status(polling_timeout_uptime):
+            if not device_watcher.is_present():
+                if while_connected:
+                    logger.info("Serial port %s disconnected", port)
+                    return None, None
+                logger.info("Waiting for serial port %s to appear", port)
+                if not device_watcher.wait(
+                        True, remaining_secs(polling_timeout_uptime)):
+                    break
+                retry_wait_times = None
+            if retry_wait_times is None:
+                # a newly appeared device is polled at once
+                retry_wait_times = mtrdevice.backoff_delays(
+                        min_retry_wait_time_secs, retry_wait_time_secs)
+                read_timeouts = mtrdevice.backoff_delays(
+                        min_serial_timeout_secs, serial_timeout_secs)
+            serial_port, status_message = probe_serial_port(
+                    port, next(read_timeouts), serial_timeout_secs)
+            if serial_port is not None:
+                return serial_port, status_message
+
+            retry_wait_time_secs_now = next(retry_wait_times)
             logger.info(
-                    "Opened serial port %s, sending 'status' command '/ST'...",
-                    port)
-            mtr_reader_status = mtrreader.MtrReader(serial_port)
-            mtr_reader_status.send_status_command()
-            messages = mtr_reader_status.receive()
-            if is_status_response(messages):
-                logger.info(
-                        "MTR status response received, ID is %d",
-                        messages[0].mtr_id())
-                return serial_port
-
-        except serial.SerialException:
-            # Just log the error, the device could have been suddenly
-            # connected and could be responding next time.
-            logger.info((
-                "MTR status polling failed; Serial port %s was closed or "
-                "couldn't be opened"), port)
-
-        logger.info(
-                "Retrying MTR status polling in %d seconds",
-                retry_wait_time_secs)
-        time.sleep(retry_wait_time_secs)
+                    "Retrying MTR status polling in %.1f seconds",
+                    retry_wait_time_secs_now)
+            remaining_polling_secs = remaining_secs(polling_timeout_uptime)
+            # retried at once (as a new device) if the device is replaced
+            # while waiting
+            device_watcher.wait(
+                    False,
+                    retry_wait_time_secs_now if remaining_polling_secs is None
+                    else min(retry_wait_time_secs_now, remaining_polling_secs))
 
     logger.info(
             "No status response received on serial port %s in %d seconds. "
             "Giving up.",
             port, polling_timeout_secs)
-    return None
+    return None, None
 
 
-def write_mtr_log_file(log_lines, output_filename):
-    with open(output_filename, 'wb') as output_file:
-        for log_line in log_lines:
-            output_file.write(("%s\n" % log_line).encode('utf-8'))
-        logger.info("Wrote log file %s", output_filename)
-    return output_filename
-
+def probe_serial_port(port, read_timeout_secs, serial_timeout_secs):
+    # Sends the status command and returns the serial port, left open with
+    # serial_timeout_secs as timeout, and the status response. Returns None,
+    # None if no MTR answers within read_timeout_secs.
+    try:
+        serial_port = serial.Serial(
+                port=port, baudrate=9600, timeout=read_timeout_secs)
 
-def upload_mtr_log_file_dropbox(log_file_name, upload_dir, token):
-    dbx = dropbox.Dropbox(token)
-    with open(log_file_name, 'rb') as f:
-        upload_filename = os.path.basename(f.name)
-        dbx.files_upload(f.read(), upload_dir + "/" + upload_filename)
-    return
+        logger.info(
+                "Opened serial port %s, sending 'status' command '/ST'...",
+                port)
+        mtr_reader_status = mtrreader.MtrReader(serial_port)
+        mtr_reader_status.send_status_command()
+        messages = mtr_reader_status.receive(expected_num_messages=1)
+        if is_status_response(messages):
+            logger.info(
+                    "MTR status response received on serial port %s, ID is "
+                    "%d",
+                    port, messages[0].mtr_id())
+            # spooling ends when a read times out
+            serial_port.timeout = serial_timeout_secs
+            return serial_port, messages[0]
+        # not left open while waiting, which matters when running as daemon
+        serial_port.close()
+
+    except serial.SerialException:
+        # Just log the error, the device could have been suddenly
+        # connected and could be responding next time.
+        logger.info((
+            "MTR status polling failed; Serial port %s was closed or "
+            "couldn't be opened"), port)
+    return None, None
+
+
+def serial_ports_with_live_mtrs(
+        polling_timeout_secs, retry_wait_time_secs, serial_timeout_secs):
+    # Sends the status command to all the serial ports matching the auto
+    # patterns at the same time, so that finding the MTRs takes one read
+    # timeout however many serial ports there are. Failed rounds are retried
+    # like in serial_port_with_live_mtr(). Returns the serial ports with MTRs
+    # and their status responses, an empty list on timeout.
+    if polling_timeout_secs is None:
+        polling_timeout_uptime = None
+    else:
+        polling_timeout_uptime = (
+                uptime() + timedelta(seconds=polling_timeout_secs))
+    logger.info(
+            "Looking for MTRs at serial ports %s",
+            ' '.join(auto_serial_port_patterns))
+
+    with mtrdevice.DeviceWatcher(*auto_serial_port_patterns) as device_watcher:
+        probed_ports = None
+        while should_poll_mtr_for_status(polling_timeout_uptime):
+            if not device_watcher.wait(
+                    True, remaining_secs(polling_timeout_uptime)):
+                break
+            ports = device_watcher.devices()
+            if not ports:
+                # the serial port disappeared after the wait, wait again
+                continue
+            if ports != probed_ports:
+                # a newly connected MTR is found within the shortest timeout
+                retry_wait_times = mtrdevice.backoff_delays(
+                        min_retry_wait_time_secs, retry_wait_time_secs)
+                read_timeouts = mtrdevice.backoff_delays(
+                        min_serial_timeout_secs, serial_timeout_secs)
+                probed_ports = ports
+            probe = functools.partial(
+                    probe_serial_port,
+                    read_timeout_secs=next(read_timeouts),
+                    serial_timeout_secs=serial_timeout_secs)
+            with concurrent.futures.ThreadPoolExecutor(len(ports)) as executor:
+                live_mtrs = [
+                        (serial_port, status_message)
+                        for (serial_port, status_message)
+                        in executor.map(probe, ports)
+                        if serial_port is not None]
+            if live_mtrs:
+                return live_mtrs
+
+            retry_wait_time_secs_now = next(retry_wait_times)
+            logger.info(
+                    "No MTR answered, retrying in %.1f seconds",
+                    retry_wait_time_secs_now)
+            remaining_polling_secs = remaining_secs(polling_timeout_uptime)
+            # retried at once if serial ports are connected or disconnected
+            # while waiting
+            device_watcher.wait_for_other_devices(
+                    ports,
+                    retry_wait_time_secs_now if remaining_polling_secs is None
+                    else min(retry_wait_time_secs_now, remaining_polling_secs))
 
+    logger.info(
+            "No MTR answered on serial ports %s in %d seconds. Giving up.",
+            ' '.join(auto_serial_port_patterns), polling_timeout_secs)
+    return []
 
-def upload_mtr_log_file_http(log_file_name, url):
-    with open(log_file_name, 'rb') as f:
-        requests.post(url, files={'file': f})
-    return
 
+def log_mtr_status(status_message):
+    logger.info(
+            "MTR %d holds %d packages (package numbers %d-%d), battery %s",
+            status_message.mtr_id(),
+            status_message.num_packages(),
+            status_message.oldest_package_num(),
+            status_message.recent_package_num(),
+            'low' if status_message.battery_status() == 1 else 'ok')
+    for (sessions_back, session) in enumerate(status_message.sessions()):
+        logger.info(
+                "Session %d: %d packages (package numbers %d-%d)",
+                -sessions_back, len(session), session.start, session.stop - 1)
 
-exit_code_serial_port_unresponsive = 100
 
-argparser = create_argparser()
-args = argparser.parse_args()
-logger = initialize_logging()
-status_target_port = args.status_target_port
+def check_destination_args(destination_args):
+    try:
+        destination_args = mtrupload.split_timeout(destination_args)[0]
+    except ValueError:
+        argparser.error(
+                "Invalid destination timeout in %s" % destination_args)
+    if destination_args[0] == 'local':
+        if len(destination_args) < 2:
+            argparser.error(
+                    "Missing second destination argument value for "
+                    "destination 'local': path to directory")
+    elif destination_args[0] == 'dropbox':
+        check_dropbox_destination_args(destination_args)
 
-report_program_status(status_target_port, b'AWAITING_MTR')
 
-serial_port = serial_port_with_live_mtr(
-        args.serial_port,
-        polling_timeout_secs=args.serial_port_polling_timeout,
-        retry_wait_time_secs=5,
-        serial_timeout_secs=3)
-if serial_port is None:
-    logger.info(
-            "Serial port is unresponsive, exiting... (status=%d)",
-            exit_code_serial_port_unresponsive)
-    sys.exit(exit_code_serial_port_unresponsive)
-
-mtr_reader = mtrreader.MtrReader(serial_port)
-destination_args = args.destination
-dropbox_api_token = None
-if destination_args[0] == 'dropbox':
+def check_dropbox_destination_args(destination_args):
     if len(destination_args) < 2:
         argparser.error(
                 "Missing second destination argument value for "
@@ -244,35 +444,348 @@ if destination_args[0] == 'dropbox':
         logger.error(error_message)
         argparser.error(error_message)
 
-output_filename = (
-        args.output_file_name.format(datetime.now().strftime('%Y%m%dT%H%M%S')))
 
+def wait_for_uploads(upload_outbox, entry_destinations):
+    # Waits for the upload to each destination until the destination's
+    # timeout, reporting each destination as soon as it is done
+    start_time = time.monotonic()
+    deadlines = {}
+    for (entry_file_name, destination_args) in entry_destinations.items():
+        timeout_secs = mtrupload.split_timeout(destination_args)[1]
+        if timeout_secs is None:
+            timeout_secs = args.upload_timeout
+        deadlines[entry_file_name] = start_time + timeout_secs
+    while deadlines:
+        timeout_secs = max(0, min(deadlines.values()) - time.monotonic())
+        done_entries = upload_outbox.wait_until_any_done(
+                deadlines, timeout_secs)
+        now = time.monotonic()
+        for entry_file_name in list(deadlines):
+            destination_name = mtrupload.destination_name_of(
+                    entry_destinations[entry_file_name])
+            if (entry_file_name in done_entries
+                    and upload_outbox.has_failed(entry_file_name)):
+                logger.error(
+                        "Upload to %s failed, leaving it in outbox %s for "
+                        "the next run", destination_name, args.outbox)
+                report_program_status(
+                        status_target_port,
+                        ('UPLOAD_FAILED %s' % destination_name).encode())
+            elif entry_file_name in done_entries:
+                logger.info("Upload to %s done", destination_name)
+                report_program_status(
+                        status_target_port,
+                        ('UPLOADED %s' % destination_name).encode())
+            elif deadlines[entry_file_name] <= now:
+                logger.warning(
+                        "Upload to %s still pending after timeout, leaving "
+                        "it in outbox %s for the next run",
+                        destination_name, args.outbox)
+                report_program_status(
+                        status_target_port,
+                        ('UPLOAD_PENDING %s' % destination_name).encode())
+            else:
+                continue
+            del deadlines[entry_file_name]
+
+
+def write_mtr_log_file(log_lines, output_filename):
+    with open(output_filename, 'wb') as output_file:
+        num_log_lines = 0
+        for log_line in log_lines:
+            output_file.write(("%s\n" % log_line).encode('utf-8'))
+            # keep the file usable if reading is interrupted
+            output_file.flush()
+            num_log_lines += 1
+        logger.info(
+                "Wrote log file %s (%d lines)", output_filename, num_log_lines)
+    return output_filename
+
+
+def is_auto_serial_port():
+    return args.serial_port == ['auto']
+
+
+def serial_port_patterns():
+    if is_auto_serial_port():
+        return auto_serial_port_patterns
+    return args.serial_port
+
+
+def is_extracting_several_mtrs():
+    return (len(serial_port_patterns()) > 1
+            or any(glob.has_magic(port) for port in serial_port_patterns()))
+
+
+def output_file_name_of(mtr_id):
+    output_file_name = args.output_file_name
+    if is_extracting_several_mtrs() and '{mtr_id}' not in output_file_name:
+        (root, ext) = os.path.splitext(output_file_name)
+        output_file_name = root + '-{mtr_id}' + ext
+    return output_file_name.format(
+            datetime.now().strftime('%Y%m%dT%H%M%S'), mtr_id=mtr_id)
+
+
+def extract_mtr(serial_port, status_message, upload_outbox):
+    # Spools the MTR at the serial port to a log file and uploads it
+    log_mtr_status(status_message)
 
-report_program_status(status_target_port, b'READING_MTR')
-mtr_reader.send_spool_all_command()
-data_messages = mtr_reader.receive()
-datetime_extracted = datetime.now()
-log_lines = mtrlog.MtrLogFormatter().format_all(
-        data_messages, datetime_extracted)
-mtr_log_file_name = write_mtr_log_file(log_lines, output_filename)
+    mtr_reader = mtrreader.MtrReader(serial_port)
+    output_filename = output_file_name_of(status_message.mtr_id())
 
-report_program_status(status_target_port, b'UPLOADING')
-if destination_args[0] == 'dropbox':
+    # Connect to the destinations while reading from the MTR
+    for destination_args in args.destination:
+        mtrupload.start_warm_up(destination_args)
+
+    report_program_status(status_target_port, b'READING_MTR')
+    spool_start_package_num = None
+    if package_num_store is not None:
+        spool_start_package_num = package_num_store.spool_start_package_num(
+                status_message)
+    # Stop reading when the most recent package has been received instead of
+    # waiting for the serial port read to time out
+    last_package_num = status_message.recent_package_num() or None
+    datetime_extracted = datetime.now()
+    if spool_start_package_num is None:
+        mtr_reader.send_spool_all_command()
+        data_messages = mtr_reader.iter_messages(
+                last_package_num=last_package_num)
+    elif spool_start_package_num > status_message.recent_package_num():
+        logger.info(
+                "No packages after package number %d, skipping spool",
+                spool_start_package_num - 1)
+        data_messages = []
+    else:
+        logger.info(
+                "Spooling from package number %d", spool_start_package_num)
+        mtr_reader.send_spool_from_command(spool_start_package_num)
+        data_messages = mtr_reader.iter_messages(
+                last_package_num=last_package_num)
+    if mtr_archive is not None:
+        data_messages = mtr_archive.track(data_messages)
+    result_store = None
+    if args.result_db is not None:
+        # imported only when used, like the destinations' libraries
+        import mtrdb
+
+        result_store = mtrdb.MtrResultStore(args.result_db)
+        # committed in short batches, as other MTRs can be extracted into
+        # the same database at the same time
+        data_messages = result_store.track(data_messages, datetime_extracted)
+    if package_num_store is not None:
+        data_messages = package_num_store.track(data_messages)
+    # Each message is formatted and written as soon as it has been received
+    log_lines = mtrlog.MtrLogFormatter().iter_format(
+            data_messages, datetime_extracted)
     try:
-        upload_dir = ""
-        if len(destination_args) >= 3:
-            upload_dir = destination_args[2]
-            if not upload_dir.startswith("/"):
-                upload_dir = "/" + upload_dir
-        upload_mtr_log_file_dropbox(
-                mtr_log_file_name, upload_dir, dropbox_api_token)
-    except Exception:
-        logger.exception("Error when uploading MTR log file to Dropbox")
-else:
+        try:
+            mtr_log_file_name = write_mtr_log_file(log_lines, output_filename)
+        except serial.SerialException:
+            logger.exception(
+                    "Reading from serial port failed, keeping partial log "
+                    "file %s", output_filename)
+            mtr_log_file_name = output_filename
+        if result_store is not None:
+            result_store.save()
+    finally:
+        if result_store is not None:
+            result_store.close()
+    if package_num_store is not None:
+        package_num_store.save()
+
+    report_program_status(status_target_port, b'UPLOADING')
+    # The outbox uploads to all destinations concurrently
+    entry_destinations = {}
+    for destination_args in args.destination:
+        entry_file_name = upload_outbox.add(
+                mtr_log_file_name, destination_args, args.compress,
+                args.upload_mode)
+        entry_destinations[entry_file_name] = destination_args
+    wait_for_uploads(upload_outbox, entry_destinations)
+
+    report_program_status(status_target_port, b'DONE')
+
+
+def poll_and_extract_mtr(port, upload_outbox, while_connected=False):
+    # Returns False if no MTR responded on the serial port
+    serial_port, status_message = serial_port_with_live_mtr(
+            port,
+            polling_timeout_secs=args.serial_port_polling_timeout,
+            retry_wait_time_secs=5,
+            serial_timeout_secs=3,
+            while_connected=while_connected)
+    if serial_port is None:
+        return False
+    return extract_live_mtr(serial_port, status_message, upload_outbox)
+
+
+def extract_live_mtr(serial_port, status_message, upload_outbox):
+    try:
+        extract_mtr(serial_port, status_message, upload_outbox)
+    finally:
+        serial_port.close()
+    return True
+
+
+def extract_mtrs(port_extractions):
+    # Runs the extraction functions of the serial ports at the same time,
+    # one thread per serial port, so that the total time is that of the
+    # slowest MTR. An extraction function returns False if the serial port
+    # is unresponsive. Returns the serial ports that were unresponsive and
+    # the ones where extraction failed.
+    unresponsive_ports = []
+    failed_ports = []
+    with concurrent.futures.ThreadPoolExecutor(
+            len(port_extractions)) as executor:
+        futures = {
+                executor.submit(extract_mtr_at_port): port
+                for (port, extract_mtr_at_port) in port_extractions.items()}
+        for future in concurrent.futures.as_completed(futures):
+            port = futures[future]
+            try:
+                if not future.result():
+                    unresponsive_ports.append(port)
+            except Exception:
+                logger.exception(
+                        "Extracting MTR on serial port %s failed", port)
+                failed_ports.append(port)
+    return unresponsive_ports, failed_ports
+
+
+def serial_ports_of(port_patterns):
+    # The serial ports given, with glob patterns expanded to the existing
+    # ports
+    ports = []
+    for port_pattern in port_patterns:
+        if not glob.has_magic(port_pattern):
+            ports.append(port_pattern)
+            continue
+        matching_ports = sorted(glob.glob(port_pattern))
+        if not matching_ports:
+            argparser.error("No serial port matches %s" % port_pattern)
+        ports.extend(matching_ports)
+    # each port once
+    return list(dict.fromkeys(ports))
+
+
+def run_daemon(upload_outbox):
+    # Extracts each MTR connected to the serial ports, until killed. MTRs
+    # at different serial ports are extracted at the same time. Imports,
+    # destinations and their connections are kept between MTRs.
+    logger.info(
+            "Running as daemon on serial ports %s",
+            ' '.join(serial_port_patterns()))
+    for destination_args in args.destination:
+        mtrupload.start_warm_up(destination_args)
+    report_program_status(status_target_port, b'AWAITING_MTR')
+    port_threads = {}
+    with mtrdevice.DeviceWatcher(*serial_port_patterns()) as device_watcher:
+        while True:
+            for port in device_watcher.devices():
+                if port in port_threads and port_threads[port].is_alive():
+                    continue
+                port_threads[port] = threading.Thread(
+                        target=extract_connected_mtr,
+                        args=(port, upload_outbox),
+                        name=port,
+                        daemon=True)
+                port_threads[port].start()
+            # a port reconnected just before its thread ended is picked up
+            # by the next check
+            device_watcher.wait_for_change(1)
+
+
+def extract_connected_mtr(port, upload_outbox):
+    # Extracts the MTR connected to the serial port and waits for it to be
+    # disconnected
     try:
-        upload_mtr_log_file_http(mtr_log_file_name, destination_args[0])
+        poll_and_extract_mtr(port, upload_outbox, while_connected=True)
     except Exception:
-        logger.exception(
-                "Error when uploading MTR log file using plain HTTP POST")
+        # keep serving the next MTR
+        logger.exception("Extracting MTR on serial port %s failed", port)
+    logger.info(
+            "Waiting for MTR to be disconnected from serial port %s", port)
+    wait_for_device(port, is_connected=False)
+    logger.info("MTR disconnected from serial port %s", port)
+    report_program_status(status_target_port, b'AWAITING_MTR')
+
 
-report_program_status(status_target_port, b'DONE')
+def wait_for_device(port, is_connected):
+    # Waits until the serial port device (node or symlink, e.g. created by
+    # udev) exists, or until it no longer exists if not is_connected
+    with mtrdevice.DeviceWatcher(port) as device_watcher:
+        device_watcher.wait(is_connected)
+
+
+exit_code_serial_port_unresponsive = 100
+# serial ports of USB serial adapters, as used by MTRs
+auto_serial_port_patterns = ['/dev/ttyUSB*', '/dev/ttyACM*']
+# first wait time and read timeout of status polls of a new device
+min_retry_wait_time_secs = 0.1
+min_serial_timeout_secs = 0.5
+
+argparser = create_argparser()
+args = argparser.parse_args()
+logger = initialize_logging()
+status_target_port = args.status_target_port
+if not args.destination:
+    argparser.error("At least one destination (-d) is required")
+if (args.compress is not None
+        and not mtrupload.is_compression_available(args.compress)):
+    argparser.error(
+            "Compression '%s' requires the zstandard module" % args.compress)
+
+for destination_args in args.destination:
+    check_destination_args(destination_args)
+if 'auto' in args.serial_port and not is_auto_serial_port():
+    argparser.error("Serial port 'auto' cannot be given with other ports")
+
+# Upload log files left by earlier runs while waiting for the MTR
+upload_outbox = mtrupload.UploadOutbox(
+        args.outbox,
+        ack_store=mtrstate.AcknowledgedPackageStore(args.ack_file))
+upload_outbox.start()
+
+# Shared by the MTRs extracted at the same time
+package_num_store = None
+if args.incremental is not None:
+    package_num_store = mtrstate.PackageNumberStore(args.incremental)
+mtr_archive = None
+if args.archive is not None:
+    # imported only when used, like the destinations' libraries
+    import mtrarchive
+
+    mtr_archive = mtrarchive.MtrArchive(args.archive)
+
+if args.daemon:
+    run_daemon(upload_outbox)
+
+if is_auto_serial_port():
+    report_program_status(status_target_port, b'AWAITING_MTR')
+    live_mtrs = serial_ports_with_live_mtrs(
+            polling_timeout_secs=args.serial_port_polling_timeout,
+            retry_wait_time_secs=5,
+            serial_timeout_secs=3)
+    if not live_mtrs:
+        logger.info(
+                "No MTR found, exiting... (status=%d)",
+                exit_code_serial_port_unresponsive)
+        sys.exit(exit_code_serial_port_unresponsive)
+    port_extractions = {
+            serial_port.port: functools.partial(
+                extract_live_mtr, serial_port, status_message, upload_outbox)
+            for (serial_port, status_message) in live_mtrs}
+else:
+    port_extractions = {
+            port: functools.partial(poll_and_extract_mtr, port, upload_outbox)
+            for port in serial_ports_of(args.serial_port)}
+    report_program_status(status_target_port, b'AWAITING_MTR')
+
+unresponsive_ports, failed_ports = extract_mtrs(port_extractions)
+if unresponsive_ports:
+    logger.info(
+            "Serial port %s is unresponsive, exiting... (status=%d)",
+            ' '.join(unresponsive_ports), exit_code_serial_port_unresponsive)
+    sys.exit(exit_code_serial_port_unresponsive)
+if failed_ports:
+    sys.exit(1)
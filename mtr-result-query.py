@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import mtrdb
+
+
+def create_argparser():
+    argparser = argparse.ArgumentParser(
+            description=(
+                "Query MTR data messages stored in a result database by "
+                "mtr-log-extractor.py --result-db."))
+    argparser.add_argument('db', help='Result database file')
+    argparser.add_argument(
+            '-s', '--splits', action='store_true',
+            help='Also print the control code and time of each split')
+    subparsers = argparser.add_subparsers(dest='query', required=True)
+    card_parser = subparsers.add_parser(
+            'card', help='Messages of a card')
+    card_parser.add_argument('card_id', type=int)
+    read_parser = subparsers.add_parser(
+            'read-between',
+            help=(
+                "Messages of cards read at or after START and before END, "
+                "e.g. late finishers. Times are given like "
+                "'2019-05-17 13:00'."))
+    read_parser.add_argument('start')
+    read_parser.add_argument('end')
+    course_parser = subparsers.add_parser(
+            'course', help='Messages with splits at all the control codes')
+    course_parser.add_argument('control_codes', type=int, nargs='+')
+    missing_parser = subparsers.add_parser(
+            'missing',
+            help=(
+                'Messages without a split at one or more of the control '
+                'codes'))
+    missing_parser.add_argument('control_codes', type=int, nargs='+')
+    return argparser
+
+
+def print_message(row, extra=''):
+    print("MTR %d package %d card %d read %s%s" % (
+        row['mtr_id'], row['packet_num'], row['card_id'],
+        row['read_time'] or '-', extra))
+    if args.splits:
+        for (control_code, time_secs) in result_store.splits(
+                row['mtr_id'], row['packet_num']):
+            print("    %03d %5d" % (control_code, time_secs))
+
+
+args = create_argparser().parse_args()
+result_store = mtrdb.MtrResultStore(args.db)
+# (row, extra text printed after the message)
+if args.query == 'card':
+    rows = [(row, '') for row in result_store.by_card_id(args.card_id)]
+elif args.query == 'read-between':
+    rows = [
+            (row, '')
+            for row in result_store.read_between(args.start, args.end)]
+elif args.query == 'course':
+    rows = [
+            (row, '')
+            for row in result_store.with_controls(args.control_codes)]
+elif args.query == 'missing':
+    rows = [
+            (row, " missing %s" % ','.join(
+                '%d' % control_code for control_code in missing_control_codes))
+            for (row, missing_control_codes)
+            in result_store.missing_controls(args.control_codes)]
+for (row, extra) in rows:
+    print_message(row, extra)
+print("%d messages" % len(rows))
+result_store.close()
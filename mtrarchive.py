@@ -0,0 +1,212 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime
+
+import mtrreader
+
+logger = logging.getLogger()
+
+RECORD_SIZE = mtrreader.MtrDataMessage.NUMBYTES
+# MTR-id, package number, card-id, read time (seconds since READ_TIME_EPOCH)
+INDEX_ENTRY = struct.Struct('<HIII')
+READ_TIME_EPOCH = datetime(2000, 1, 1)
+
+
+def read_time_secs_of(data_message):
+    # 0 if the timestamp is not a valid date
+    try:
+        read_time = datetime(
+                2000 + data_message.timestamp_year(),
+                data_message.timestamp_month(),
+                data_message.timestamp_day(),
+                data_message.timestamp_hours(),
+                data_message.timestamp_minutes(),
+                data_message.timestamp_seconds())
+    except ValueError:
+        return 0
+    return max(0, int((read_time - READ_TIME_EPOCH).total_seconds()))
+
+
+def index_entry_of(data_message):
+    return (
+            data_message.mtr_id(),
+            data_message.packet_num(),
+            data_message.card_id(),
+            read_time_secs_of(data_message))
+
+
+# Archive of raw MTR data messages, kept as fixed size records one after
+# another in one file (the same layout as read from the MTR) and an index
+# file with one small entry per record. The index is loaded into memory for
+# lookups, records are read from a memory map of the archive without
+# copying. An archive opened read_only, e.g. for lookups while the extractor
+# is appending to it, never writes to the files.
+class MtrArchive:
+
+    def __init__(self, file_name, read_only=False):
+        self.file_name = file_name
+        self.index_file_name = file_name + '.idx'
+        self.read_only = read_only
+        self.entries = []
+        self.record_nums_by_package = {}
+        self.record_nums_by_card_id = {}
+        self.record_nums_by_mtr_id = {}
+        # (read time, record number), sorted
+        self.read_times = []
+        self.mmap = None
+        # messages of several MTRs can be appended at the same time
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return
+        if self.read_only:
+            num_records = os.path.getsize(self.file_name) // RECORD_SIZE
+        else:
+            num_records = self.repair()
+        index_bytes = b''
+        if os.path.exists(self.index_file_name):
+            with open(self.index_file_name, 'rb') as index_file:
+                index_bytes = index_file.read()
+        # Records past the last index entry (and the entries of partial
+        # records) are only read from the archive by the appending writer:
+        # for a reader they may still be being appended.
+        num_entries = min(num_records, len(index_bytes) // INDEX_ENTRY.size)
+        for entry in INDEX_ENTRY.iter_unpack(
+                index_bytes[:num_entries * INDEX_ENTRY.size]):
+            self.add_entry(entry)
+        if not self.read_only and len(self.entries) < num_records:
+            # the index lags behind after an interrupted append
+            logger.info(
+                    "Indexing %d records of MTR archive %s missing in index",
+                    num_records - len(self.entries), self.file_name)
+            with open(self.file_name, 'rb') as archive_file:
+                archive_file.seek(len(self.entries) * RECORD_SIZE)
+                missing_records = archive_file.read()
+            with open(self.index_file_name, 'ab') as index_file:
+                for offset in range(0, len(missing_records), RECORD_SIZE):
+                    entry = index_entry_of(mtrreader.MtrDataMessage(
+                        missing_records, offset))
+                    index_file.write(INDEX_ENTRY.pack(*entry))
+                    self.add_entry(entry)
+
+    def repair(self):
+        # Drops partly written records and index entries of an interrupted
+        # append. Returns the number of records.
+        num_records = os.path.getsize(self.file_name) // RECORD_SIZE
+        if os.path.getsize(self.file_name) != num_records * RECORD_SIZE:
+            logger.warning(
+                    "Dropping partial record at end of MTR archive %s",
+                    self.file_name)
+            os.truncate(self.file_name, num_records * RECORD_SIZE)
+        if not os.path.exists(self.index_file_name):
+            open(self.index_file_name, 'wb').close()
+        num_entries = min(
+                num_records,
+                os.path.getsize(self.index_file_name) // INDEX_ENTRY.size)
+        if os.path.getsize(self.index_file_name) != (
+                num_entries * INDEX_ENTRY.size):
+            os.truncate(self.index_file_name, num_entries * INDEX_ENTRY.size)
+        return num_records
+
+    def add_entry(self, entry):
+        (mtr_id, package_num, card_id, read_time_secs) = entry
+        record_num = len(self.entries)
+        self.entries.append(entry)
+        self.record_nums_by_package.setdefault(
+                (mtr_id, package_num), []).append(record_num)
+        self.record_nums_by_card_id.setdefault(card_id, []).append(
+                record_num)
+        self.record_nums_by_mtr_id.setdefault(mtr_id, []).append(record_num)
+        bisect.insort(self.read_times, (read_time_secs, record_num))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, data_messages):
+        # Returns the number of messages appended. Messages already in the
+        # archive and messages with invalid checksum are skipped.
+        num_records = len(self.entries)
+        for data_message in self.track(data_messages):
+            pass
+        return len(self.entries) - num_records
+
+    def track(self, data_messages):
+        # Appends data messages as they pass through, like append()
+        if self.read_only:
+            raise ValueError(
+                    "MTR archive %s is opened read-only" % self.file_name)
+        with open(self.file_name, 'ab') as archive_file, \
+                open(self.index_file_name, 'ab') as index_file:
+            for data_message in data_messages:
+                with self.lock:
+                    if (data_message.is_checksum_valid()
+                            and not self.is_archived(data_message)):
+                        entry = index_entry_of(data_message)
+                        # the record is written before its index entry, see
+                        # load()
+                        archive_file.write(data_message.message_bytes)
+                        archive_file.flush()
+                        index_file.write(INDEX_ENTRY.pack(*entry))
+                        index_file.flush()
+                        self.add_entry(entry)
+                yield data_message
+
+    def is_archived(self, data_message):
+        message_bytes = data_message.message_bytes
+        return any(
+                self.message(record_num).message_bytes == message_bytes
+                for record_num in self.record_nums_by_package.get(
+                    (data_message.mtr_id(), data_message.packet_num()), ()))
+
+    def message(self, record_num):
+        # The message shares memory with the memory map of the archive
+        if self.mmap is None or len(self.mmap) <= record_num * RECORD_SIZE:
+            # mapped again when the archive has grown, messages keep the
+            # earlier map alive as long as they need it
+            with open(self.file_name, 'rb') as archive_file:
+                self.mmap = mmap.mmap(
+                        archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return mtrreader.MtrDataMessage(self.mmap, record_num * RECORD_SIZE)
+
+    def batch(self):
+        # All messages as an mtrbatch.MtrBatch (requires NumPy) sharing
+        # memory with the memory map of the archive. Imported here, NumPy is
+        # not needed for archiving.
+        import mtrbatch
+
+        if not self.entries:
+            return mtrbatch.MtrBatch(b'')
+        # without records past the last index entry
+        return mtrbatch.MtrBatch(memoryview(
+                self.message(len(self.entries) - 1).buffer)[
+                    :len(self.entries) * RECORD_SIZE])
+
+    def messages(self, record_nums):
+        return [self.message(record_num) for record_num in record_nums]
+
+    def by_package(self, mtr_id, package_num):
+        return self.messages(
+                self.record_nums_by_package.get((mtr_id, package_num), []))
+
+    def by_card_id(self, card_id):
+        return self.messages(self.record_nums_by_card_id.get(card_id, []))
+
+    def by_read_time(self, start, end):
+        # Messages read at or after start and before end (datetimes), in
+        # order of read time
+        start_secs = int((start - READ_TIME_EPOCH).total_seconds())
+        end_secs = int((end - READ_TIME_EPOCH).total_seconds())
+        return self.messages(
+                record_num
+                for (read_time_secs, record_num) in self.read_times[
+                    bisect.bisect_left(self.read_times, (start_secs, -1)):
+                    bisect.bisect_left(self.read_times, (end_secs, -1))])
+
+    def by_mtr_id(self, mtr_id):
+        return self.messages(self.record_nums_by_mtr_id.get(mtr_id, []))
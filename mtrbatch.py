@@ -0,0 +1,139 @@
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, only needed for batches
+    numpy = None
+
+import mtrlog
+import mtrreader
+
+if numpy is not None:
+    # Layout of MTR data message, see mtrreader
+    DATA_MESSAGE_DTYPE = numpy.dtype([
+        ('preamble', 'u1', (4,)),
+        ('package_size', 'u1'),
+        ('package_type', 'u1'),
+        ('mtr_id', '<u2'),
+        ('timestamp_year', 'u1'),
+        ('timestamp_month', 'u1'),
+        ('timestamp_day', 'u1'),
+        ('timestamp_hours', 'u1'),
+        ('timestamp_minutes', 'u1'),
+        ('timestamp_seconds', 'u1'),
+        ('timestamp_milliseconds', '<u2'),
+        ('packet_num', '<u4'),
+        ('card_id', 'u1', (3,)),
+        ('product_week', 'u1'),
+        ('product_year', 'u1'),
+        ('ecard_head_checksum', 'u1'),
+        ('splits', [('code', 'u1'), ('time', '<u2')], (50,)),
+        ('ascii_string', 'S56'),
+        ('checksum', 'u1'),
+        ('null_filler', 'u1'),
+    ])
+
+
+def is_available():
+    return numpy is not None
+
+
+# Columnar view of many MTR data messages stored one after another in one
+# buffer. Columns are NumPy arrays sharing memory with the buffer.
+class MtrBatch:
+
+    def __init__(self, buffer):
+        if numpy is None:
+            raise ImportError("MtrBatch requires NumPy")
+        numbytes = mtrreader.MtrDataMessage.NUMBYTES
+        if len(buffer) % numbytes != 0:
+            raise ValueError(
+                    "Buffer size %d is not a multiple of data message size %d"
+                    % (len(buffer), numbytes))
+        self.buffer = buffer
+        self.records = numpy.frombuffer(buffer, dtype=DATA_MESSAGE_DTYPE)
+
+    @classmethod
+    def from_messages(cls, data_messages):
+        return cls(b''.join(msg.message_bytes for msg in data_messages))
+
+    @classmethod
+    def from_log_lines(cls, log_lines):
+        # lines that are not data message log lines are skipped
+        return cls(mtrlog.MtrLogParser().parse_frames(log_lines))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        numbytes = mtrreader.MtrDataMessage.NUMBYTES
+        for offset in range(0, len(self.records) * numbytes, numbytes):
+            yield mtrreader.MtrDataMessage(self.buffer, offset)
+
+    def mtr_id(self):
+        return self.records['mtr_id']
+
+    def timestamp_year(self):
+        return self.records['timestamp_year']
+
+    def timestamp_month(self):
+        return self.records['timestamp_month']
+
+    def timestamp_day(self):
+        return self.records['timestamp_day']
+
+    def timestamp_hours(self):
+        return self.records['timestamp_hours']
+
+    def timestamp_minutes(self):
+        return self.records['timestamp_minutes']
+
+    def timestamp_seconds(self):
+        return self.records['timestamp_seconds']
+
+    def timestamp_milliseconds(self):
+        return self.records['timestamp_milliseconds']
+
+    def packet_num(self):
+        return self.records['packet_num']
+
+    def card_id(self):
+        card_id_bytes = self.records['card_id'].astype('<u4')
+        return (card_id_bytes[:, 0]
+                | card_id_bytes[:, 1] << 8
+                | card_id_bytes[:, 2] << 16)
+
+    def split_codes(self):
+        # (N, 50) matrix of control codes
+        return self.records['splits']['code']
+
+    def split_times(self):
+        # (N, 50) matrix of times at controls
+        return self.records['splits']['time']
+
+    def flat_splits(self):
+        # (N, 100) matrix of control code and time of each split after one
+        # another
+        return numpy.stack(
+                (self.split_codes(), self.split_times()),
+                axis=2).reshape(len(self.records), 100)
+
+    def num_splits(self):
+        # number of splits up to and including the last one not all zero,
+        # one element per message
+        is_split_used = self.flat_splits().reshape(
+                len(self.records), 50, 2).any(axis=2)
+        last_unused_splits = numpy.argmax(is_split_used[:, ::-1], axis=1)
+        return numpy.where(
+                is_split_used.any(axis=1), 50 - last_unused_splits, 0)
+
+    def is_checksum_valid(self):
+        # boolean array, one element per message
+        message_bytes = numpy.frombuffer(self.buffer, dtype='u1').reshape(
+                len(self.records), mtrreader.MtrDataMessage.NUMBYTES)
+        calculated_checksums = (
+                message_bytes[:, :232].sum(axis=1, dtype='u4') % 256)
+        return calculated_checksums == self.records['checksum']
+
+    def valid(self):
+        # new batch with only the messages with valid checksum
+        return MtrBatch(self.records[self.is_checksum_valid()].tobytes())
@@ -0,0 +1,177 @@
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger()
+
+# Several MTRs can be extracted into the same database at the same time,
+# each with its own connection. Tracked messages are committed at least this
+# often, so that a write transaction is never open for a whole spool and
+# the other connections wait for it much less than TIMEOUT_SECS.
+COMMIT_INTERVAL_SECS = 1
+# How long a connection waits for another one's write transaction
+TIMEOUT_SECS = 30
+
+# One row per data message, and one row per used split of a message (unused
+# splits are all zero and not stored). Times are ISO 8601 text, so that they
+# sort and compare as times. The read time is NULL if the message's timestamp
+# is not a valid date.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    mtr_id INTEGER NOT NULL,
+    packet_num INTEGER NOT NULL,
+    card_id INTEGER NOT NULL,
+    read_time TEXT,
+    extracted_time TEXT NOT NULL,
+    num_splits INTEGER NOT NULL,
+    PRIMARY KEY (mtr_id, packet_num)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_card_id ON messages (card_id);
+CREATE INDEX IF NOT EXISTS messages_read_time ON messages (read_time);
+CREATE TABLE IF NOT EXISTS splits (
+    mtr_id INTEGER NOT NULL,
+    packet_num INTEGER NOT NULL,
+    split_num INTEGER NOT NULL,
+    control_code INTEGER NOT NULL,
+    time_secs INTEGER NOT NULL,
+    PRIMARY KEY (mtr_id, packet_num, split_num)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS splits_control_code ON splits (control_code);
+'''
+
+
+def read_time_of(msg):
+    fields = msg.fields()
+    (year, month, day, hours, minutes, seconds, milliseconds) = fields[3:10]
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hours < 24
+            and minutes < 60 and seconds < 60):
+        return None
+    return '%04d-%02d-%02d %02d:%02d:%02d.%03d' % (
+            2000 + year, month, day, hours, minutes, seconds, milliseconds)
+
+
+# Store of extracted MTR data messages in an SQLite database, for queries
+# over many extractions. Messages are identified by MTR-id and package
+# number, messages already in the store are not inserted again.
+class MtrResultStore:
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name, timeout=TIMEOUT_SECS)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        # messages tracked and inserted since the last save()
+        self.num_tracked = 0
+        self.num_inserted = 0
+
+    def close(self):
+        self.connection.close()
+
+    def insert(self, data_messages, datetime_extracted):
+        # Inserts and commits all messages. Returns the number of messages
+        # inserted.
+        for data_message in self.track(data_messages, datetime_extracted):
+            pass
+        return self.save()
+
+    def track(self, data_messages, datetime_extracted):
+        # Inserts data messages as they pass through. They are committed in
+        # batches of COMMIT_INTERVAL_SECS, the rest by save().
+        extracted_time = datetime_extracted.isoformat(' ', 'milliseconds')
+        cursor = self.connection.cursor()
+        commit_time = None
+        for data_message in data_messages:
+            if commit_time is None:
+                # the write transaction starts with the first insert
+                commit_time = time.monotonic() + COMMIT_INTERVAL_SECS
+            self.insert_message(cursor, data_message, extracted_time)
+            if time.monotonic() >= commit_time:
+                self.connection.commit()
+                commit_time = None
+            yield data_message
+
+    def insert_message(self, cursor, msg, extracted_time):
+        self.num_tracked += 1
+        mtr_id = msg.mtr_id()
+        packet_num = msg.packet_num()
+        num_splits = msg.num_splits()
+        cursor.execute(
+                'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+                (mtr_id, packet_num, msg.card_id(), read_time_of(msg),
+                 extracted_time, num_splits))
+        if cursor.rowcount == 0:
+            # already in the store
+            return
+        self.num_inserted += 1
+        flat_splits = msg.flat_splits()
+        cursor.executemany(
+                'INSERT INTO splits VALUES (?, ?, ?, ?, ?)',
+                ((mtr_id, packet_num, split_num,
+                  flat_splits[2 * split_num], flat_splits[2 * split_num + 1])
+                 for split_num in range(num_splits)))
+
+    def save(self):
+        # Commits the messages not committed yet. Returns the number of
+        # messages inserted since the last save().
+        self.connection.commit()
+        logger.info(
+                "Inserted %d of %d messages into %s",
+                self.num_inserted, self.num_tracked, self.file_name)
+        num_inserted = self.num_inserted
+        self.num_tracked = 0
+        self.num_inserted = 0
+        return num_inserted
+
+    def query_messages(self, where, parameters=()):
+        return self.connection.execute(
+                'SELECT * FROM messages WHERE %s '
+                'ORDER BY read_time, mtr_id, packet_num' % where,
+                parameters).fetchall()
+
+    def by_card_id(self, card_id):
+        return self.query_messages('card_id = ?', (card_id,))
+
+    def read_between(self, start, end):
+        # Messages read at or after start and before end (ISO 8601 text)
+        return self.query_messages(
+                'read_time >= ? AND read_time < ?', (start, end))
+
+    def with_controls(self, control_codes):
+        # Messages with splits at all the control codes
+        return self.query_messages(
+                '(mtr_id, packet_num) IN (%s)' % ' INTERSECT '.join(
+                    len(control_codes)
+                    * ['SELECT mtr_id, packet_num FROM splits '
+                       'WHERE control_code = ?']),
+                tuple(control_codes))
+
+    def missing_controls(self, control_codes):
+        # Messages without a split at one or more of the control codes, with
+        # the missing control codes
+        punched_by_control_code = {
+                control_code: set(
+                    (row['mtr_id'], row['packet_num'])
+                    for row in self.connection.execute(
+                        'SELECT mtr_id, packet_num FROM splits '
+                        'WHERE control_code = ?', (control_code,)))
+                for control_code in control_codes}
+        rows = self.query_messages(
+                ' OR '.join(
+                    len(control_codes)
+                    * ['(mtr_id, packet_num) NOT IN ('
+                       'SELECT mtr_id, packet_num FROM splits '
+                       'WHERE control_code = ?)']),
+                tuple(control_codes))
+        return [
+                (row, [control_code for control_code in control_codes
+                       if (row['mtr_id'], row['packet_num'])
+                       not in punched_by_control_code[control_code]])
+                for row in rows]
+
+    def splits(self, mtr_id, packet_num):
+        return [
+                (row['control_code'], row['time_secs'])
+                for row in self.connection.execute(
+                    'SELECT control_code, time_secs FROM splits '
+                    'WHERE mtr_id = ? AND packet_num = ? ORDER BY split_num',
+                    (mtr_id, packet_num))]
@@ -0,0 +1,132 @@
+import ctypes
+import glob
+import logging
+import os
+import select
+import time
+
+logger = logging.getLogger()
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    inotify_init1 = libc.inotify_init1
+    inotify_add_watch = libc.inotify_add_watch
+except AttributeError:
+    # inotify is Linux only, devices are polled elsewhere
+    inotify_init1 = None
+
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Events of device nodes and symlinks (as created by udev) appearing or
+# disappearing. Permissions are often set right after the node is created.
+DEVICE_EVENTS = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+POLLING_INTERVAL_SECS = 0.1
+
+
+def backoff_delays(initial_secs, max_secs):
+    # Delays doubling from initial_secs up to max_secs
+    delay_secs = initial_secs
+    while True:
+        yield min(delay_secs, max_secs)
+        delay_secs *= 2
+
+
+# Waits for devices (e.g. serial ports) to appear or disappear. Devices are
+# given as paths or glob patterns, like /dev/ttyUSB*. Changes in the
+# devices' directories are watched with inotify, falling back to polling
+# where inotify is not available (or a directory does not exist yet).
+class DeviceWatcher:
+
+    def __init__(self, *path_patterns):
+        self.path_patterns = path_patterns
+        self.inotify_fd = None
+        if inotify_init1 is None:
+            return
+        inotify_fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if inotify_fd < 0:
+            logger.warning(
+                    "inotify not available (%s), polling devices %s",
+                    os.strerror(ctypes.get_errno()), ' '.join(path_patterns))
+            return
+        for path_pattern in path_patterns:
+            directory = os.path.dirname(os.path.abspath(path_pattern))
+            if glob.has_magic(directory) or inotify_add_watch(
+                    inotify_fd, os.fsencode(directory), DEVICE_EVENTS) < 0:
+                logger.warning(
+                        "Cannot watch directory %s, polling devices %s",
+                        directory, ' '.join(path_patterns))
+                os.close(inotify_fd)
+                return
+        self.inotify_fd = inotify_fd
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def devices(self):
+        # Paths of the devices present, sorted
+        return sorted(set(
+                path
+                for path_pattern in self.path_patterns
+                for path in glob.glob(path_pattern)
+                # not a dangling symlink
+                if os.path.exists(path)))
+
+    def is_present(self):
+        return len(self.devices()) > 0
+
+    def wait(self, is_present=True, timeout_secs=None):
+        # Waits until any device is present (or none is present), at most
+        # timeout_secs if given. Returns True if it is.
+        return self.wait_until(
+                lambda: self.is_present() == is_present, timeout_secs)
+
+    def wait_for_other_devices(self, devices, timeout_secs=None):
+        # Waits until the devices present are not the given ones, at most
+        # timeout_secs if given. Returns True if they are not.
+        return self.wait_until(
+                lambda: self.devices() != devices, timeout_secs)
+
+    def wait_until(self, condition, timeout_secs=None):
+        deadline = (
+                None if timeout_secs is None
+                else time.monotonic() + timeout_secs)
+        while not condition():
+            wait_secs = (
+                    None if deadline is None
+                    else deadline - time.monotonic())
+            if wait_secs is not None and wait_secs <= 0:
+                return False
+            self.wait_for_change(wait_secs)
+        return True
+
+    def wait_for_change(self, timeout_secs=None):
+        # Returns when the devices' directories may have changed, at the
+        # latest after timeout_secs if given
+        if self.inotify_fd is None:
+            time.sleep(
+                    POLLING_INTERVAL_SECS if timeout_secs is None
+                    else min(POLLING_INTERVAL_SECS, timeout_secs))
+        elif select.select([self.inotify_fd], [], [], timeout_secs)[0]:
+            # the events are not needed, only that something changed
+            self.read_events()
+
+    def read_events(self):
+        try:
+            while os.read(self.inotify_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
@@ -1,41 +1,224 @@
 import logging
+import struct
+
+import mtrreader
 
 logger = logging.getLogger()
 
+# MTR log file line: package type, 0, MTR-id, card-id, extraction timestamp,
+# card read timestamp, card-id, product week (skipped), product year
+# (skipped), control code and time of 50 splits, package number
+LOG_LINE_TEMPLATE = (
+        '"M","0","%d","%06d","%s",'
+        '"%02d.%02d.%02d %02d:%02d:%02d.%03d",'
+        '%06d,0000,0000,'
+        + 50 * '%03d,%05d,'
+        + '%07d')
+
+# Templates by number of splits used. Unused splits are all zero so they are
+# part of the template instead of being formatted one by one.
+LOG_LINE_TEMPLATES_BY_NUM_SPLITS = [
+        LOG_LINE_TEMPLATE.replace(
+            (50 - num_splits) * '%03d,%05d,' + '%07d',
+            (50 - num_splits) * '000,00000,' + '%07d')
+        for num_splits in range(51)]
+
+DATETIME_EXTRACTED_FORMAT = '%d.%m.%y %H:%M:%S.000'
+
+# Unused splits at the end of a log line, by number of unused splits
+UNUSED_SPLITS_STRS = [num_splits * '000,00000,' for num_splits in range(51)]
+# Data message up to the checksum, as mtrreader.MtrDataMessage.FIELDS and
+# SPLITS with the preamble and ASCII-string, by number of used splits
+# (unused splits are padding, i.e. zero)
+DATA_MESSAGE_STRUCTS = [
+        struct.Struct(
+            '<4s' + mtrreader.MtrDataMessage.FIELDS.format[3:]
+            + num_splits * 'BH' + '%dx' % (3 * (50 - num_splits)) + '56s')
+        for num_splits in range(51)]
+# Two digit numbers of log line timestamps, looked up instead of parsed for
+# speed
+TWO_DIGIT_NUMBERS = {'%02d' % n: n for n in range(100)}
+# Not in log lines. The values are the ones of packages spooled from the MTR
+# (retrieved from "history", see mtrreader).
+ASCII_STRING_FROM_HISTORY = 56 * b' '
+
+
+def mtr_id_and_packet_num_of(log_line):
+    # Returns (MTR-id, package number) of a log line, None if the line is
+    # not an MTR log line
+    fields = log_line.rstrip('\r\n').split(',')
+    try:
+        return (int(fields[2].strip('"')), int(fields[-1]))
+    except (IndexError, ValueError):
+        return None
+
+
+# Parses MTR log lines back into data messages, the reverse of
+# MtrLogFormatter. A data message spooled from the MTR is parsed back into
+# the same bytes it was formatted from.
+class MtrLogParser:
+
+    def parse(self, log_line):
+        # Raises ValueError if the line is not a data message log line
+        message_bytes = bytearray(mtrreader.MtrDataMessage.NUMBYTES)
+        self.parse_into(log_line, message_bytes, 0)
+        return mtrreader.MtrDataMessage(message_bytes)
+
+    def iter_parse(self, log_lines):
+        # Yields a data message for each log line. Lines that are not data
+        # message log lines are skipped.
+        for (line_num, log_line) in enumerate(log_lines, 1):
+            try:
+                yield self.parse(log_line)
+            except ValueError as e:
+                logger.warning("Skipping log line %d: %s", line_num, e)
+
+    def parse_frames(self, log_lines):
+        # Returns the data messages of all log lines one after another in
+        # one buffer, e.g. for mtrbatch.MtrBatch. Lines that are not data
+        # message log lines are skipped.
+        numbytes = mtrreader.MtrDataMessage.NUMBYTES
+        buffer = bytearray()
+        for (line_num, log_line) in enumerate(log_lines, 1):
+            offset = len(buffer)
+            buffer.extend(bytes(numbytes))
+            try:
+                self.parse_into(log_line, buffer, offset)
+            except ValueError as e:
+                logger.warning("Skipping log line %d: %s", line_num, e)
+                del buffer[offset:]
+        return buffer
+
+    def parse_into(self, log_line, buffer, offset):
+        # Writes the data message of the log line at offset in buffer
+        log_line = log_line.rstrip('\r\n')
+        package_num_offset = log_line.rfind(',') + 1
+        # Most splits are usually unused. They are found with a binary
+        # search and not parsed, as parsing the numbers takes most of the
+        # time.
+        (min_num_unused, max_num_unused) = (0, 50)
+        while min_num_unused < max_num_unused:
+            num_unused = (min_num_unused + max_num_unused + 1) // 2
+            if log_line.endswith(
+                    UNUSED_SPLITS_STRS[num_unused], 0, package_num_offset):
+                min_num_unused = num_unused
+            else:
+                max_num_unused = num_unused - 1
+        num_splits = 50 - min_num_unused
+        fields = log_line[
+                :package_num_offset - len(UNUSED_SPLITS_STRS[min_num_unused])
+                ].split(',')
+        if len(fields) != 10 + 2 * num_splits or fields[0] != '"M"':
+            raise ValueError("Not a data message log line: %r" % log_line)
+        # "dd.mm.yy HH:MM:SS.fff", sliced instead of strptime for speed
+        datetime_read_str = fields[5]
+        if len(datetime_read_str) != 23:
+            raise ValueError(
+                    "Unexpected card read time %s" % datetime_read_str)
+        try:
+            card_id = int(fields[6])
+            DATA_MESSAGE_STRUCTS[num_splits].pack_into(
+                    buffer, offset,
+                    mtrreader.PREAMBLE,
+                    mtrreader.MtrDataMessage.NUMBYTES - 4,
+                    ord('M'),
+                    int(fields[2][1:-1]),
+                    TWO_DIGIT_NUMBERS[datetime_read_str[7:9]],
+                    TWO_DIGIT_NUMBERS[datetime_read_str[4:6]],
+                    TWO_DIGIT_NUMBERS[datetime_read_str[1:3]],
+                    TWO_DIGIT_NUMBERS[datetime_read_str[10:12]],
+                    TWO_DIGIT_NUMBERS[datetime_read_str[13:15]],
+                    TWO_DIGIT_NUMBERS[datetime_read_str[16:18]],
+                    int(datetime_read_str[19:22]),
+                    int(log_line[package_num_offset:]),
+                    card_id & 0xFFFF,
+                    card_id >> 16,
+                    0, 0, 0,
+                    *map(int, fields[9:-1]),
+                    ASCII_STRING_FROM_HISTORY)
+        except (KeyError, ValueError, struct.error) as e:
+            raise ValueError("Invalid data message log line: %r" % e)
+        buffer[offset + 232] = mtrreader.checksum_of(
+                buffer[offset:offset + 232])
+        buffer[offset + 233] = 0
+
 
 class MtrLogFormatter:
 
     def format_all(self, data_messages, datetime_extracted):
-        log_lines = []
+        return list(self.iter_format(data_messages, datetime_extracted))
+
+    def iter_format(self, data_messages, datetime_extracted):
+        # the extraction timestamp is the same for all lines
+        datetime_extracted_str = datetime_extracted.strftime(
+                DATETIME_EXTRACTED_FORMAT)
+        is_logging_lines = logger.isEnabledFor(logging.INFO)
         for data_message in data_messages:
-            log_lines.append(self.format(data_message, datetime_extracted))
-        return log_lines
+            yield self.format_message(
+                    data_message, datetime_extracted_str, is_logging_lines)
 
     def format(self, msg, datetime_extracted):
-        log_line = []
-        log_line.append('"M"')
-        log_line.append('"0"')
-        log_line.append('"%d"' % msg.mtr_id())
-        log_line.append('"%06d"' % msg.card_id())
-        log_line.append(
-                '"%s"' % datetime_extracted.strftime('%d.%m.%y %H:%M:%S.000'))
-        log_line.append(
-                '"%02d.%02d.%02d %02d:%02d:%02d.%03d"' % (
-                    msg.timestamp_day(),
-                    msg.timestamp_month(),
-                    msg.timestamp_year(),
-                    msg.timestamp_hours(),
-                    msg.timestamp_minutes(),
-                    msg.timestamp_seconds(),
-                    msg.timestamp_milliseconds()))
-        log_line.append('%06d' % msg.card_id())
-        log_line.append('%04d' % 0)  # skipped product week
-        log_line.append('%04d' % 0)  # skipped product year
-        for (control_code, time_at_control) in msg.splits():
-            log_line.append('%03d' % control_code)
-            log_line.append('%05d' % time_at_control)
-        log_line.append('%07d' % msg.packet_num())
-
-        log_line_str = ",".join(log_line)
-        logger.info("Converted message to log line format: %s", log_line_str)
+        return self.format_message(
+                msg,
+                datetime_extracted.strftime(DATETIME_EXTRACTED_FORMAT),
+                logger.isEnabledFor(logging.INFO))
+
+    def format_message(self, msg, datetime_extracted_str, is_logging_lines):
+        return self.format_fields(
+                msg.mtr_id(),
+                msg.card_id(),
+                datetime_extracted_str,
+                (msg.timestamp_day(),
+                 msg.timestamp_month(),
+                 msg.timestamp_year(),
+                 msg.timestamp_hours(),
+                 msg.timestamp_minutes(),
+                 msg.timestamp_seconds(),
+                 msg.timestamp_milliseconds()),
+                msg.flat_splits(),
+                msg.num_splits(),
+                msg.packet_num(),
+                is_logging_lines)
+
+    def format_batch(self, batch, datetime_extracted):
+        # Columns are extracted from the batch as a whole (see mtrbatch)
+        datetime_extracted_str = datetime_extracted.strftime(
+                DATETIME_EXTRACTED_FORMAT)
+        is_logging_lines = logger.isEnabledFor(logging.INFO)
+        log_lines = []
+        timestamps = zip(
+                batch.timestamp_day().tolist(),
+                batch.timestamp_month().tolist(),
+                batch.timestamp_year().tolist(),
+                batch.timestamp_hours().tolist(),
+                batch.timestamp_minutes().tolist(),
+                batch.timestamp_seconds().tolist(),
+                batch.timestamp_milliseconds().tolist())
+        for (mtr_id, card_id, timestamp, flat_splits, num_splits,
+                packet_num) in zip(
+                    batch.mtr_id().tolist(),
+                    batch.card_id().tolist(),
+                    timestamps,
+                    batch.flat_splits().tolist(),
+                    batch.num_splits().tolist(),
+                    batch.packet_num().tolist()):
+            log_lines.append(self.format_fields(
+                mtr_id, card_id, datetime_extracted_str, timestamp,
+                tuple(flat_splits), num_splits, packet_num,
+                is_logging_lines))
+        return log_lines
+
+    def format_fields(
+            self, mtr_id, card_id, datetime_extracted_str, timestamp,
+            flat_splits, num_splits, packet_num, is_logging_lines):
+        # splits after the first num_splits splits must be unused (all zero)
+        log_line_str = LOG_LINE_TEMPLATES_BY_NUM_SPLITS[num_splits] % (
+                (mtr_id, card_id, datetime_extracted_str)
+                + timestamp
+                + (card_id,)
+                + flat_splits[:2 * num_splits]
+                + (packet_num,))
+        if is_logging_lines:
+            logger.info(
+                    "Converted message to log line format: %s", log_line_str)
         return log_line_str
@@ -64,23 +64,38 @@
 # Size                59
 
 import logging
+import struct
 
 logger = logging.getLogger()
 
-
-def extend_with(old_items, new_items):
-    old_items.extend(new_items)
-    return new_items
+PREAMBLE = b'\xFF\xFF\xFF\xFF'
+PACKAGE_SIZE_OFFSET = len(PREAMBLE)
+PACKAGE_TYPE_OFFSET = PACKAGE_SIZE_OFFSET + 1
+MIN_MESSAGE_NUMBYTES = PACKAGE_TYPE_OFFSET + 1
 
 
 def checksum_of(message_bytes):
     return sum(message_bytes) % 256
 
 
+def is_complete(
+        num_messages, new_messages, expected_num_messages, last_package_num):
+    if (expected_num_messages is not None
+            and num_messages >= expected_num_messages):
+        return True
+    if last_package_num is not None:
+        for msg in new_messages:
+            if (isinstance(msg, MtrDataMessage)
+                    and msg.packet_num() >= last_package_num):
+                return True
+    return False
+
+
 class MtrReader:
 
     def __init__(self, serial_port):
         self.serial_port = serial_port
+        self.decoder = MtrDecoder()
 
     def send_status_command(self):
         self.serial_port.write(b'/ST')
@@ -88,118 +103,221 @@ class MtrReader:
     def send_spool_all_command(self):
         self.serial_port.write(b'/SA')
 
-    def receive(self):
-        messages = []
-        timed_out = False
-        PREAMBLE = b'\xFF\xFF\xFF\xFF'
-        while not timed_out:
-            preamble_buffer = bytearray()
-            while preamble_buffer != PREAMBLE:
-                if len(preamble_buffer) == len(PREAMBLE):
-                    # make room for incoming byte
-                    preamble_buffer.pop(0)
-
-                bytes_read_waiting = self.serial_port.read()
-                timed_out = len(bytes_read_waiting) == 0
-                if timed_out:
-                    logger.debug(
-                            'Timed out, returning %d messages', len(messages))
-                    return messages
-
-                preamble_buffer.extend(bytes_read_waiting)
+    def send_spool_from_command(self, package_num):
+        self.serial_port.write(b'/SB' + package_num.to_bytes(4, 'little'))
+
+    def receive(self, expected_num_messages=None, last_package_num=None):
+        return list(self.iter_messages(
+            expected_num_messages, last_package_num))
+
+    def iter_messages(self, expected_num_messages=None, last_package_num=None):
+        # Yields messages as they are received. Stops when the serial port
+        # read times out, or as soon as expected_num_messages messages or the
+        # data message with package number last_package_num has been
+        # received (if given)
+        num_messages = 0
+        while True:
+            # Block for (at least) one byte, then take whatever else has
+            # arrived in the same read to avoid one read call per byte
+            num_bytes_to_read = max(1, self.serial_port.in_waiting)
+            bytes_read = self.serial_port.read(num_bytes_to_read)
+            if len(bytes_read) == 0:
+                if self.decoder.has_partial_message():
+                    logger.warning('Did not receive expected number of bytes')
+                    self.decoder.reset()
+                logger.debug(
+                        'Timed out after %d messages', num_messages)
+                return
+            new_messages = self.decoder.feed(bytes_read)
+            num_messages += len(new_messages)
+            yield from new_messages
+            if is_complete(
+                    num_messages, new_messages,
+                    expected_num_messages, last_package_num):
                 logger.debug(
-                        'Byte read waiting (hex): %s '
-                        '(current preamble buffer: %s)',
-                        bytes_read_waiting.hex(),
-                        preamble_buffer.hex())
-
-            logger.debug('Saw preable, start package parsing')
-            message_bytes = bytearray()
-            message_bytes.extend(preamble_buffer)
-
-            package_size_numbytes = 1
-            package_type_numbytes = 1
-            package_size = int.from_bytes(
-                    extend_with(
-                        message_bytes,
-                        self.serial_port.read(package_size_numbytes)),
-                    'little')
-            package_type = int.from_bytes(
-                    extend_with(
-                        message_bytes,
-                        self.serial_port.read(package_type_numbytes)),
-                    'little')
-
-            num_remaining_bytes_expected = (
-                    package_size
-                    - package_size_numbytes
-                    - package_type_numbytes)
-            remaining_bytes = self.serial_port.read(
-                    num_remaining_bytes_expected)
-            if len(remaining_bytes) < num_remaining_bytes_expected:
-                logger.warning('Did not receive expected number of bytes')
-                continue
-            message_bytes.extend(remaining_bytes)
-
-            msg = None
-            if (package_type == ord('M')):
-                msg = MtrDataMessage(message_bytes)
-            elif package_type == ord('S'):
-                msg = MtrStatusMessage(message_bytes)
-            else:
-                logger.warning('Got unsupported package type %d', package_type)
-                continue
-
-            logger.info(
-                    "Got message number %d (hex): %s",
-                    len(messages) + 1, message_bytes.hex())
-            if not msg.is_checksum_valid():
-                logger.warning("Message has incorrect checksum")
-                continue
-
-            messages.append(msg)
+                        'Received expected messages after %d messages',
+                        num_messages)
+                return
+
 
+# Splits a byte stream fed in chunks of any size into MTR messages. Messages
+# are located by searching the buffered bytes for the preamble. Bytes of an
+# incomplete message are kept until the next chunk is fed.
+class MtrDecoder:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.num_messages_received = 0
+
+    def reset(self):
+        self.buffer.clear()
+
+    def has_partial_message(self):
+        return self.buffer.startswith(PREAMBLE)
+
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+        messages = []
+        offset = 0
+        # Messages refer to their position in one immutable copy of the
+        # buffer, made when the first complete message is found
+        buffer_copy = None
+        while True:
+            preamble_offset = self.buffer.find(PREAMBLE, offset)
+            if preamble_offset < 0:
+                # keep a possible partial preamble at the end of the buffer
+                offset = max(offset, len(self.buffer) - len(PREAMBLE) + 1)
+                break
+            offset = preamble_offset
+            if len(self.buffer) - offset < MIN_MESSAGE_NUMBYTES:
+                break
+            package_size = self.buffer[offset + PACKAGE_SIZE_OFFSET]
+            message_numbytes = max(
+                    MIN_MESSAGE_NUMBYTES, len(PREAMBLE) + package_size)
+            if len(self.buffer) - offset < message_numbytes:
+                break
+            if buffer_copy is None:
+                buffer_copy = bytes(self.buffer)
+            msg = self.message_of(buffer_copy, offset)
+            offset += message_numbytes
+            if msg is not None:
+                messages.append(msg)
+        del self.buffer[:offset]
         return messages
 
+    def message_of(self, buffer, offset):
+        package_type = buffer[offset + PACKAGE_TYPE_OFFSET]
+        if package_type == ord('M'):
+            message_class = MtrDataMessage
+        elif package_type == ord('S'):
+            message_class = MtrStatusMessage
+        else:
+            logger.warning('Got unsupported package type %d', package_type)
+            return None
+        # A message is a view of NUMBYTES bytes, those of a shorter package
+        # would include bytes of the next one
+        package_size = buffer[offset + PACKAGE_SIZE_OFFSET]
+        if package_size != message_class.NUMBYTES - len(PREAMBLE):
+            logger.warning(
+                    "Got package of type %s with incorrect size %d",
+                    chr(package_type), package_size)
+            return None
+        msg = message_class(buffer, offset)
+
+        self.num_messages_received += 1
+        logger.info(
+                "Got message number %d (hex): %s",
+                self.num_messages_received, msg.message_bytes.hex())
+        if not msg.is_checksum_valid():
+            logger.warning("Message has incorrect checksum")
+            return None
+
+        return msg
+
 
 class MtrStatusMessage:
 
-    def __init__(self, message_bytes):
-        self.message_bytes = message_bytes
+    __slots__ = ('buffer', 'offset', '_fields')
+
+    NUMBYTES = 59
+
+    # size, type, MTR-id, timestamp (year, month, day, hours, minutes,
+    # seconds, milliseconds), battery status, recent and oldest package
+    # numbers, current session and 7 previous session start package numbers
+    FIELDS = struct.Struct('<4xBBH6BHB10I')
+
+    # The message is read from the given offset in buffer without copying
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        self._fields = None
+
+    @property
+    def message_bytes(self):
+        return memoryview(self.buffer)[
+                self.offset:self.offset + self.NUMBYTES]
+
+    def fields(self):
+        # decoded on first use only
+        if self._fields is None:
+            self._fields = self.FIELDS.unpack_from(self.buffer, self.offset)
+        return self._fields
 
     def mtr_id(self):
-        return int.from_bytes(self.message_bytes[6:8], 'little')
+        return self.fields()[2]
 
     def timestamp_year(self):
-        return int.from_bytes(self.message_bytes[8:9], 'little')
+        return self.fields()[3]
 
     def timestamp_month(self):
-        return int.from_bytes(self.message_bytes[9:10], 'little')
+        return self.fields()[4]
 
     def timestamp_day(self):
-        return int.from_bytes(self.message_bytes[10:11], 'little')
+        return self.fields()[5]
 
     def timestamp_hours(self):
-        return int.from_bytes(self.message_bytes[11:12], 'little')
+        return self.fields()[6]
 
     def timestamp_minutes(self):
-        return int.from_bytes(self.message_bytes[12:13], 'little')
+        return self.fields()[7]
 
     def timestamp_seconds(self):
-        return int.from_bytes(self.message_bytes[13:14], 'little')
+        return self.fields()[8]
 
     def timestamp_milliseconds(self):
-        return int.from_bytes(self.message_bytes[14:16], 'little')
+        return self.fields()[9]
 
     def battery_status(self):
-        return int.from_bytes(self.message_bytes[16:17], 'little')
-
-    # package number fields not supported (yet)
+        return self.fields()[10]
+
+    def recent_package_num(self):
+        return self.fields()[11]
+
+    def oldest_package_num(self):
+        return self.fields()[12]
+
+    def current_session_start_package_num(self):
+        return self.fields()[13]
+
+    def previous_session_start_package_num(self, sessions_back):
+        # sessions_back is 1 for the previous session, up to 7
+        if not 1 <= sessions_back <= 7:
+            raise ValueError(
+                    "Sessions back must be 1-7, was %d" % sessions_back)
+        return self.fields()[13 + sessions_back]
+
+    def num_packages(self):
+        recent_package_num = self.recent_package_num()
+        if recent_package_num == 0:
+            return 0
+        return recent_package_num - self.oldest_package_num() + 1
+
+    def sessions(self):
+        # Package number ranges of the current and up to 7 previous sessions
+        # (most recent first), limited to packages still in the MTR's memory
+        recent_package_num = self.recent_package_num()
+        if recent_package_num == 0:
+            return []
+        oldest_package_num = self.oldest_package_num()
+        start_package_nums = self.fields()[13:21]
+        sessions = []
+        end_package_num = recent_package_num
+        for start_package_num in start_package_nums:
+            if start_package_num == 0 or end_package_num < oldest_package_num:
+                break
+            sessions.append(range(
+                max(start_package_num, oldest_package_num),
+                end_package_num + 1))
+            end_package_num = start_package_num - 1
+        return sessions
 
     def is_checksum_valid(self):
-        checksum = int.from_bytes(self.message_bytes[57:58], 'little')
+        message_bytes = self.message_bytes
+        if len(message_bytes) < 58:
+            return False
+        checksum = message_bytes[57]
         # calculate checksum for message bytes up until checksum
-        calculated_checksum = checksum_of(self.message_bytes[:57])
+        calculated_checksum = checksum_of(message_bytes[:57])
         logger.debug(
                 "Calculated checksum %d, read %d",
                 calculated_checksum, checksum)
@@ -208,68 +326,92 @@ class MtrStatusMessage:
 
 class MtrDataMessage:
 
-    def __init__(self, message_bytes):
-        self.message_bytes = message_bytes
+    __slots__ = ('buffer', 'offset', '_fields')
+
+    NUMBYTES = 234
+
+    # size, type, MTR-id, timestamp (year, month, day, hours, minutes,
+    # seconds, milliseconds), package number, card-id (2 least significant
+    # bytes, most significant byte), product week, product year, ecard head
+    # checksum
+    FIELDS = struct.Struct('<4xBBH6BHIHBBBB')
+    # control code and time of 50 splits, following the fields above
+    SPLITS = struct.Struct('<' + 50 * 'BH')
+
+    # The message is read from the given offset in buffer without copying
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        self._fields = None
+
+    @property
+    def message_bytes(self):
+        return memoryview(self.buffer)[
+                self.offset:self.offset + self.NUMBYTES]
+
+    def fields(self):
+        # decoded on first use only
+        if self._fields is None:
+            self._fields = self.FIELDS.unpack_from(self.buffer, self.offset)
+        return self._fields
 
     def mtr_id(self):
-        return int.from_bytes(self.message_bytes[6:8], 'little')
+        return self.fields()[2]
 
     def timestamp_year(self):
-        return int.from_bytes(self.message_bytes[8:9], 'little')
+        return self.fields()[3]
 
     def timestamp_month(self):
-        return int.from_bytes(self.message_bytes[9:10], 'little')
+        return self.fields()[4]
 
     def timestamp_day(self):
-        return int.from_bytes(self.message_bytes[10:11], 'little')
+        return self.fields()[5]
 
     def timestamp_hours(self):
-        return int.from_bytes(self.message_bytes[11:12], 'little')
+        return self.fields()[6]
 
     def timestamp_minutes(self):
-        return int.from_bytes(self.message_bytes[12:13], 'little')
+        return self.fields()[7]
 
     def timestamp_seconds(self):
-        return int.from_bytes(self.message_bytes[13:14], 'little')
+        return self.fields()[8]
 
     def timestamp_milliseconds(self):
-        return int.from_bytes(self.message_bytes[14:16], 'little')
+        return self.fields()[9]
 
     def packet_num(self):
-        return int.from_bytes(self.message_bytes[16:20], 'little')
+        return self.fields()[10]
 
     def card_id(self):
-        return int.from_bytes(self.message_bytes[20:23], 'little')
+        fields = self.fields()
+        return fields[11] | fields[12] << 16
+
+    def flat_splits(self):
+        # control code and time of each split after one another
+        return self.SPLITS.unpack_from(
+                self.buffer, self.offset + self.FIELDS.size)
 
-    # product week (1 byte)
-    # product year (1 byte)
-    # ecard head checksum (1 byte)
+    def num_splits(self):
+        # number of splits up to and including the last one not all zero
+        splits_offset = self.offset + self.FIELDS.size
+        splits_bytes = bytes(
+                self.buffer[splits_offset:splits_offset + self.SPLITS.size])
+        return (len(splits_bytes.rstrip(b'\x00')) + 2) // 3
 
     def splits(self):
-        splits = []
-        splits_offset = 26
-        code_numbytes = 1
-        time_numbytes = 2
-        split_numbytes = code_numbytes + time_numbytes
-        for split_index in range(50):
-            code_offset = splits_offset + split_index * split_numbytes
-            time_offset = code_offset + code_numbytes
-            code = int.from_bytes(
-                    self.message_bytes[code_offset:code_offset+code_numbytes],
-                    'little')
-            time = int.from_bytes(
-                    self.message_bytes[time_offset:time_offset+time_numbytes],
-                    'little')
-            splits.append((code, time))
-        return splits
+        flat_splits = self.flat_splits()
+        return list(zip(flat_splits[0::2], flat_splits[1::2]))
 
     def ascii_string(self):
-        return self.message_bytes[176:232].decode('ascii')
+        return str(self.message_bytes[176:232], 'ascii')
 
     def is_checksum_valid(self):
-        checksum = int.from_bytes(self.message_bytes[232:233], 'little')
+        message_bytes = self.message_bytes
+        if len(message_bytes) < 233:
+            return False
+        checksum = message_bytes[232]
         # calculate checksum for message bytes up until checksum
-        calculated_checksum = checksum_of(self.message_bytes[:232])
+        calculated_checksum = checksum_of(message_bytes[:232])
         logger.debug(
                 "Calculated checksum %d, read %d",
                 calculated_checksum, checksum)
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+
+
+class PackageNumberStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        # MTRs can be extracted at the same time
+        self.lock = threading.Lock()
+        self.last_package_nums = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            logger.info(
+                    "No package number state file %s, starting from scratch",
+                    self.filename)
+            return {}
+        except (OSError, ValueError):
+            logger.exception(
+                    "Could not read package number state file %s, ignoring it",
+                    self.filename)
+            return {}
+        return {
+                int(mtr_id): package_num
+                for (mtr_id, package_num) in state.items()}
+
+    def save(self):
+        # write to a temporary file first so that an interrupted write never
+        # leaves a truncated state file behind
+        with self.lock:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as state_file:
+                json.dump(
+                        {str(mtr_id): package_num
+                         for (mtr_id, package_num)
+                         in self.last_package_nums.items()},
+                        state_file)
+            os.replace(temp_filename, self.filename)
+        logger.info("Wrote package number state file %s", self.filename)
+
+    def last_package_num(self, mtr_id):
+        with self.lock:
+            return self.last_package_nums.get(mtr_id)
+
+    def record(self, data_messages):
+        with self.lock:
+            for data_message in data_messages:
+                mtr_id = data_message.mtr_id()
+                package_num = data_message.packet_num()
+                if package_num > self.last_package_nums.get(mtr_id, 0):
+                    self.last_package_nums[mtr_id] = package_num
+
+    def track(self, data_messages):
+        # Records data messages as they pass through. A message is recorded
+        # when the next one is requested, i.e. when it has been handled.
+        for data_message in data_messages:
+            yield data_message
+            self.record([data_message])
+
+    def spool_start_package_num(self, status_message):
+        # Returns the package number to spool from, or None if all packages
+        # must be spooled. The returned package number is one greater than
+        # the most recent package number if there is nothing new to spool.
+        last_package_num = self.last_package_num(status_message.mtr_id())
+        recent_package_num = status_message.recent_package_num()
+        oldest_package_num = status_message.oldest_package_num()
+        if last_package_num is None or recent_package_num == 0:
+            return None
+        start_package_num = last_package_num + 1
+        if not (oldest_package_num
+                <= start_package_num
+                <= recent_package_num + 1):
+            logger.info(
+                    "Last extracted package number %d is not in range of "
+                    "MTR %d (%d-%d)",
+                    last_package_num, status_message.mtr_id(),
+                    oldest_package_num, recent_package_num)
+            return None
+        return start_package_num
+
+
+# Packages acknowledged (uploaded successfully) per destination, used to only
+# upload packages a destination has not received yet. Package numbers are
+# kept as ranges in the file to keep it small.
+class AcknowledgedPackageStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # destination key -> MTR-id -> set of package numbers
+        self.package_nums = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            logger.info(
+                    "No acknowledged package file %s, starting from scratch",
+                    self.filename)
+            return {}
+        except (OSError, ValueError):
+            logger.exception(
+                    "Could not read acknowledged package file %s, ignoring it",
+                    self.filename)
+            return {}
+        return {
+                destination_key: {
+                    int(mtr_id): {
+                        package_num
+                        for (first, last) in package_num_ranges
+                        for package_num in range(first, last + 1)}
+                    for (mtr_id, package_num_ranges) in mtrs.items()}
+                for (destination_key, mtrs) in state.items()}
+
+    def save(self):
+        # uploads finishing at the same time must not share the temporary
+        # file
+        with self.lock:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as state_file:
+                json.dump(
+                        {destination_key: {
+                            str(mtr_id): ranges_of(package_nums)
+                            for (mtr_id, package_nums) in mtrs.items()}
+                         for (destination_key, mtrs)
+                         in self.package_nums.items()},
+                        state_file)
+            os.replace(temp_filename, self.filename)
+
+    def is_acknowledged(self, destination_args, mtr_id, package_num):
+        with self.lock:
+            mtrs = self.package_nums.get(destination_key_of(destination_args))
+            return (mtrs is not None
+                    and package_num in mtrs.get(mtr_id, ()))
+
+    def acknowledge(self, destination_args, mtr_id_and_package_nums):
+        with self.lock:
+            mtrs = self.package_nums.setdefault(
+                    destination_key_of(destination_args), {})
+            for (mtr_id, package_num) in mtr_id_and_package_nums:
+                mtrs.setdefault(mtr_id, set()).add(package_num)
+
+
+def destination_key_of(destination_args):
+    return ' '.join(destination_args)
+
+
+def ranges_of(package_nums):
+    # sorted [first, last] ranges of consecutive package numbers
+    ranges = []
+    for package_num in sorted(package_nums):
+        if ranges and ranges[-1][1] == package_num - 1:
+            ranges[-1][1] = package_num
+        else:
+            ranges.append([package_num, package_num])
+    return ranges
@@ -0,0 +1,805 @@
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import mtrlog
+
+logger = logging.getLogger()
+
+WARM_UP_TIMEOUT_SECS = 30
+# Network timeout of destinations without a 'timeout=SECS' argument
+DEFAULT_TIMEOUT_SECS = 120
+# Size of chunks of Dropbox upload sessions without a 'chunk_size=BYTES'
+# argument. Smaller files are uploaded with a single request.
+DEFAULT_DROPBOX_CHUNK_SIZE = 1024 * 1024
+# Size of chunks of resumable HTTP uploads without a 'chunk_size=BYTES'
+# argument
+DEFAULT_HTTP_CHUNK_SIZE = 256 * 1024
+# Block size of the Dropbox content hash, see
+# https://www.dropbox.com/developers/reference/content-hash
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# File name extension of compressed uploads by compression
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# HTTP statuses of failed uploads that will fail the same way when retried,
+# like a refused or unknown URL. 400 is not one of them, it is also the
+# response to a truncated upload.
+PERMANENT_HTTP_STATUSES = {401, 403, 404, 405, 410, 413, 415}
+
+
+# Raised by destinations when retrying an upload will not help, e.g. when the
+# destination refuses the credentials
+class PermanentUploadError(Exception):
+    pass
+
+
+def read_dropbox_token(token_file_name):
+    with open(token_file_name, 'r') as token_file:
+        return token_file.read().strip()
+
+
+def dropbox_upload_dir(destination_args):
+    upload_dir = ""
+    if len(destination_args) >= 3:
+        upload_dir = destination_args[2]
+        if not upload_dir.startswith("/"):
+            upload_dir = "/" + upload_dir
+    return upload_dir
+
+
+def split_option(destination_args, name, value_type):
+    # Returns destination_args without a 'NAME=VALUE' argument and the value,
+    # None if not given
+    value = None
+    other_args = []
+    for destination_arg in destination_args:
+        if destination_arg.startswith(name + '='):
+            value = value_type(destination_arg[len(name) + 1:])
+        else:
+            other_args.append(destination_arg)
+    return (other_args, value)
+
+
+def split_timeout(destination_args):
+    return split_option(destination_args, 'timeout', float)
+
+
+def destination_key_of(destination_args):
+    # Uploads with the same key go to the same destination. Changing the
+    # timeout of a destination keeps its key.
+    return tuple(split_timeout(destination_args)[0])
+
+
+def destination_name_of(destination_args):
+    return ' '.join(split_timeout(destination_args)[0])
+
+
+def is_compression_available(compression):
+    # zstandard is optional, only needed (and imported) for zstd compressed
+    # uploads
+    return (compression != 'zstd'
+            or importlib.util.find_spec('zstandard') is not None)
+
+
+def compress(data, compression):
+    if compression == 'gzip':
+        # no timestamp, the same log gives the same upload
+        return gzip.compress(data, mtime=0)
+    if compression == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError("Unknown compression %r" % compression)
+
+
+def sha256_of(f):
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: f.read(DEFAULT_HTTP_CHUNK_SIZE), b''):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+def dropbox_content_hash(f):
+    # hex digest of the SHA-256 of the SHA-256 of each block of the file
+    block_hashes = hashlib.sha256()
+    for block in iter(lambda: f.read(DROPBOX_HASH_BLOCK_SIZE), b''):
+        block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+
+def upload_mtr_log_file(
+        log_file_name, destination_args, compression=None,
+        resume_state=None):
+    # destination_args as given to the -d/--destination argument,
+    # compression is None or one of COMPRESSION_EXTENSIONS
+    destination_for(destination_args).upload(
+            log_file_name, compression, resume_state)
+
+
+# Destination specific state of an upload, kept in its outbox entry so that
+# a later attempt can resume an interrupted upload. save() writes the
+# values to the outbox entry.
+class ResumeState:
+
+    def __init__(self, values, save=lambda: None):
+        self.values = values
+        self.save = save
+
+
+def warm_up(destination_args):
+    # Prepares the destination's connection so that a following upload does
+    # not have to wait for DNS lookup and TCP/TLS handshakes
+    try:
+        destination_for(destination_args).warm_up()
+        logger.info("Warmed up connection to %s", destination_args)
+    except Exception:
+        # not fatal, the upload will connect by itself
+        logger.exception(
+                "Could not warm up connection to %s", destination_args)
+
+
+def start_warm_up(destination_args):
+    warm_up_thread = threading.Thread(
+            target=warm_up,
+            args=(destination_args,),
+            name='warm-up',
+            daemon=True)
+    warm_up_thread.start()
+    return warm_up_thread
+
+
+# Destinations by destination arguments, kept to reuse their connections
+destinations = {}
+destinations_lock = threading.Lock()
+
+
+def destination_for(destination_args):
+    with destinations_lock:
+        key = tuple(destination_args)
+        if key not in destinations:
+            destinations[key] = create_destination(destination_args)
+        return destinations[key]
+
+
+def create_destination(destination_args):
+    (destination_args, timeout_secs) = split_timeout(destination_args)
+    if timeout_secs is None:
+        timeout_secs = DEFAULT_TIMEOUT_SECS
+    # destination arguments not starting with a registered destination type
+    # are HTTP URLs
+    destination_class = destination_classes.get(
+            destination_args[0], HttpDestination)
+    return destination_class.from_args(destination_args, timeout_secs)
+
+
+# A destination class has a from_args(destination_args, timeout_secs) class
+# method and warm_up() and upload(log_file_name, compression, resume_state)
+# methods. Uploads to each destination are made one at a time, uploads to
+# different destinations are made concurrently. The client libraries
+# (dropbox, requests) take long to import, they are only imported by the
+# destinations using them.
+class DropboxDestination:
+
+    def __init__(
+            self, token, upload_dir, timeout_secs=DEFAULT_TIMEOUT_SECS,
+            chunk_size=DEFAULT_DROPBOX_CHUNK_SIZE):
+        import dropbox
+
+        self.upload_dir = upload_dir
+        self.chunk_size = chunk_size
+        self.session = dropbox.create_session()
+        self.dbx = dropbox.Dropbox(
+                token, session=self.session, timeout=timeout_secs)
+
+    @classmethod
+    def from_args(cls, destination_args, timeout_secs):
+        # dropbox TOKEN_FILE [UPLOAD_DIR] [chunk_size=BYTES]
+        (destination_args, chunk_size) = split_option(
+                destination_args, 'chunk_size', int)
+        return cls(
+                read_dropbox_token(destination_args[1]),
+                dropbox_upload_dir(destination_args),
+                timeout_secs,
+                chunk_size or DEFAULT_DROPBOX_CHUNK_SIZE)
+
+    def warm_up(self):
+        # Checking the token connects to the API host, uploads are sent to
+        # the content host
+        import dropbox
+
+        self.dbx.check_user()
+        self.session.head(
+                'https://' + dropbox.session.API_CONTENT_HOST,
+                timeout=WARM_UP_TIMEOUT_SECS)
+
+    def upload(self, log_file_name, compression=None, resume_state=None):
+        import dropbox
+
+        try:
+            self.upload_file(log_file_name, compression, resume_state)
+        except (
+                dropbox.exceptions.AuthError,
+                dropbox.exceptions.BadInputError) as e:
+            raise PermanentUploadError(
+                    "Dropbox refused upload: %s" % e) from e
+
+    def upload_file(self, log_file_name, compression, resume_state):
+        upload_filename = os.path.basename(log_file_name)
+        if compression is None:
+            f = open(log_file_name, 'rb')
+        else:
+            with open(log_file_name, 'rb') as log_file:
+                f = io.BytesIO(compress(log_file.read(), compression))
+            upload_filename += COMPRESSION_EXTENSIONS[compression]
+        path = self.upload_dir + "/" + upload_filename
+        with f:
+            content_hash = dropbox_content_hash(f)
+            if self.remote_content_hash(path) == content_hash:
+                logger.info(
+                        "Identical file %s already in Dropbox, skipping "
+                        "upload", path)
+                return
+            size = f.seek(0, io.SEEK_END)
+            f.seek(0)
+            if size <= self.chunk_size:
+                self.dbx.files_upload(f.read(), path)
+            else:
+                self.upload_session(f, size, path, content_hash, resume_state)
+
+    def remote_content_hash(self, path):
+        import dropbox
+
+        try:
+            metadata = self.dbx.files_get_metadata(path)
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return None
+            raise
+        return getattr(metadata, 'content_hash', None)
+
+    def upload_session(self, f, size, path, content_hash, resume_state):
+        # Uploads in chunks. The session and the offset uploaded so far are
+        # kept in the resume state after each chunk, a later attempt with
+        # the same content continues from there.
+        import dropbox
+
+        if resume_state is None:
+            resume_state = ResumeState({})
+        state = resume_state.values
+        if (state.get('path') != path
+                or state.get('content_hash') != content_hash):
+            state.clear()
+        if 'session_id' in state:
+            cursor = dropbox.files.UploadSessionCursor(
+                    state['session_id'], state['offset'])
+            logger.info(
+                    "Resuming Dropbox upload session of %s at offset %d",
+                    path, cursor.offset)
+        else:
+            result = self.dbx.files_upload_session_start(
+                    f.read(self.chunk_size))
+            cursor = dropbox.files.UploadSessionCursor(
+                    result.session_id, f.tell())
+            self.save_resume_state(resume_state, path, content_hash, cursor)
+        while size - cursor.offset > self.chunk_size:
+            f.seek(cursor.offset)
+            try:
+                self.dbx.files_upload_session_append_v2(
+                        f.read(self.chunk_size), cursor)
+            except dropbox.exceptions.ApiError as e:
+                self.handle_session_error(e.error, resume_state)
+                raise
+            cursor.offset = f.tell()
+            self.save_resume_state(resume_state, path, content_hash, cursor)
+        f.seek(cursor.offset)
+        try:
+            self.dbx.files_upload_session_finish(
+                    f.read(), cursor, dropbox.files.CommitInfo(path=path))
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_lookup_failed():
+                self.handle_session_error(
+                        e.error.get_lookup_failed(), resume_state)
+            raise
+
+    def handle_session_error(self, error, resume_state):
+        # The next attempt continues at the offset Dropbox has, or starts a
+        # new session if this one is gone
+        if error.is_incorrect_offset():
+            resume_state.values['offset'] = (
+                    error.get_incorrect_offset().correct_offset)
+        else:
+            resume_state.values.clear()
+        resume_state.save()
+
+    def save_resume_state(self, resume_state, path, content_hash, cursor):
+        resume_state.values.update({
+            'path': path,
+            'content_hash': content_hash,
+            'session_id': cursor.session_id,
+            'offset': cursor.offset})
+        resume_state.save()
+
+
+# Uploads with multipart form POST requests, or in resumable mode with
+# chunked PUT requests to URL/FILENAME as implemented by
+# devutil-httpuploadserver.py
+class HttpDestination:
+
+    def __init__(
+            self, url, timeout_secs=DEFAULT_TIMEOUT_SECS, is_resumable=False,
+            chunk_size=DEFAULT_HTTP_CHUNK_SIZE):
+        import requests
+
+        self.url = url
+        self.timeout_secs = timeout_secs
+        self.is_resumable = is_resumable
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+
+    @classmethod
+    def from_args(cls, destination_args, timeout_secs):
+        # URL [resumable] [chunk_size=BYTES]
+        (destination_args, chunk_size) = split_option(
+                destination_args, 'chunk_size', int)
+        return cls(
+                destination_args[0],
+                timeout_secs,
+                'resumable' in destination_args[1:],
+                chunk_size or DEFAULT_HTTP_CHUNK_SIZE)
+
+    def warm_up(self):
+        # any response will do, the connection is kept in the session's pool
+        self.session.head(self.url, timeout=WARM_UP_TIMEOUT_SECS)
+
+    def upload(self, log_file_name, compression=None, resume_state=None):
+        import requests
+
+        # empty files have no chunks
+        if self.is_resumable and os.path.getsize(log_file_name) > 0:
+            self.upload_resumable(log_file_name, compression)
+            return
+        with open(log_file_name, 'rb') as f:
+            request = self.session.prepare_request(requests.Request(
+                    'POST', self.url, files={'file': f}))
+        if compression is not None:
+            # the whole multipart body is compressed, the server sees the
+            # original file after decoding the body
+            request.body = compress(request.body, compression)
+            request.headers['Content-Encoding'] = compression
+            request.prepare_content_length(request.body)
+        settings = self.session.merge_environment_settings(
+                request.url, {}, None, None, None)
+        response = self.session.send(
+                request, timeout=self.timeout_secs, **settings)
+        raise_for_status(response)
+
+    def upload_resumable(self, log_file_name, compression):
+        # The server tells how much of the file it has, so an upload
+        # interrupted in an earlier attempt continues from there
+        upload_filename = os.path.basename(log_file_name)
+        if compression is None:
+            f = open(log_file_name, 'rb')
+        else:
+            with open(log_file_name, 'rb') as log_file:
+                f = io.BytesIO(compress(log_file.read(), compression))
+            upload_filename += COMPRESSION_EXTENSIONS[compression]
+        url = self.url.rstrip('/') + '/' + urllib.parse.quote(upload_filename)
+        with f:
+            headers = {'Upload-Sha256': sha256_of(f)}
+            size = f.seek(0, io.SEEK_END)
+            response = self.session.head(
+                    url, headers=headers, timeout=self.timeout_secs)
+            raise_for_status(response)
+            offset = int(response.headers.get('Upload-Offset', 0))
+            if offset > 0:
+                logger.info(
+                        "Resuming upload of %s at offset %d", url, offset)
+            while offset < size:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                        offset, offset + len(chunk) - 1, size)
+                response = self.session.put(
+                        url, data=chunk, headers=headers,
+                        timeout=self.timeout_secs)
+                # 409 Conflict: the server has a different offset
+                if response.status_code != 409:
+                    raise_for_status(response)
+                offset = int(response.headers['Upload-Offset'])
+
+
+def raise_for_status(response):
+    if response.status_code in PERMANENT_HTTP_STATUSES:
+        raise PermanentUploadError("Upload to %s refused with status %d %s" % (
+            response.url, response.status_code, response.reason))
+    response.raise_for_status()
+
+
+class LocalDestination:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def from_args(cls, destination_args, timeout_secs):
+        # local DIR, e.g. a mounted USB stick
+        return cls(destination_args[1])
+
+    def warm_up(self):
+        if not os.path.isdir(self.directory):
+            raise FileNotFoundError(
+                    "Local destination directory %s does not exist"
+                    % self.directory)
+
+    def upload(self, log_file_name, compression=None, resume_state=None):
+        with open(log_file_name, 'rb') as f:
+            data = f.read()
+        upload_filename = os.path.basename(log_file_name)
+        if compression is not None:
+            data = compress(data, compression)
+            upload_filename += COMPRESSION_EXTENSIONS[compression]
+        upload_path = os.path.join(self.directory, upload_filename)
+        # the file is complete on the device once it has its name, even if
+        # the device is removed right after
+        with open(upload_path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(upload_path + '.tmp', upload_path)
+
+
+# Destination classes by first destination argument, see create_destination
+destination_classes = {
+        'dropbox': DropboxDestination,
+        'local': LocalDestination,
+}
+
+
+def delta_file_name_of(log_file_name):
+    (root, ext) = os.path.splitext(os.path.basename(log_file_name))
+    return root + '-delta' + ext
+
+
+# Uploads pending in an outbox directory, one JSON file per upload. Each
+# destination has a background worker thread making one upload at a time, so
+# an unreachable destination does not hold up uploads to the others. Failed
+# uploads are retried with exponential backoff (with jitter), the time of the
+# next attempt is kept in the upload's file. Uploads left in the outbox by an
+# earlier run are retried when the outbox is started, after the uploads of
+# this run to the same destination. Uploads failing with a
+# PermanentUploadError are not retried until the next start.
+#
+# With an ack_store (see mtrstate.AcknowledgedPackageStore) the packages of
+# successful uploads are recorded per destination, and uploads in 'delta'
+# mode only send the log lines of packages the destination has not
+# acknowledged yet. Uploads in 'full' mode always send the whole log file.
+class UploadOutbox:
+
+    def __init__(
+            self,
+            directory,
+            upload=upload_mtr_log_file,
+            initial_retry_delay_secs=5,
+            max_retry_delay_secs=600,
+            ack_store=None):
+        self.directory = directory
+        self.upload = upload
+        self.ack_store = ack_store
+        self.initial_retry_delay_secs = initial_retry_delay_secs
+        self.max_retry_delay_secs = max_retry_delay_secs
+        self.condition = threading.Condition()
+        # entry file name -> time.monotonic() of next attempt
+        self.pending = {}
+        # entry file name -> destination key, see destination_key_of()
+        self.entry_destinations = {}
+        # entries found when started, uploaded after the entries added since
+        self.backlog = set()
+        self.in_progress = set()
+        # entries that failed permanently, kept for the next start
+        self.failed = set()
+        # destination key -> worker thread
+        self.workers = {}
+        self.is_started = False
+        self.is_stopping = False
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        with self.condition:
+            for entry_file_name in sorted(os.listdir(self.directory)):
+                if (not entry_file_name.endswith('.json')
+                        or entry_file_name in self.pending):
+                    continue
+                try:
+                    entry = self.read_entry(entry_file_name)
+                    destination_key = destination_key_of(
+                            entry['destination'])
+                except (OSError, ValueError, KeyError, TypeError):
+                    logger.exception(
+                            "Could not read upload outbox entry %s, dropping "
+                            "it", entry_file_name)
+                    self.remove_entry(entry_file_name)
+                    continue
+                self.backlog.add(entry_file_name)
+                self.add_pending(entry_file_name, destination_key, entry)
+            if self.pending:
+                logger.info(
+                        "Found %d pending uploads in outbox %s",
+                        len(self.pending), self.directory)
+            self.is_started = True
+            for destination_key in set(self.entry_destinations.values()):
+                self.start_worker(destination_key)
+
+    def stop(self):
+        with self.condition:
+            self.is_stopping = True
+            self.condition.notify_all()
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.join()
+        self.workers = {}
+
+    def add(
+            self, log_file_name, destination_args, compression=None,
+            mode='full'):
+        # file names sort in the order the uploads were added
+        now = time.time()
+        entry_file_name = '%s.%06d-%s.json' % (
+                time.strftime('%Y%m%dT%H%M%S', time.localtime(now)),
+                now % 1 * 1e6, uuid.uuid4().hex[:8])
+        entry = {
+            'log_file_name': os.path.abspath(log_file_name),
+            'destination': destination_args,
+            'compression': compression,
+            'mode': mode,
+            'attempts': 0}
+        self.write_entry(entry_file_name, entry)
+        with self.condition:
+            self.add_pending(
+                    entry_file_name, destination_key_of(destination_args),
+                    entry)
+        logger.info(
+                "Added %s to upload outbox as %s",
+                log_file_name, entry_file_name)
+        return entry_file_name
+
+    def add_pending(self, entry_file_name, destination_key, entry):
+        # called with self.condition held
+        self.entry_destinations[entry_file_name] = destination_key
+        self.pending[entry_file_name] = (
+                time.monotonic() + self.secs_until_attempt(entry))
+        if self.is_started and destination_key not in self.workers:
+            self.start_worker(destination_key)
+        self.condition.notify_all()
+
+    def secs_until_attempt(self, entry):
+        # The next attempt is kept as wall clock time to be kept over
+        # restarts. A clock set back (like on a Raspberry Pi without a real
+        # time clock before it is synchronized) delays it by at most
+        # max_retry_delay_secs.
+        next_attempt = entry.get('next_attempt')
+        if next_attempt is None:
+            return 0
+        return min(
+                max(0, next_attempt - time.time()),
+                self.max_retry_delay_secs)
+
+    def start_worker(self, destination_key):
+        # called with self.condition held
+        worker = threading.Thread(
+                target=self.work,
+                args=(destination_key,),
+                name='upload-worker-%d' % len(self.workers),
+                daemon=True)
+        worker.start()
+        self.workers[destination_key] = worker
+
+    def num_pending(self):
+        with self.condition:
+            return len(self.pending) + len(self.in_progress)
+
+    def has_failed(self, entry_file_name):
+        # True if the upload failed permanently
+        with self.condition:
+            return entry_file_name in self.failed
+
+    def wait_until_empty(self, timeout_secs=None):
+        # Returns True if all uploads are done, False on timeout
+        with self.condition:
+            return self.condition.wait_for(
+                    lambda: not self.pending and not self.in_progress,
+                    timeout_secs)
+
+    def wait_until_any_done(self, entry_file_names, timeout_secs=None):
+        # Waits until at least one of the entries is done (uploaded, dropped
+        # or failed permanently) and returns the entries that are done, an
+        # empty set on timeout
+        def done_entries():
+            return {
+                    entry_file_name
+                    for entry_file_name in entry_file_names
+                    if entry_file_name not in self.pending
+                    and entry_file_name not in self.in_progress}
+
+        with self.condition:
+            self.condition.wait_for(done_entries, timeout_secs)
+            return done_entries()
+
+    def retry_delay_secs(self, attempts):
+        delay_secs = min(
+                self.max_retry_delay_secs,
+                self.initial_retry_delay_secs * 2 ** (attempts - 1))
+        # jitter avoids retrying in lockstep with other uploads
+        return random.uniform(delay_secs / 2, delay_secs)
+
+    def work(self, destination_key):
+        while True:
+            with self.condition:
+                entry_file_name = self.next_due_entry(destination_key)
+                while entry_file_name is None:
+                    if self.is_stopping:
+                        return
+                    self.condition.wait(
+                            self.secs_until_next_due(destination_key))
+                    entry_file_name = self.next_due_entry(destination_key)
+                del self.pending[entry_file_name]
+                self.in_progress.add(entry_file_name)
+            try:
+                self.attempt(entry_file_name)
+            finally:
+                with self.condition:
+                    self.in_progress.discard(entry_file_name)
+                    self.condition.notify_all()
+
+    def destination_entries(self, destination_key):
+        return [
+                entry_file_name for entry_file_name in self.pending
+                if self.entry_destinations[entry_file_name]
+                == destination_key]
+
+    def next_due_entry(self, destination_key):
+        now = time.monotonic()
+        due_entries = [
+                entry_file_name
+                for entry_file_name in self.destination_entries(
+                    destination_key)
+                if self.pending[entry_file_name] <= now]
+        if not due_entries:
+            return None
+        # the entries of this run first, each in the order they were added
+        return min(
+                due_entries,
+                key=lambda entry_file_name: (
+                    entry_file_name in self.backlog, entry_file_name))
+
+    def secs_until_next_due(self, destination_key):
+        entry_file_names = self.destination_entries(destination_key)
+        if not entry_file_names:
+            return None
+        return max(0, min(
+                self.pending[entry_file_name]
+                for entry_file_name in entry_file_names) - time.monotonic())
+
+    def attempt(self, entry_file_name):
+        try:
+            entry = self.read_entry(entry_file_name)
+        except (OSError, ValueError):
+            logger.exception(
+                    "Could not read upload outbox entry %s, dropping it",
+                    entry_file_name)
+            self.remove_entry(entry_file_name)
+            return
+        log_file_name = entry['log_file_name']
+        if not os.path.exists(log_file_name):
+            logger.error(
+                    "MTR log file %s to upload no longer exists, dropping "
+                    "outbox entry %s", log_file_name, entry_file_name)
+            self.remove_entry(entry_file_name)
+            return
+        entry['attempts'] += 1
+        entry.pop('next_attempt', None)
+        try:
+            self.upload_entry(entry_file_name, entry)
+        except PermanentUploadError:
+            logger.exception(
+                    "Upload attempt %d of MTR log file %s to %s failed, not "
+                    "retrying it until the next start",
+                    entry['attempts'], log_file_name, entry['destination'])
+            self.write_entry(entry_file_name, entry)
+            with self.condition:
+                self.failed.add(entry_file_name)
+            return
+        except Exception:
+            retry_delay_secs = self.retry_delay_secs(entry['attempts'])
+            logger.exception(
+                    "Upload attempt %d of MTR log file %s to %s failed, "
+                    "retrying in %.1f seconds",
+                    entry['attempts'], log_file_name, entry['destination'],
+                    retry_delay_secs)
+            entry['next_attempt'] = time.time() + retry_delay_secs
+            self.write_entry(entry_file_name, entry)
+            with self.condition:
+                self.pending[entry_file_name] = (
+                        time.monotonic() + retry_delay_secs)
+            return
+        logger.info(
+                "Uploaded MTR log file %s to %s",
+                log_file_name, entry['destination'])
+        self.remove_entry(entry_file_name)
+
+    def upload_entry(self, entry_file_name, entry):
+        log_file_name = entry['log_file_name']
+        destination_args = entry['destination']
+        # entries written by older versions have no compression and mode
+        compression = entry.get('compression')
+        resume_state = ResumeState(
+                entry.setdefault('resume', {}),
+                lambda: self.write_entry(entry_file_name, entry))
+        if self.ack_store is None:
+            self.upload(
+                    log_file_name, destination_args, compression,
+                    resume_state)
+            return
+        # changing the timeout of a destination keeps its acknowledgements
+        ack_destination_args = split_timeout(destination_args)[0]
+        with open(log_file_name, 'r') as f:
+            log_lines = f.readlines()
+        packages = [
+                mtrlog.mtr_id_and_packet_num_of(log_line)
+                for log_line in log_lines]
+        new_log_lines = log_lines
+        if entry.get('mode', 'full') == 'delta':
+            # lines that are not MTR log lines are always sent
+            new_log_lines = [
+                    log_line
+                    for (log_line, package) in zip(log_lines, packages)
+                    if package is None
+                    or not self.ack_store.is_acknowledged(
+                        ack_destination_args, *package)]
+            logger.info(
+                    "%d of %d lines of MTR log file %s not yet uploaded to "
+                    "%s", len(new_log_lines), len(log_lines), log_file_name,
+                    destination_args)
+        if len(new_log_lines) == len(log_lines):
+            self.upload(
+                    log_file_name, destination_args, compression,
+                    resume_state)
+        elif new_log_lines:
+            with tempfile.TemporaryDirectory() as delta_dir:
+                delta_file_name = os.path.join(
+                        delta_dir, delta_file_name_of(log_file_name))
+                with open(delta_file_name, 'w') as f:
+                    f.writelines(new_log_lines)
+                self.upload(
+                        delta_file_name, destination_args, compression,
+                        resume_state)
+        self.ack_store.acknowledge(
+                ack_destination_args,
+                [package for package in packages if package is not None])
+        self.ack_store.save()
+
+    def read_entry(self, entry_file_name):
+        with open(os.path.join(self.directory, entry_file_name), 'r') as f:
+            return json.load(f)
+
+    def write_entry(self, entry_file_name, entry):
+        entry_path = os.path.join(self.directory, entry_file_name)
+        # never leave a truncated entry behind
+        with open(entry_path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(entry_path + '.tmp', entry_path)
+
+    def remove_entry(self, entry_file_name):
+        try:
+            os.remove(os.path.join(self.directory, entry_file_name))
+        except FileNotFoundError:
+            pass
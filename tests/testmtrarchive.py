@@ -0,0 +1,242 @@
+from datetime import datetime
+import mmap
+import os
+import tempfile
+import threading
+import unittest
+
+import mtrarchive
+import mtrbatch
+import mtrreader
+from tests.testmtrreader import data_message
+
+
+class TestMtrArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.archive_file_name = os.path.join(
+                self.archive_dir.name, 'mtr.archive')
+        self.archive = mtrarchive.MtrArchive(self.archive_file_name)
+
+    def tearDown(self):
+        self.archive_dir.cleanup()
+
+    def test_new_archive_is_empty(self):
+        self.assertEqual(len(self.archive), 0)
+        self.assertEqual(self.archive.by_card_id(66308), [])
+
+    def test_append_and_lookup_by_card_id(self):
+        self.archive.append([
+                data_message(package_num=1, card_id=66308),
+                data_message(package_num=2, card_id=1234),
+                data_message(package_num=3, card_id=66308)])
+        messages = self.archive.by_card_id(66308)
+        self.assertEqual(
+                [msg.packet_num() for msg in messages], [1, 3])
+        self.assertEqual(messages[0].card_id(), 66308)
+
+    def test_lookup_by_package(self):
+        self.archive.append([
+                data_message(mtr_id=1, package_num=5, card_id=1),
+                data_message(mtr_id=2, package_num=5, card_id=2)])
+        messages = self.archive.by_package(2, 5)
+        self.assertEqual([msg.card_id() for msg in messages], [2])
+        self.assertEqual(self.archive.by_package(3, 5), [])
+
+    def test_lookup_by_mtr_id(self):
+        self.archive.append([
+                data_message(mtr_id=1, package_num=1),
+                data_message(mtr_id=2, package_num=1),
+                data_message(mtr_id=1, package_num=2)])
+        self.assertEqual(
+                [msg.packet_num() for msg in self.archive.by_mtr_id(1)],
+                [1, 2])
+        self.assertEqual(self.archive.by_mtr_id(3), [])
+
+    def test_lookup_by_read_time(self):
+        self.archive.append([
+                data_message(
+                    package_num=1,
+                    datetime_read=datetime(2019, 5, 17, 14, 0, 0)),
+                data_message(
+                    package_num=2,
+                    datetime_read=datetime(2019, 5, 17, 12, 0, 0)),
+                data_message(
+                    package_num=3,
+                    datetime_read=datetime(2019, 5, 18, 12, 0, 0))])
+        messages = self.archive.by_read_time(
+                datetime(2019, 5, 17), datetime(2019, 5, 18))
+        self.assertEqual([msg.packet_num() for msg in messages], [2, 1])
+
+    def test_invalid_read_time_is_indexed_as_zero(self):
+        message_bytes = bytearray(data_message().message_bytes)
+        message_bytes[9] = 13  # month
+        message_bytes[232] = mtrreader.checksum_of(message_bytes[:232])
+        self.archive.append([mtrreader.MtrDataMessage(message_bytes)])
+        self.assertEqual(self.archive.entries[0][3], 0)
+
+    def test_messages_share_memory_with_archive(self):
+        self.archive.append([data_message()])
+        message = self.archive.by_card_id(66308)[0]
+        self.assertIsInstance(message.buffer, mmap.mmap)
+
+    def test_duplicates_are_not_appended(self):
+        self.assertEqual(self.archive.append([data_message()]), 1)
+        self.assertEqual(self.archive.append([data_message()]), 0)
+        self.assertEqual(len(self.archive), 1)
+
+    def test_same_package_num_with_other_content_is_appended(self):
+        # e.g. after the MTR's memory has been cleared
+        self.archive.append([data_message(card_id=1)])
+        self.archive.append([data_message(card_id=2)])
+        self.assertEqual(len(self.archive.by_package(1, 1)), 2)
+
+    def test_invalid_checksum_is_not_appended(self):
+        message_bytes = bytearray(data_message().message_bytes)
+        message_bytes[232] ^= 0xFF
+        self.assertEqual(
+                self.archive.append([mtrreader.MtrDataMessage(message_bytes)]),
+                0)
+
+    def test_track_passes_all_messages_through(self):
+        messages = [data_message(package_num=1)] * 2
+        self.assertEqual(list(self.archive.track(messages)), messages)
+        self.assertEqual(len(self.archive), 1)
+
+    def test_track_several_mtrs_at_the_same_time(self):
+        threads = [
+                threading.Thread(
+                    target=self.archive.append,
+                    args=([
+                        data_message(mtr_id=mtr_id, package_num=i)
+                        for i in range(1, 201)],))
+                for mtr_id in [1, 2]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        archive = mtrarchive.MtrArchive(self.archive_file_name)
+        self.assertEqual(len(archive), 400)
+        for mtr_id in [1, 2]:
+            self.assertEqual(
+                    [msg.packet_num() for msg in archive.by_mtr_id(mtr_id)],
+                    list(range(1, 201)))
+
+    def test_lookup_after_archive_has_grown(self):
+        self.archive.append([data_message(package_num=1)])
+        first = self.archive.by_package(1, 1)[0]
+        self.archive.append([data_message(package_num=2)])
+        self.assertEqual(self.archive.by_package(1, 2)[0].packet_num(), 2)
+        self.assertEqual(first.packet_num(), 1)
+
+    def test_reopen(self):
+        self.archive.append([
+                data_message(package_num=1, card_id=66308),
+                data_message(package_num=2, card_id=1234)])
+        archive = mtrarchive.MtrArchive(self.archive_file_name)
+        self.assertEqual(len(archive), 2)
+        self.assertEqual(
+                [msg.packet_num() for msg in archive.by_card_id(1234)], [2])
+
+    def test_reopen_drops_partial_record(self):
+        self.archive.append([data_message(package_num=1)])
+        with open(self.archive_file_name, 'ab') as f:
+            f.write(data_message(package_num=2).message_bytes[:100])
+        archive = mtrarchive.MtrArchive(self.archive_file_name)
+        self.assertEqual(len(archive), 1)
+        self.assertEqual(
+                os.path.getsize(self.archive_file_name),
+                mtrarchive.RECORD_SIZE)
+
+    def test_reopen_indexes_records_missing_in_index(self):
+        self.archive.append([
+                data_message(package_num=1),
+                data_message(package_num=2, card_id=1234)])
+        os.truncate(
+                self.archive.index_file_name, mtrarchive.INDEX_ENTRY.size)
+        archive = mtrarchive.MtrArchive(self.archive_file_name)
+        self.assertEqual(
+                [msg.packet_num() for msg in archive.by_card_id(1234)], [2])
+        self.assertEqual(
+                os.path.getsize(archive.index_file_name),
+                2 * mtrarchive.INDEX_ENTRY.size)
+
+    def append_record_without_index_entry(self, data_message):
+        # like the writer between writing a record and its index entry
+        with open(self.archive_file_name, 'ab') as archive_file:
+            archive_file.write(data_message.message_bytes)
+
+    def append_index_entry(self, data_message):
+        with open(self.archive.index_file_name, 'ab') as index_file:
+            index_file.write(mtrarchive.INDEX_ENTRY.pack(
+                *mtrarchive.index_entry_of(data_message)))
+
+    def test_read_only_open_does_not_write(self):
+        self.archive.append([data_message(package_num=1, card_id=22)])
+        self.append_record_without_index_entry(
+                data_message(package_num=2, card_id=33))
+        with open(self.archive_file_name, 'ab') as archive_file:
+            archive_file.write(data_message(package_num=3).message_bytes[:100])
+        sizes = (
+                os.path.getsize(self.archive_file_name),
+                os.path.getsize(self.archive.index_file_name))
+        archive = mtrarchive.MtrArchive(
+                self.archive_file_name, read_only=True)
+        self.assertEqual(len(archive), 1)
+        self.assertEqual(archive.by_card_id(33), [])
+        self.assertEqual(
+                (os.path.getsize(self.archive_file_name),
+                 os.path.getsize(self.archive.index_file_name)),
+                sizes)
+
+    def test_read_only_open_while_appending(self):
+        self.archive.append([data_message(package_num=1, card_id=22)])
+        messages = [
+                data_message(package_num=2, card_id=33),
+                data_message(package_num=3, card_id=44)]
+        self.append_record_without_index_entry(messages[0])
+        mtrarchive.MtrArchive(self.archive_file_name, read_only=True)
+        # the writer goes on with the index entry and the next message
+        self.append_index_entry(messages[0])
+        self.append_record_without_index_entry(messages[1])
+        self.append_index_entry(messages[1])
+        archive = mtrarchive.MtrArchive(
+                self.archive_file_name, read_only=True)
+        for (card_id, package_nums) in [(22, [1]), (33, [2]), (44, [3])]:
+            self.assertEqual(
+                    [msg.packet_num() for msg in archive.by_card_id(card_id)],
+                    package_nums)
+
+    def test_read_only_missing_archive_is_empty(self):
+        archive = mtrarchive.MtrArchive(
+                self.archive_file_name, read_only=True)
+        self.assertEqual(len(archive), 0)
+        self.assertEqual(os.listdir(self.archive_dir.name), [])
+
+    def test_read_only_archive_cannot_be_appended(self):
+        archive = mtrarchive.MtrArchive(
+                self.archive_file_name, read_only=True)
+        with self.assertRaises(ValueError):
+            archive.append([data_message()])
+
+    @unittest.skipUnless(mtrbatch.is_available(), "NumPy not installed")
+    def test_read_only_batch_without_records_past_index(self):
+        self.archive.append([data_message(package_num=1, card_id=22)])
+        self.append_record_without_index_entry(
+                data_message(package_num=2, card_id=33))
+        archive = mtrarchive.MtrArchive(
+                self.archive_file_name, read_only=True)
+        self.assertEqual(list(archive.batch().card_id()), [22])
+
+    @unittest.skipUnless(mtrbatch.is_available(), "NumPy not installed")
+    def test_batch(self):
+        self.archive.append([
+                data_message(package_num=1, card_id=66308),
+                data_message(package_num=2, card_id=1234)])
+        self.assertEqual(
+                list(self.archive.batch().card_id()), [66308, 1234])
+
+
+if __name__ == '__main__':
+    unittest.main()
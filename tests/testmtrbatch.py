@@ -0,0 +1,101 @@
+from datetime import datetime
+import unittest
+
+import mtrbatch
+import mtrlog
+import mtrreader
+from tests.testmtrreader import MtrDataBytesBuilder
+
+
+@unittest.skipUnless(mtrbatch.is_available(), "NumPy not installed")
+class TestMtrBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.datetime_read = datetime(2019, 5, 17, 13, 27, 41)
+        self.bytes_builder = MtrDataBytesBuilder(
+                mtr_id=33145,
+                card_id=131586,
+                splits=[(0, 0), (31, 60), (249, 4660)],
+                datetime_read=self.datetime_read,
+                package_number=1)
+        self.data = bytearray()
+        for package_number in range(1, 4):
+            self.bytes_builder.package_number = package_number
+            self.data.extend(self.bytes_builder.to_bytes())
+        self.batch = mtrbatch.MtrBatch(bytes(self.data))
+
+    def test_len(self):
+        self.assertEqual(len(self.batch), 3)
+
+    def test_buffer_size_not_multiple_of_message_size(self):
+        with self.assertRaises(ValueError):
+            mtrbatch.MtrBatch(bytes(self.data[:-1]))
+
+    def test_columns(self):
+        self.assertEqual(self.batch.mtr_id().tolist(), [33145] * 3)
+        self.assertEqual(self.batch.card_id().tolist(), [131586] * 3)
+        self.assertEqual(self.batch.packet_num().tolist(), [1, 2, 3])
+        self.assertEqual(self.batch.timestamp_year().tolist(), [19] * 3)
+        self.assertEqual(self.batch.timestamp_month().tolist(), [5] * 3)
+        self.assertEqual(self.batch.timestamp_day().tolist(), [17] * 3)
+        self.assertEqual(self.batch.timestamp_hours().tolist(), [13] * 3)
+        self.assertEqual(self.batch.timestamp_minutes().tolist(), [27] * 3)
+        self.assertEqual(self.batch.timestamp_seconds().tolist(), [41] * 3)
+        self.assertEqual(
+                self.batch.timestamp_milliseconds().tolist(), [0] * 3)
+
+    def test_splits(self):
+        self.assertEqual(self.batch.split_codes().shape, (3, 50))
+        self.assertEqual(self.batch.split_times().shape, (3, 50))
+        self.assertEqual(
+                self.batch.split_codes()[0].tolist(),
+                [0, 31, 249] + 47 * [0])
+        self.assertEqual(
+                self.batch.split_times()[2].tolist(),
+                [0, 60, 4660] + 47 * [0])
+
+    def test_flat_splits(self):
+        self.assertEqual(
+                self.batch.flat_splits()[1].tolist(),
+                [0, 0, 31, 60, 249, 4660] + 94 * [0])
+
+    def test_num_splits(self):
+        self.data[234 + 26:234 + 176] = bytes(150)
+        self.data[2 * 234 + 26 + 49 * 3] = 1
+        batch = mtrbatch.MtrBatch(bytes(self.data))
+        self.assertEqual(batch.num_splits().tolist(), [3, 0, 50])
+
+    def test_checksums(self):
+        self.data[234 + 232] = (self.data[234 + 232] + 1) % 256
+        batch = mtrbatch.MtrBatch(bytes(self.data))
+        self.assertEqual(
+                batch.is_checksum_valid().tolist(), [True, False, True])
+        self.assertEqual(batch.valid().packet_num().tolist(), [1, 3])
+
+    def test_iterate_messages(self):
+        messages = list(self.batch)
+        self.assertEqual([msg.packet_num() for msg in messages], [1, 2, 3])
+        self.assertEqual(messages[0].splits(), self.bytes_builder.splits + [
+            (0, 0)] * 47)
+
+    def test_from_messages(self):
+        messages = mtrreader.MtrDecoder().feed(self.data)
+        batch = mtrbatch.MtrBatch.from_messages(messages)
+        self.assertEqual(batch.packet_num().tolist(), [1, 2, 3])
+
+    def test_from_log_lines(self):
+        log_lines = mtrlog.MtrLogFormatter().format_all(
+                self.batch, datetime.now())
+        batch = mtrbatch.MtrBatch.from_log_lines(log_lines)
+        self.assertEqual(bytes(batch.buffer), bytes(self.data))
+
+    def test_format_batch(self):
+        datetime_extracted = datetime.now()
+        formatter = mtrlog.MtrLogFormatter()
+        self.assertEqual(
+                formatter.format_batch(self.batch, datetime_extracted),
+                formatter.format_all(self.batch, datetime_extracted))
+
+
+if __name__ == '__main__':
+    unittest.main()
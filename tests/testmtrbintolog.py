@@ -0,0 +1,84 @@
+from datetime import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import mtrbatch
+import mtrlog
+import mtrreader
+from tests.testmtrreader import MtrDataBytesBuilder, MtrStatusBytesBuilder
+from tests.testmtrupload import load_devutil_module
+
+mtrbintolog = load_devutil_module('mtrbintolog', 'mtr-bin-to-log.py')
+
+
+class TestConvert(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.capture_file_name = os.path.join(self.temp_dir.name, 'mtr.bin')
+        self.log_file_name = os.path.join(self.temp_dir.name, 'mtr.log')
+        self.datetime_extracted = datetime(2019, 5, 17, 14, 0, 0)
+        data_messages_bytes = [
+                MtrDataBytesBuilder(
+                    mtr_id=33145,
+                    card_id=131586 + package_number,
+                    splits=[(0, 0), (31, 60), (249, 4660)],
+                    datetime_read=datetime(2019, 5, 17, 13, 27, 41),
+                    package_number=package_number).to_bytes()
+                for package_number in range(1, 4)]
+        with open(self.capture_file_name, 'wb') as capture_file:
+            capture_file.write(MtrStatusBytesBuilder(33145).to_bytes())
+            for data_message_bytes in data_messages_bytes:
+                capture_file.write(data_message_bytes)
+            # recording stopped in the middle of a frame
+            capture_file.write(data_messages_bytes[0][:100])
+        mtime = self.datetime_extracted.timestamp()
+        os.utime(self.capture_file_name, (mtime, mtime))
+        formatter = mtrlog.MtrLogFormatter()
+        self.expected_log_lines = [
+                formatter.format(
+                    mtrreader.MtrDataMessage(bytes(data_message_bytes)),
+                    self.datetime_extracted)
+                for data_message_bytes in data_messages_bytes]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def converted_log_lines(self):
+        num_log_lines = mtrbintolog.convert(
+                self.capture_file_name, self.log_file_name)
+        self.assertEqual(num_log_lines, len(self.expected_log_lines))
+        with open(self.log_file_name, encoding='utf-8') as log_file:
+            return log_file.read().splitlines()
+
+    @unittest.skipUnless(mtrbatch.is_available(), "NumPy not installed")
+    def test_convert_with_numpy(self):
+        self.assertEqual(self.converted_log_lines(), self.expected_log_lines)
+
+    def test_convert_without_numpy(self):
+        with mock.patch.object(mtrbatch, 'is_available', return_value=False):
+            self.assertEqual(
+                    self.converted_log_lines(), self.expected_log_lines)
+
+    def test_failed_capture_does_not_stop_others(self):
+        missing_capture_file_name = os.path.join(
+                self.temp_dir.name, 'missing.bin')
+        result = subprocess.run(
+                [sys.executable, mtrbintolog.__file__,
+                    missing_capture_file_name, self.capture_file_name],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn(missing_capture_file_name, result.stderr)
+        with open(self.log_file_name, encoding='utf-8') as log_file:
+            self.assertEqual(
+                    log_file.read().splitlines(), self.expected_log_lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
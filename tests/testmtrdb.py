@@ -0,0 +1,186 @@
+from datetime import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import mtrdb
+import mtrreader
+from tests.testmtrreader import data_message
+
+
+class TestMtrResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file_name = os.path.join(self.db_dir.name, 'results.db')
+        self.store = mtrdb.MtrResultStore(self.db_file_name)
+        self.datetime_extracted = datetime(2019, 5, 17, 15, 0, 0)
+
+    def tearDown(self):
+        self.store.close()
+        self.db_dir.cleanup()
+
+    def insert(self, data_messages):
+        return self.store.insert(data_messages, self.datetime_extracted)
+
+    def keys(self, rows):
+        return [(row['mtr_id'], row['packet_num']) for row in rows]
+
+    def test_insert_and_lookup_by_card_id(self):
+        self.insert([
+                data_message(package_num=1, card_id=66308),
+                data_message(package_num=2, card_id=1234),
+                data_message(package_num=3, card_id=66308)])
+        rows = self.store.by_card_id(66308)
+        self.assertEqual(self.keys(rows), [(1, 1), (1, 3)])
+        self.assertEqual(rows[0]['read_time'], '2019-05-17 13:27:41.000')
+        self.assertEqual(
+                rows[0]['extracted_time'], '2019-05-17 15:00:00.000')
+        self.assertEqual(rows[0]['num_splits'], 4)
+
+    def test_splits(self):
+        self.insert([data_message()])
+        self.assertEqual(
+                self.store.splits(1, 1),
+                [(0, 0), (31, 60), (32, 120), (249, 180)])
+
+    def test_duplicates_are_not_inserted(self):
+        self.assertEqual(
+                self.insert([data_message(), data_message()]), 1)
+        self.assertEqual(
+                self.insert([
+                    data_message(splits=[(0, 0)]),
+                    data_message(package_num=2)]),
+                1)
+        self.assertEqual(len(self.store.splits(1, 1)), 4)
+
+    def test_invalid_read_time_is_null(self):
+        message_bytes = bytearray(data_message().message_bytes)
+        message_bytes[9] = 13  # month
+        self.insert([mtrreader.MtrDataMessage(message_bytes)])
+        self.assertIsNone(self.store.by_card_id(66308)[0]['read_time'])
+
+    def test_read_between(self):
+        self.insert([
+                data_message(
+                    package_num=1,
+                    datetime_read=datetime(2019, 5, 17, 14, 0, 0)),
+                data_message(
+                    package_num=2,
+                    datetime_read=datetime(2019, 5, 17, 12, 0, 0)),
+                data_message(
+                    package_num=3,
+                    datetime_read=datetime(2019, 5, 18, 12, 0, 0))])
+        self.assertEqual(
+                self.keys(self.store.read_between(
+                    '2019-05-17 13:00', '2019-05-18')),
+                [(1, 1)])
+
+    def test_with_controls(self):
+        self.insert([
+                data_message(package_num=1),
+                data_message(
+                    package_num=2, splits=[(0, 0), (31, 60), (249, 180)]),
+                data_message(
+                    package_num=3, splits=[(0, 0), (33, 60), (249, 180)])])
+        self.assertEqual(
+                self.keys(self.store.with_controls([31, 32])), [(1, 1)])
+        self.assertEqual(
+                self.keys(self.store.with_controls([31])), [(1, 1), (1, 2)])
+
+    def test_missing_controls(self):
+        self.insert([
+                data_message(package_num=1),
+                data_message(
+                    package_num=2, splits=[(0, 0), (31, 60), (249, 180)]),
+                data_message(package_num=3, splits=[(0, 0)])])
+        missing = self.store.missing_controls([31, 32])
+        self.assertEqual(
+                [((row['mtr_id'], row['packet_num']), missing_codes)
+                 for (row, missing_codes) in missing],
+                [((1, 2), [32]), ((1, 3), [31, 32])])
+
+    def test_track_and_save(self):
+        messages = [data_message(package_num=1)]
+        self.assertEqual(
+                list(self.store.track(messages, self.datetime_extracted)),
+                messages)
+        # not committed yet
+        other_store = mtrdb.MtrResultStore(self.db_file_name)
+        self.addCleanup(other_store.close)
+        self.assertEqual(other_store.by_card_id(66308), [])
+        self.assertEqual(self.store.save(), 1)
+        self.assertEqual(self.keys(other_store.by_card_id(66308)), [(1, 1)])
+        self.assertEqual(self.store.save(), 0)
+
+    def test_track_inserts_messages_as_they_pass(self):
+        def messages():
+            yield data_message(package_num=1)
+            # the first message is inserted before the next is requested
+            self.assertEqual(
+                    self.keys(self.store.by_card_id(66308)), [(1, 1)])
+            yield data_message(package_num=2)
+
+        for msg in self.store.track(
+                messages(), self.datetime_extracted):
+            pass
+        self.assertEqual(self.store.save(), 2)
+
+    @mock.patch.object(mtrdb, 'COMMIT_INTERVAL_SECS', 0)
+    def test_track_commits_while_streaming(self):
+        other_store = mtrdb.MtrResultStore(self.db_file_name)
+        self.addCleanup(other_store.close)
+        tracked = self.store.track(
+                [data_message(package_num=1), data_message(package_num=2)],
+                self.datetime_extracted)
+        next(tracked)
+        self.assertEqual(self.keys(other_store.by_card_id(66308)), [(1, 1)])
+        list(tracked)
+        self.assertEqual(self.store.save(), 2)
+
+    @mock.patch.object(mtrdb, 'COMMIT_INTERVAL_SECS', 0)
+    @mock.patch.object(mtrdb, 'TIMEOUT_SECS', 0.1)
+    def test_concurrent_tracking(self):
+        # like two MTRs extracted at the same time, each with its own store
+        stores = [mtrdb.MtrResultStore(self.db_file_name) for mtr_id in (1, 2)]
+        for store in stores:
+            self.addCleanup(store.close)
+        tracked = [
+                store.track(
+                    [data_message(mtr_id=mtr_id, package_num=package_num)
+                     for package_num in range(1, 4)],
+                    self.datetime_extracted)
+                for (mtr_id, store) in zip((1, 2), stores)]
+        for messages in zip(*tracked):
+            pass
+        self.assertEqual([store.save() for store in stores], [3, 3])
+        self.assertEqual(len(self.store.by_card_id(66308)), 6)
+
+    def test_close_without_save_discards_tracked_messages(self):
+        for msg in self.store.track(
+                [data_message()], self.datetime_extracted):
+            pass
+        self.store.close()
+        self.store = mtrdb.MtrResultStore(self.db_file_name)
+        self.assertEqual(self.store.by_card_id(66308), [])
+
+    def test_reopen(self):
+        self.insert([data_message()])
+        self.store.close()
+        self.store = mtrdb.MtrResultStore(self.db_file_name)
+        self.assertEqual(self.keys(self.store.by_card_id(66308)), [(1, 1)])
+
+    def test_lookups_use_indexes(self):
+        for (where, parameters) in [
+                ('card_id = ?', (66308,)),
+                ('read_time >= ? AND read_time < ?', ('2019', '2020'))]:
+            plan = ' '.join(
+                    row['detail'] for row in self.store.connection.execute(
+                        'EXPLAIN QUERY PLAN SELECT * FROM messages WHERE '
+                        + where, parameters))
+            self.assertIn('USING INDEX', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import mtrdevice
+
+
+class TestDeviceWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.device_dir = tempfile.TemporaryDirectory()
+        self.device_path = os.path.join(self.device_dir.name, 'ttyMTR')
+        (self.pty_master, self.pty_slave) = os.openpty()
+
+    def tearDown(self):
+        os.close(self.pty_master)
+        os.close(self.pty_slave)
+        self.device_dir.cleanup()
+
+    def connect_device(self):
+        # like the symlink to the device node created by udev
+        os.symlink(os.ttyname(self.pty_slave), self.device_path)
+
+    def connect_device_later(self, delay_secs):
+        connected_times = []
+
+        def connect():
+            connected_times.append(time.monotonic())
+            self.connect_device()
+        timer = threading.Timer(delay_secs, connect)
+        timer.start()
+        self.addCleanup(timer.join)
+        return connected_times
+
+    def test_device_already_present(self):
+        self.connect_device()
+        with mtrdevice.DeviceWatcher(self.device_path) as device_watcher:
+            self.assertTrue(device_watcher.wait(True, 0))
+
+    def test_wait_for_device_to_appear(self):
+        with mtrdevice.DeviceWatcher(self.device_path) as device_watcher:
+            connected_times = self.connect_device_later(0.2)
+            self.assertTrue(device_watcher.wait(True, 5))
+            # notified, not polled
+            self.assertLess(time.monotonic() - connected_times[0], 0.05)
+
+    def test_wait_for_device_to_disappear(self):
+        self.connect_device()
+        with mtrdevice.DeviceWatcher(self.device_path) as device_watcher:
+            timer = threading.Timer(0.1, os.remove, (self.device_path,))
+            timer.start()
+            self.addCleanup(timer.join)
+            self.assertTrue(device_watcher.wait(False, 5))
+
+    def test_wait_timeout(self):
+        with mtrdevice.DeviceWatcher(self.device_path) as device_watcher:
+            start_time = time.monotonic()
+            self.assertFalse(device_watcher.wait(True, 0.2))
+            self.assertGreaterEqual(time.monotonic() - start_time, 0.2)
+
+    def test_other_files_in_directory_are_ignored(self):
+        with mtrdevice.DeviceWatcher(self.device_path) as device_watcher:
+            open(os.path.join(self.device_dir.name, 'other'), 'w').close()
+            self.assertFalse(device_watcher.wait(True, 0.2))
+
+    def test_devices_matching_glob_pattern(self):
+        self.connect_device()
+        os.symlink(
+                os.ttyname(self.pty_slave),
+                os.path.join(self.device_dir.name, 'ttyUSB0'))
+        with mtrdevice.DeviceWatcher(
+                os.path.join(self.device_dir.name, 'ttyUSB*'),
+                self.device_path) as device_watcher:
+            self.assertEqual(
+                    device_watcher.devices(),
+                    [os.path.join(self.device_dir.name, 'ttyMTR'),
+                     os.path.join(self.device_dir.name, 'ttyUSB0')])
+
+    def test_wait_for_device_matching_glob_pattern(self):
+        with mtrdevice.DeviceWatcher(
+                os.path.join(self.device_dir.name, 'tty*')) as device_watcher:
+            self.assertIsNotNone(device_watcher.inotify_fd)
+            connected_times = self.connect_device_later(0.2)
+            self.assertTrue(device_watcher.wait(True, 5))
+            self.assertLess(time.monotonic() - connected_times[0], 0.05)
+
+    def test_wait_for_other_devices(self):
+        self.connect_device()
+        with mtrdevice.DeviceWatcher(
+                os.path.join(self.device_dir.name, 'tty*')) as device_watcher:
+            devices = device_watcher.devices()
+            self.assertFalse(device_watcher.wait_for_other_devices(
+                devices, 0.1))
+            timer = threading.Timer(0.1, os.symlink, (
+                os.ttyname(self.pty_slave),
+                os.path.join(self.device_dir.name, 'ttyUSB0')))
+            timer.start()
+            self.addCleanup(timer.join)
+            self.assertTrue(device_watcher.wait_for_other_devices(
+                devices, 5))
+
+    def test_polling_without_inotify(self):
+        with mock.patch.object(mtrdevice, 'inotify_init1', None):
+            with mtrdevice.DeviceWatcher(self.device_path) as device_watcher:
+                self.assertIsNone(device_watcher.inotify_fd)
+                self.connect_device_later(0.2)
+                self.assertTrue(device_watcher.wait(True, 5))
+
+    def test_polling_if_directory_is_missing(self):
+        device_path = os.path.join(self.device_dir.name, 'serial', 'ttyMTR')
+        with mtrdevice.DeviceWatcher(device_path) as device_watcher:
+            self.assertIsNone(device_watcher.inotify_fd)
+            self.assertFalse(device_watcher.wait(True, 0.2))
+
+
+class TestBackoffDelays(unittest.TestCase):
+
+    def test_doubling_up_to_max(self):
+        delays = mtrdevice.backoff_delays(0.1, 0.5)
+        self.assertEqual(
+                [next(delays) for i in range(5)],
+                [0.1, 0.2, 0.4, 0.5, 0.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,419 @@
+from datetime import datetime
+import glob
+import json
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mtrarchive
+import mtrdb
+from tests.testmtrreader import MtrDataBytesBuilder, MtrStatusBytesBuilder
+
+EXTRACTOR = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'mtr-log-extractor.py')
+
+# Modules that take long to import and are not needed before the MTR has
+# been polled (imported by the destinations, archive, result database or
+# compression when used)
+SLOW_MODULES = [
+        'dropbox', 'requests', 'numpy', 'zstandard', 'mtrarchive', 'mmap',
+        'mtrdb', 'sqlite3']
+# Modules imported at start: the ones needed to poll the MTR, and the upload
+# outbox with its store of acknowledged packages (uploading the log files
+# left by earlier runs while waiting for the MTR)
+STARTUP_MODULES = [
+        'serial', 'mtrreader', 'mtrlog', 'mtrupload', 'mtrstate']
+# Limit of the import time of the extractor's modules relative to that of
+# the modules the interpreter imports itself at startup. The ratio is about
+# 1.4 on a desktop computer: the import time growing by half fails.
+MAX_IMPORT_TIME_RATIO = 2.0
+# Import times are the minimum of several runs
+NUM_IMPORT_TIME_RUNS = 3
+
+# Runs the extractor with -h, which exits when all modules of the extractor
+# have been imported, and prints the names of the imported modules
+PRINT_MODULES_AFTER_IMPORT = '\n'.join([
+        'import runpy, sys',
+        'sys.argv = [%r, "-h"]' % EXTRACTOR,
+        'sys.path.insert(0, %r)' % os.path.dirname(EXTRACTOR),
+        'try:',
+        '    runpy.run_path(sys.argv[0], run_name="__main__")',
+        'except SystemExit:',
+        '    pass',
+        'sys.stdout.flush()',
+        'sys.stderr.write("\\n".join(sorted(sys.modules)))',
+        ])
+
+
+def imported_modules():
+    result = subprocess.run(
+            [sys.executable, '-c', PRINT_MODULES_AFTER_IMPORT],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True)
+    return set(result.stderr.splitlines())
+
+
+def import_times(python_args):
+    # Cumulative import time in seconds of each module imported when running
+    # python with python_args, and the names of the modules imported at top
+    # level
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime'] + python_args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True)
+    import_secs = {}
+    top_level_modules = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        (self_us, cumulative_us, module) = line.split(':', 1)[1].split('|')
+        if not cumulative_us.strip().isdigit():
+            continue
+        import_secs[module.strip()] = int(cumulative_us) / 1e6
+        # nested imports are indented
+        if not module[1:].startswith(' '):
+            top_level_modules.append(module.strip())
+    return import_secs, top_level_modules
+
+
+def min_import_secs(python_args, excluded_modules=()):
+    # Import time of the top level modules, without excluded_modules (e.g.
+    # the ones imported by the interpreter itself)
+    def import_secs_of_run():
+        (import_secs, top_level_modules) = import_times(python_args)
+        return sum(
+                import_secs[module]
+                for module in top_level_modules
+                if module not in excluded_modules)
+    return min(
+            import_secs_of_run() for run in range(NUM_IMPORT_TIME_RUNS))
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_slow_modules_are_not_imported(self):
+        modules = imported_modules()
+        imported_packages = {module.split('.')[0] for module in modules}
+        for module in SLOW_MODULES:
+            self.assertNotIn(module, imported_packages)
+        for module in STARTUP_MODULES:
+            self.assertIn(module, modules)
+
+    def test_import_time(self):
+        # measured against the interpreter's own startup imports in the same
+        # run, so that the budget holds on slower computers too
+        startup_modules = import_times(['-c', 'pass'])[0]
+        startup_secs = min_import_secs(['-c', 'pass'])
+        extractor_secs = min_import_secs(
+                [EXTRACTOR, '-h'], startup_modules)
+        self.assertLess(
+                extractor_secs / startup_secs, MAX_IMPORT_TIME_RATIO,
+                "extractor imports take %.3f seconds, interpreter startup "
+                "imports %.3f seconds" % (extractor_secs, startup_secs))
+
+
+class FakeMtr:
+
+    # Answers the status and spool commands of the extractor at the master
+    # side of a pty, with num_messages data messages sent
+    # message_interval_secs apart
+
+    def __init__(
+            self, pty_master, mtr_id, num_messages, message_interval_secs=0):
+        self.pty_master = pty_master
+        self.mtr_id = mtr_id
+        self.num_messages = num_messages
+        self.message_interval_secs = message_interval_secs
+        self.is_stopping = False
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_stopping = True
+        self.thread.join()
+
+    def serve(self):
+        commands = bytearray()
+        while not self.is_stopping:
+            if not select.select([self.pty_master], [], [], 0.1)[0]:
+                continue
+            commands.extend(os.read(self.pty_master, 1024))
+            while len(commands) >= 3:
+                command = bytes(commands[:3])
+                if command == b'/SB' and len(commands) < 7:
+                    break
+                if command == b'/ST':
+                    os.write(self.pty_master, self.status_bytes())
+                elif command in (b'/SA', b'/SB'):
+                    self.send_data()
+                else:
+                    del commands[0]
+                    continue
+                del commands[:7 if command == b'/SB' else 3]
+
+    def status_bytes(self):
+        return bytes(MtrStatusBytesBuilder(
+                self.mtr_id,
+                recent_package_num=self.num_messages,
+                session_start_package_nums=[1]).to_bytes())
+
+    def send_data(self):
+        for package_num in range(1, self.num_messages + 1):
+            if package_num > 1 and self.message_interval_secs > 0:
+                if self.is_stopping:
+                    return
+                time.sleep(self.message_interval_secs)
+            os.write(self.pty_master, bytes(MtrDataBytesBuilder(
+                    self.mtr_id,
+                    card_id=66308,
+                    splits=[(0, 0), (31, 60), (249, 4660)],
+                    datetime_read=datetime(2019, 5, 17, 13, 27, 41),
+                    package_number=package_num).to_bytes()))
+
+
+class TestMultiplePorts(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.upload_dir = os.path.join(self.temp_dir.name, 'uploads')
+        os.mkdir(self.upload_dir)
+
+    def temp_path(self, file_name):
+        return os.path.join(self.temp_dir.name, file_name)
+
+    def port(self, name):
+        # a pty symlinked like the device node created by udev
+        (pty_master, pty_slave) = os.openpty()
+        self.addCleanup(os.close, pty_slave)
+        self.addCleanup(os.close, pty_master)
+        device_path = self.temp_path(name)
+        os.symlink(os.ttyname(pty_slave), device_path)
+        return (device_path, pty_master)
+
+    def port_with_mtr(self, name, mtr_id, num_messages=3, **kwargs):
+        (device_path, pty_master) = self.port(name)
+        mtr = FakeMtr(pty_master, mtr_id, num_messages, **kwargs)
+        self.addCleanup(mtr.stop)
+        return device_path
+
+    def run_extractor(self, ports, *extractor_args):
+        return subprocess.run(
+                [sys.executable, EXTRACTOR,
+                    '-p'] + ports + [
+                    '-t', '2',
+                    '-f', self.temp_path('mtr-{}.log'),
+                    '-d', 'local', self.upload_dir,
+                    '--upload-mode', 'full',
+                    '--outbox', self.temp_path('outbox'),
+                    '--ack-file', self.temp_path('acks.json'),
+                    '-l', self.temp_path('extractor.log')]
+                + list(extractor_args),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=60).returncode
+
+    def log_lines(self, log_file_pattern):
+        # of the one log file matching the pattern
+        (log_file_name,) = glob.glob(self.temp_path(log_file_pattern))
+        with open(log_file_name, encoding='utf-8') as log_file:
+            return log_file.read().splitlines()
+
+    def two_ports_with_mtrs(self):
+        return [
+                self.port_with_mtr(name, mtr_id)
+                for (name, mtr_id) in [('ttyMTR1', 101), ('ttyMTR2', 102)]]
+
+    def test_one_log_file_per_mtr(self):
+        self.assertEqual(self.run_extractor(self.two_ports_with_mtrs()), 0)
+        for mtr_id in (101, 102):
+            log_lines = self.log_lines('mtr-*-%d.log' % mtr_id)
+            self.assertEqual(len(log_lines), 3)
+            self.assertTrue(all(
+                    '"%d"' % mtr_id in log_line for log_line in log_lines))
+        self.assertEqual(len(os.listdir(self.upload_dir)), 2)
+
+    def test_glob_pattern(self):
+        ports = self.two_ports_with_mtrs()
+        # a port matching the pattern and also given is extracted once
+        self.assertEqual(
+                self.run_extractor(
+                    [self.temp_path('ttyMTR*'), ports[0]],
+                    '-f', self.temp_path('mtr-{mtr_id}.log')),
+                0)
+        self.assertEqual(len(self.log_lines('mtr-101.log')), 3)
+        self.assertEqual(len(self.log_lines('mtr-102.log')), 3)
+        self.assertEqual(
+                len([line
+                     for line in self.log_lines('extractor.log')
+                     if "Wrote log file" in line]),
+                2)
+
+    def test_unresponsive_port(self):
+        ports = [self.port_with_mtr('ttyMTR1', 101), self.port('ttyMTR2')[0]]
+        self.assertEqual(self.run_extractor(ports), 100)
+        # the other MTR is still extracted
+        self.assertEqual(len(self.log_lines('mtr-*-101.log')), 3)
+
+    def test_failed_extraction(self):
+        # the log file of MTR 102 cannot be written
+        os.mkdir(self.temp_path('101'))
+        self.assertEqual(
+                self.run_extractor(
+                    self.two_ports_with_mtrs(),
+                    '-f', self.temp_path(os.path.join('{mtr_id}', 'mtr.log'))),
+                1)
+        self.assertEqual(
+                len(self.log_lines(os.path.join('101', 'mtr.log'))), 3)
+        self.assertEqual(os.listdir(self.upload_dir), ['mtr.log'])
+
+    def test_state_shared_by_concurrent_extractions(self):
+        ports = self.two_ports_with_mtrs()
+        state_args = [
+                '-i', self.temp_path('state.json'),
+                '--archive', self.temp_path('mtr.archive'),
+                '--result-db', self.temp_path('results.db')]
+        self.assertEqual(
+                self.run_extractor(
+                    ports, '-f', self.temp_path('mtr-{mtr_id}-1.log'),
+                    *state_args),
+                0)
+        with open(self.temp_path('state.json')) as state_file:
+            self.assertEqual(json.load(state_file), {'101': 3, '102': 3})
+        archive = mtrarchive.MtrArchive(
+                self.temp_path('mtr.archive'), read_only=True)
+        self.assertEqual(
+                [[msg.packet_num() for msg in archive.by_mtr_id(mtr_id)]
+                 for mtr_id in (101, 102)],
+                [[1, 2, 3], [1, 2, 3]])
+        # nothing new to spool the next time
+        self.assertEqual(
+                self.run_extractor(
+                    ports, '-f', self.temp_path('mtr-{mtr_id}-2.log'),
+                    *state_args),
+                0)
+        for mtr_id in (101, 102):
+            self.assertEqual(self.log_lines('mtr-%d-2.log' % mtr_id), [])
+        self.assertEqual(
+                len(mtrarchive.MtrArchive(
+                    self.temp_path('mtr.archive'), read_only=True)),
+                6)
+
+    def test_result_db_shared_by_concurrent_extractions(self):
+        # each spool takes longer than SQLite's default 5 second timeout
+        ports = [
+                self.port_with_mtr(
+                    name, mtr_id, num_messages=12, message_interval_secs=0.5)
+                for (name, mtr_id) in [('ttyMTR1', 101), ('ttyMTR2', 102)]]
+        result_db = self.temp_path('results.db')
+        self.assertEqual(
+                self.run_extractor(ports, '--result-db', result_db), 0)
+        result_store = mtrdb.MtrResultStore(result_db)
+        self.addCleanup(result_store.close)
+        self.assertEqual(
+                sorted(
+                    (row['mtr_id'], row['packet_num'])
+                    for row in result_store.by_card_id(66308)),
+                [(mtr_id, package_num)
+                 for mtr_id in (101, 102)
+                 for package_num in range(1, 13)])
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.device_path = os.path.join(self.temp_dir.name, 'ttyMTR')
+        self.upload_dir = os.path.join(self.temp_dir.name, 'uploads')
+        os.mkdir(self.upload_dir)
+        self.outbox_dir = os.path.join(self.temp_dir.name, 'outbox')
+        self.log_file_name = os.path.join(self.temp_dir.name, 'extractor.log')
+        (self.pty_master, self.pty_slave) = os.openpty()
+        self.addCleanup(os.close, self.pty_slave)
+        self.addCleanup(os.close, self.pty_master)
+        self.extractor = subprocess.Popen(
+                [sys.executable, EXTRACTOR, '--daemon',
+                    '-p', self.device_path,
+                    '-f', os.path.join(
+                        self.temp_dir.name, 'mtr-{mtr_id}.log'),
+                    '-d', 'local', self.upload_dir,
+                    '--upload-mode', 'full',
+                    '--outbox', self.outbox_dir,
+                    '--ack-file', os.path.join(
+                        self.temp_dir.name, 'acks.json'),
+                    '-l', self.log_file_name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        self.addCleanup(self.extractor.wait)
+        self.addCleanup(self.extractor.kill)
+
+    def connect_mtr(self, mtr_id):
+        mtr = FakeMtr(self.pty_master, mtr_id, num_messages=3)
+        self.addCleanup(mtr.stop)
+        # like the symlink to the device node created by udev
+        os.symlink(os.ttyname(self.pty_slave), self.device_path)
+        return mtr
+
+    def disconnect_mtr(self, mtr):
+        os.remove(self.device_path)
+        mtr.stop()
+
+    def log_lines_containing(self, text):
+        try:
+            with open(self.log_file_name, encoding='utf-8') as log_file:
+                return [line for line in log_file if text in line]
+        except FileNotFoundError:
+            return []
+
+    def wait_for_log_lines(self, text, num_lines, timeout_secs=20):
+        deadline = time.monotonic() + timeout_secs
+        while len(self.log_lines_containing(text)) < num_lines:
+            self.assertIsNone(self.extractor.poll(), "extractor exited")
+            self.assertLess(
+                    time.monotonic(), deadline,
+                    "no %d log lines containing %r" % (num_lines, text))
+            time.sleep(0.05)
+
+    def assert_extracted(self, mtr_id, num_extractions):
+        # the uploads have finished when the extractor waits for the MTR to
+        # be disconnected
+        self.wait_for_log_lines(
+                "Waiting for MTR to be disconnected", num_extractions)
+        log_file_name = os.path.join(
+                self.temp_dir.name, 'mtr-%d.log' % mtr_id)
+        with open(log_file_name, encoding='utf-8') as log_file:
+            self.assertEqual(len(log_file.read().splitlines()), 3)
+        self.assertEqual(
+                len(self.log_lines_containing(
+                    "Added %s to upload outbox" % log_file_name)),
+                1)
+        self.assertTrue(
+                os.path.exists(os.path.join(
+                    self.upload_dir, os.path.basename(log_file_name))))
+        # uploaded entries are removed from the outbox
+        self.assertEqual(
+                glob.glob(os.path.join(self.outbox_dir, '*.json')), [])
+
+    def test_extract_reconnected_mtrs(self):
+        mtr = self.connect_mtr(101)
+        self.assert_extracted(101, 1)
+        self.disconnect_mtr(mtr)
+        self.wait_for_log_lines("MTR disconnected", 1)
+        self.connect_mtr(102)
+        self.assert_extracted(102, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
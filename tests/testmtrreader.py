@@ -30,10 +30,16 @@ class MtrStatusBytesBuilder():
             self,
             mtr_id,
             current_datetime=datetime.now(),
-            battery_status=0):
+            battery_status=0,
+            recent_package_num=0,
+            oldest_package_num=1,
+            session_start_package_nums=[]):
         self._mtr_id = mtr_id
         self._current_datetime = current_datetime
         self._battery_status = battery_status
+        self._recent_package_num = recent_package_num
+        self._oldest_package_num = oldest_package_num
+        self._session_start_package_nums = session_start_package_nums
 
     @property
     def mtr_id(self):
@@ -59,6 +65,30 @@ class MtrStatusBytesBuilder():
     def battery_status(self, battery_status):
         self._battery_status = battery_status
 
+    @property
+    def recent_package_num(self):
+        return self._recent_package_num
+
+    @recent_package_num.setter
+    def recent_package_num(self, recent_package_num):
+        self._recent_package_num = recent_package_num
+
+    @property
+    def oldest_package_num(self):
+        return self._oldest_package_num
+
+    @oldest_package_num.setter
+    def oldest_package_num(self, oldest_package_num):
+        self._oldest_package_num = oldest_package_num
+
+    @property
+    def session_start_package_nums(self):
+        return self._session_start_package_nums
+
+    @session_start_package_nums.setter
+    def session_start_package_nums(self, session_start_package_nums):
+        self._session_start_package_nums = session_start_package_nums
+
     def to_bytes(self):
         data = bytearray(b'\xFF\xFF\xFF\xFF')  # preamble
         data.append(55)
@@ -72,16 +102,17 @@ class MtrStatusBytesBuilder():
         data.append(self._current_datetime.second)
         data.extend((0).to_bytes(2, 'little'))  # timestamp-ms
         data.append(self._battery_status % 256)  # battery status
-        data.extend((0).to_bytes(4, 'little'))  # recent package num (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # oldest package num (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # current session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 1 session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 2 session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 3 session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 4 session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 5 session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 6 session start (n/a)
-        data.extend((0).to_bytes(4, 'little'))  # prev 7 session start (n/a)
+        data.extend(self._recent_package_num.to_bytes(4, 'little'))
+        data.extend(self._oldest_package_num.to_bytes(4, 'little'))
+        # current session start followed by previous 1-7 session starts
+        num_session_starts_missing = max(
+                0, 8 - len(self._session_start_package_nums))
+        session_start_package_nums_exact_length = (
+                self._session_start_package_nums[0:8]
+                + num_session_starts_missing * [0])
+        for session_start_package_num in (
+                session_start_package_nums_exact_length):
+            data.extend(session_start_package_num.to_bytes(4, 'little'))
         data.append(sum(data) % 256)  # checksum
         data.append(0)  # 0-filler
         return data
@@ -181,6 +212,19 @@ class MtrDataBytesBuilder():
         return data
 
 
+# Data message for tests storing and looking up messages
+def data_message(
+        mtr_id=1, package_num=1, card_id=66308,
+        splits=[(0, 0), (31, 60), (32, 120), (249, 180)],
+        datetime_read=datetime(2019, 5, 17, 13, 27, 41)):
+    return mtrreader.MtrDataMessage(MtrDataBytesBuilder(
+            mtr_id=mtr_id,
+            card_id=card_id,
+            splits=splits,
+            datetime_read=datetime_read,
+            package_number=package_num).to_bytes())
+
+
 class TestMtrReader(unittest.TestCase):
 
     def setUp(self):
@@ -203,6 +247,10 @@ class TestMtrReader(unittest.TestCase):
         self.mtr_reader.send_spool_all_command()
         self.assertEqual(self.serial_loop.read(3), b'/SA')
 
+    def test_send_spool_from_command(self):
+        self.mtr_reader.send_spool_from_command(258)
+        self.assertEqual(self.serial_loop.read(7), b'/SB\x02\x01\x00\x00')
+
     def test_receive_none(self):
         self.mtr_reader.send_spool_all_command()
         self.fake_mtr.send_message(bytes())
@@ -223,6 +271,56 @@ class TestMtrReader(unittest.TestCase):
         data_messages = self.mtr_reader.receive()
         self.assertEqual(len(data_messages), 2)
 
+    def test_spool_all_receive_many(self):
+        self.mtr_reader.send_spool_all_command()
+        for package_number in range(1, 11):
+            self.data_bytes_builder.package_number = package_number
+            self.fake_mtr.send_message(self.data_bytes_builder.to_bytes())
+        data_messages = self.mtr_reader.receive()
+        self.assertEqual(
+                [msg.packet_num() for msg in data_messages],
+                list(range(1, 11)))
+
+    def test_receive_incomplete_message(self):
+        self.mtr_reader.send_spool_all_command()
+        self.fake_mtr.send_message(self.data_bytes_builder.to_bytes())
+        self.fake_mtr.send_message(self.data_bytes_builder.to_bytes()[:100])
+        data_messages = self.mtr_reader.receive()
+        self.assertEqual(len(data_messages), 1)
+
+    def test_receive_returns_when_expected_num_messages_received(self):
+        self.mtr_reader.send_status_command()
+        self.fake_mtr.send_message(self.status_bytes_builder.to_bytes())
+        start = datetime.now()
+        messages = self.mtr_reader.receive(expected_num_messages=1)
+        self.assertEqual(len(messages), 1)
+        self.assertLess(datetime.now() - start, timedelta(seconds=0.5))
+
+    def test_receive_returns_when_last_package_received(self):
+        self.mtr_reader.send_spool_all_command()
+        for package_number in range(1, 4):
+            self.data_bytes_builder.package_number = package_number
+            self.fake_mtr.send_message(self.data_bytes_builder.to_bytes())
+        start = datetime.now()
+        messages = self.mtr_reader.receive(last_package_num=3)
+        self.assertEqual([msg.packet_num() for msg in messages], [1, 2, 3])
+        self.assertLess(datetime.now() - start, timedelta(seconds=0.5))
+
+    def test_receive_times_out_if_last_package_missing(self):
+        self.mtr_reader.send_spool_all_command()
+        self.fake_mtr.send_message(self.data_bytes_builder.to_bytes())
+        messages = self.mtr_reader.receive(last_package_num=2)
+        self.assertEqual(len(messages), 1)
+
+    def test_iter_messages_yields_before_timeout(self):
+        self.mtr_reader.send_spool_all_command()
+        self.fake_mtr.send_message(self.data_bytes_builder.to_bytes())
+        start = datetime.now()
+        data_messages = self.mtr_reader.iter_messages()
+        self.assertEqual(next(data_messages).packet_num(), 1)
+        self.assertLess(datetime.now() - start, timedelta(seconds=0.5))
+        self.assertEqual(list(data_messages), [])
+
     def test_receive_status(self):
         self.mtr_reader.send_status_command()
         self.status_bytes_builder.mtr_id = 2
@@ -231,6 +329,90 @@ class TestMtrReader(unittest.TestCase):
         self.assertEqual(status_message.mtr_id(), 2)
 
 
+class TestMtrDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = mtrreader.MtrDecoder()
+        self.data_bytes_builder = MtrDataBytesBuilder(
+                mtr_id=1,
+                card_id=546,
+                splits=[(0, 0), (249, 60)],
+                datetime_read=datetime.now(),
+                package_number=1)
+
+    def test_feed_whole_messages(self):
+        data = self.data_bytes_builder.to_bytes()
+        self.data_bytes_builder.package_number = 2
+        data.extend(self.data_bytes_builder.to_bytes())
+        messages = self.decoder.feed(data)
+        self.assertEqual([msg.packet_num() for msg in messages], [1, 2])
+        self.assertFalse(self.decoder.has_partial_message())
+
+    def test_feed_byte_by_byte(self):
+        data = self.data_bytes_builder.to_bytes()
+        messages = []
+        for i in range(len(data)):
+            messages.extend(self.decoder.feed(data[i:i+1]))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].message_bytes, data)
+
+    def test_feed_message_split_in_preamble(self):
+        data = self.data_bytes_builder.to_bytes()
+        self.assertEqual(self.decoder.feed(b'\x00\x01' + data[:2]), [])
+        messages = self.decoder.feed(data[2:])
+        self.assertEqual(len(messages), 1)
+
+    def test_partial_message_kept_between_feeds(self):
+        data = self.data_bytes_builder.to_bytes()
+        self.assertEqual(self.decoder.feed(data[:100]), [])
+        self.assertTrue(self.decoder.has_partial_message())
+        messages = self.decoder.feed(data[100:])
+        self.assertEqual(len(messages), 1)
+        self.assertFalse(self.decoder.has_partial_message())
+
+    def test_skips_bytes_before_preamble(self):
+        data = b'garbage' + self.data_bytes_builder.to_bytes()
+        messages = self.decoder.feed(data)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].card_id(), 546)
+
+    def test_skips_message_with_incorrect_checksum(self):
+        bad_data = self.data_bytes_builder.to_bytes()
+        bad_data[-2] = (bad_data[-2] + 1) % 256
+        self.data_bytes_builder.package_number = 2
+        data = bad_data + self.data_bytes_builder.to_bytes()
+        messages = self.decoder.feed(data)
+        self.assertEqual([msg.packet_num() for msg in messages], [2])
+
+    def test_skips_too_short_message(self):
+        short_data = self.data_bytes_builder.to_bytes()[:34]
+        short_data[4] = 30  # package size
+        data = short_data + self.data_bytes_builder.to_bytes()
+        messages = self.decoder.feed(data)
+        self.assertEqual(len(messages), 1)
+
+        # in the middle of the buffer, with the checksum byte (of the next
+        # package) matching the short package and the bytes following it
+        previous_data = self.data_bytes_builder.to_bytes()
+        self.data_bytes_builder.package_number = 2
+        next_data = self.data_bytes_builder.to_bytes()
+        data = short_data + next_data
+        short_data[20] = (
+                short_data[20] + data[232]
+                - mtrreader.checksum_of(data[:232])) % 256
+        data = previous_data + short_data + next_data
+        self.assertTrue(mtrreader.MtrDataMessage(
+            data, mtrreader.MtrDataMessage.NUMBYTES).is_checksum_valid())
+        messages = self.decoder.feed(data)
+        self.assertEqual([msg.packet_num() for msg in messages], [1, 2])
+
+    def test_status_message(self):
+        data = MtrStatusBytesBuilder(mtr_id=7).to_bytes()
+        messages = self.decoder.feed(data)
+        self.assertIsInstance(messages[0], mtrreader.MtrStatusMessage)
+        self.assertEqual(messages[0].mtr_id(), 7)
+
+
 class TestMtrStatusMessage(unittest.TestCase):
 
     def setUp(self):
@@ -258,6 +440,52 @@ class TestMtrStatusMessage(unittest.TestCase):
         msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
         self.assertEqual(msg.battery_status(), 1)
 
+    def test_package_nums(self):
+        self.bytes_builder.recent_package_num = 4660
+        self.bytes_builder.oldest_package_num = 301
+        msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.recent_package_num(), 4660)
+        self.assertEqual(msg.oldest_package_num(), 301)
+
+    def test_session_start_package_nums(self):
+        self.bytes_builder.session_start_package_nums = [
+                80, 70, 60, 50, 40, 30, 20, 10]
+        msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.current_session_start_package_num(), 80)
+        self.assertEqual(msg.previous_session_start_package_num(1), 70)
+        self.assertEqual(msg.previous_session_start_package_num(7), 10)
+        with self.assertRaises(ValueError):
+            msg.previous_session_start_package_num(8)
+
+    def test_num_packages(self):
+        self.bytes_builder.recent_package_num = 100
+        self.bytes_builder.oldest_package_num = 11
+        msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.num_packages(), 90)
+
+    def test_num_packages_empty(self):
+        self.bytes_builder.recent_package_num = 0
+        self.bytes_builder.oldest_package_num = 1
+        msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.num_packages(), 0)
+        self.assertEqual(msg.sessions(), [])
+
+    def test_sessions(self):
+        self.bytes_builder.recent_package_num = 100
+        self.bytes_builder.oldest_package_num = 1
+        self.bytes_builder.session_start_package_nums = [61, 31, 1]
+        msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(
+                msg.sessions(),
+                [range(61, 101), range(31, 61), range(1, 31)])
+
+    def test_sessions_partially_overwritten(self):
+        self.bytes_builder.recent_package_num = 100
+        self.bytes_builder.oldest_package_num = 41
+        self.bytes_builder.session_start_package_nums = [61, 31, 1]
+        msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.sessions(), [range(61, 101), range(41, 61)])
+
     def test_checksum_valid(self):
         msg = mtrreader.MtrStatusMessage(self.bytes_builder.to_bytes())
         self.assertTrue(msg.is_checksum_valid())
@@ -318,6 +546,16 @@ class TestMtrDataMessage(unittest.TestCase):
         expected_splits = input_splits + 45 * [(0, 0)]
         self.assertEqual(output_splits, expected_splits)
 
+    def test_num_splits(self):
+        self.bytes_builder.splits = [(0, 0), (31, 60), (0, 0), (33, 256)]
+        msg = mtrreader.MtrDataMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.num_splits(), 4)
+
+    def test_num_splits_none_used(self):
+        self.bytes_builder.splits = [(0, 0)]
+        msg = mtrreader.MtrDataMessage(self.bytes_builder.to_bytes())
+        self.assertEqual(msg.num_splits(), 0)
+
     def test_ascii_string(self):
         self.bytes_builder.ascii_string = "This is a test"
         msg = mtrreader.MtrDataMessage(self.bytes_builder.to_bytes())
@@ -427,6 +665,25 @@ class TestMtrLogFormatter(unittest.TestCase):
                 mtrreader.MtrDataMessage(new_bytes), self.datetime_read)
         self.assertEqual(line, expected_line)
 
+    def test_splits_zero_between_used(self):
+        self.default_bytes_builder.splits = [(0, 0), (0, 0), (31, 1)]
+        new_bytes = self.default_bytes_builder.to_bytes()
+        expected_line = (
+                self.default_line[0:86]
+                + '000,00000,000,00000,031,00001,'
+                + self.default_line[116:])
+        line = mtrlog.MtrLogFormatter().format(
+                mtrreader.MtrDataMessage(new_bytes), self.datetime_read)
+        self.assertEqual(line, expected_line)
+
+    def test_datetime_extracted(self):
+        datetime_extracted = datetime(2019, 5, 17, 13, 27, 41, 500)
+        line = mtrlog.MtrLogFormatter().format(
+                mtrreader.MtrDataMessage(
+                    self.default_bytes_builder.to_bytes()),
+                datetime_extracted)
+        self.assertEqual(line[21:45], '"17.05.19 13:27:41.000",')
+
     def test_multiple(self):
         expected_lines = []
 
@@ -446,6 +703,101 @@ class TestMtrLogFormatter(unittest.TestCase):
 
         self.assertEqual(lines, expected_lines)
 
+    def test_iter_format(self):
+        messages = (
+                mtrreader.MtrDataMessage(self.default_bytes_builder.to_bytes())
+                for i in range(2))
+        lines = mtrlog.MtrLogFormatter().iter_format(
+                messages, self.datetime_read)
+        self.assertEqual(next(lines), self.default_line)
+        self.assertEqual(next(lines), self.default_line)
+        with self.assertRaises(StopIteration):
+            next(lines)
+
+    def test_mtr_id_and_packet_num_of(self):
+        self.default_bytes_builder.mtr_id = 258
+        self.default_bytes_builder.package_number = 4660
+        line = mtrlog.MtrLogFormatter().format(
+                mtrreader.MtrDataMessage(
+                    self.default_bytes_builder.to_bytes()),
+                self.datetime_read)
+        self.assertEqual(
+                mtrlog.mtr_id_and_packet_num_of(line + '\n'), (258, 4660))
+
+    def test_mtr_id_and_packet_num_of_other_line(self):
+        self.assertIsNone(mtrlog.mtr_id_and_packet_num_of('not a log line'))
+
+
+class TestMtrLogParser(unittest.TestCase):
+
+    def setUp(self):
+        self.bytes_builder = MtrDataBytesBuilder(
+                mtr_id=33145,
+                card_id=131586,
+                splits=[(0, 0), (31, 60), (249, 4660)],
+                datetime_read=datetime(2019, 5, 17, 13, 27, 41),
+                package_number=1234567)
+        self.parser = mtrlog.MtrLogParser()
+
+    def log_line(self, message_bytes):
+        return mtrlog.MtrLogFormatter().format(
+                mtrreader.MtrDataMessage(message_bytes), datetime.now())
+
+    def test_parse_is_reverse_of_format(self):
+        message_bytes = self.bytes_builder.to_bytes()
+        msg = self.parser.parse(self.log_line(message_bytes) + '\n')
+        self.assertEqual(bytes(msg.message_bytes), bytes(message_bytes))
+        self.assertTrue(msg.is_checksum_valid())
+
+    def test_parse_all_splits(self):
+        self.bytes_builder.splits = [
+                (control_code, 65535 - control_code)
+                for control_code in range(50)]
+        message_bytes = self.bytes_builder.to_bytes()
+        msg = self.parser.parse(self.log_line(message_bytes))
+        self.assertEqual(msg.splits(), self.bytes_builder.splits)
+        self.assertEqual(bytes(msg.message_bytes), bytes(message_bytes))
+
+    def test_parse_no_splits(self):
+        self.bytes_builder.splits = []
+        message_bytes = self.bytes_builder.to_bytes()
+        msg = self.parser.parse(self.log_line(message_bytes))
+        self.assertEqual(bytes(msg.message_bytes), bytes(message_bytes))
+
+    def test_parse_unused_split_between_used_splits(self):
+        self.bytes_builder.splits = [(31, 60), (0, 0), (249, 4660)]
+        message_bytes = self.bytes_builder.to_bytes()
+        msg = self.parser.parse(self.log_line(message_bytes))
+        self.assertEqual(bytes(msg.message_bytes), bytes(message_bytes))
+
+    def test_parse_other_line(self):
+        with self.assertRaises(ValueError):
+            self.parser.parse('not a log line')
+
+    def test_parse_invalid_number(self):
+        log_line = self.log_line(self.bytes_builder.to_bytes())
+        with self.assertRaises(ValueError):
+            self.parser.parse(log_line.replace(',031,', ',X31,'))
+
+    def test_iter_parse_skips_other_lines(self):
+        log_line = self.log_line(self.bytes_builder.to_bytes())
+        messages = list(self.parser.iter_parse(
+            [log_line, 'not a log line', log_line]))
+        self.assertEqual(len(messages), 2)
+
+    def test_parse_frames(self):
+        log_lines = []
+        for package_num in (1, 2):
+            self.bytes_builder.package_number = package_num
+            log_lines.append(self.log_line(self.bytes_builder.to_bytes()))
+        frames = self.parser.parse_frames(
+                [log_lines[0], 'not a log line', log_lines[1]])
+        self.assertEqual(len(frames), 2 * mtrreader.MtrDataMessage.NUMBYTES)
+        self.assertEqual(
+                [msg.packet_num() for msg in mtrreader.MtrDecoder().feed(
+                    bytes(frames))],
+                [1, 2])
+
 
 initialize_logging(log_dir='testoutput', log_file='testlog.log')
 
@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+
+import mtrreader
+import mtrstate
+from tests.testmtrreader import MtrDataBytesBuilder, MtrStatusBytesBuilder
+
+
+class TestPackageNumberStore(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.state_filename = os.path.join(self.state_dir.name, 'state.json')
+        self.store = mtrstate.PackageNumberStore(self.state_filename)
+        self.status_bytes_builder = MtrStatusBytesBuilder(
+                mtr_id=1, recent_package_num=200, oldest_package_num=1)
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def data_messages(self, mtr_id, package_nums):
+        messages = []
+        for package_num in package_nums:
+            message_bytes = MtrDataBytesBuilder(
+                    mtr_id=mtr_id,
+                    card_id=1,
+                    package_number=package_num).to_bytes()
+            messages.append(mtrreader.MtrDataMessage(message_bytes))
+        return messages
+
+    def status_message(self):
+        return mtrreader.MtrStatusMessage(self.status_bytes_builder.to_bytes())
+
+    def test_no_state_file(self):
+        self.assertEqual(self.store.last_package_nums, {})
+
+    def test_record_keeps_highest_package_num_per_mtr(self):
+        self.store.record(self.data_messages(1, [3, 5, 4]))
+        self.store.record(self.data_messages(2, [7]))
+        self.assertEqual(self.store.last_package_num(1), 5)
+        self.assertEqual(self.store.last_package_num(2), 7)
+
+    def test_track_records_handled_messages(self):
+        data_messages = self.store.track(self.data_messages(1, [3, 4]))
+        self.assertEqual(next(data_messages).packet_num(), 3)
+        self.assertIsNone(self.store.last_package_num(1))
+        self.assertEqual(next(data_messages).packet_num(), 4)
+        self.assertEqual(self.store.last_package_num(1), 3)
+        self.assertEqual(list(data_messages), [])
+        self.assertEqual(self.store.last_package_num(1), 4)
+
+    def test_save_and_load(self):
+        self.store.record(self.data_messages(1, [42]))
+        self.store.save()
+        loaded_store = mtrstate.PackageNumberStore(self.state_filename)
+        self.assertEqual(loaded_store.last_package_num(1), 42)
+
+    def test_corrupt_state_file_is_ignored(self):
+        with open(self.state_filename, 'w') as state_file:
+            state_file.write('{not json')
+        loaded_store = mtrstate.PackageNumberStore(self.state_filename)
+        self.assertEqual(loaded_store.last_package_nums, {})
+
+    def test_spool_all_for_unknown_mtr(self):
+        self.assertIsNone(
+                self.store.spool_start_package_num(self.status_message()))
+
+    def test_spool_from_next_package(self):
+        self.store.record(self.data_messages(1, [150]))
+        self.assertEqual(
+                self.store.spool_start_package_num(self.status_message()),
+                151)
+
+    def test_spool_nothing_new(self):
+        self.store.record(self.data_messages(1, [200]))
+        self.assertEqual(
+                self.store.spool_start_package_num(self.status_message()),
+                201)
+
+    def test_spool_all_if_last_package_no_longer_in_memory(self):
+        self.status_bytes_builder.oldest_package_num = 100
+        self.store.record(self.data_messages(1, [50]))
+        self.assertIsNone(
+                self.store.spool_start_package_num(self.status_message()))
+
+    def test_spool_all_if_last_package_beyond_recent(self):
+        self.store.record(self.data_messages(1, [300]))
+        self.assertIsNone(
+                self.store.spool_start_package_num(self.status_message()))
+
+    def test_spool_all_if_mtr_is_empty(self):
+        self.status_bytes_builder.recent_package_num = 0
+        self.store.record(self.data_messages(1, [10]))
+        self.assertIsNone(
+                self.store.spool_start_package_num(self.status_message()))
+
+
+class TestAcknowledgedPackageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.state_filename = os.path.join(self.state_dir.name, 'acks.json')
+        self.store = mtrstate.AcknowledgedPackageStore(self.state_filename)
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_no_state_file(self):
+        self.assertFalse(
+                self.store.is_acknowledged(['http://example.org/'], 1, 1))
+
+    def test_acknowledged_per_destination(self):
+        self.store.acknowledge(['http://example.org/'], [(1, 5), (2, 6)])
+        self.assertTrue(
+                self.store.is_acknowledged(['http://example.org/'], 1, 5))
+        self.assertTrue(
+                self.store.is_acknowledged(['http://example.org/'], 2, 6))
+        self.assertFalse(
+                self.store.is_acknowledged(['http://example.org/'], 1, 6))
+        self.assertFalse(
+                self.store.is_acknowledged(['dropbox', 'token'], 1, 5))
+
+    def test_save_and_load(self):
+        self.store.acknowledge(
+                ['dropbox', 'token'], [(1, n) for n in [1, 2, 3, 7, 9, 8]])
+        self.store.save()
+        with open(self.state_filename, 'r') as state_file:
+            self.assertEqual(
+                    json.load(state_file),
+                    {'dropbox token': {'1': [[1, 3], [7, 9]]}})
+        loaded_store = mtrstate.AcknowledgedPackageStore(self.state_filename)
+        self.assertEqual(
+                loaded_store.package_nums,
+                {'dropbox token': {1: {1, 2, 3, 7, 8, 9}}})
+
+    def test_corrupt_state_file_is_ignored(self):
+        with open(self.state_filename, 'w') as state_file:
+            state_file.write('{not json')
+        loaded_store = mtrstate.AcknowledgedPackageStore(self.state_filename)
+        self.assertEqual(loaded_store.package_nums, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,928 @@
+from functools import partial
+from http.server import ThreadingHTTPServer
+import collections
+import gzip
+import hashlib
+import http.client
+import importlib.util
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import dropbox
+import requests
+
+import mtrstate
+import mtrupload
+
+
+def load_devutil_module(name, file_name):
+    spec = importlib.util.spec_from_file_location(
+            name,
+            os.path.join(
+                os.path.dirname(os.path.dirname(__file__)), file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+httpuploadserver = load_devutil_module(
+        'httpuploadserver', 'devutil-httpuploadserver.py')
+
+
+class FailingUploadHTTPRequestHandler(
+        httpuploadserver.UploadHTTPRequestHandler):
+
+    # number of uploads left to fail, shared by all requests
+    num_failures = 0
+    num_failures_lock = threading.Lock()
+
+    def do_POST(self):
+        with self.num_failures_lock:
+            should_fail = FailingUploadHTTPRequestHandler.num_failures > 0
+            if should_fail:
+                FailingUploadHTTPRequestHandler.num_failures -= 1
+        if not should_fail:
+            super().do_POST()
+            return
+        self.rfile.read(int(self.headers['content-length']))
+        self.send_response(503)
+        self.send_header("Content-Length", str(0))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class KeepAliveUploadHTTPRequestHandler(
+        httpuploadserver.UploadHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # client address and content length of each request, in order
+    client_addresses = []
+    content_lengths = []
+
+    def do_HEAD(self):
+        self.client_addresses.append(self.client_address)
+        super().do_HEAD()
+
+    def do_POST(self):
+        self.client_addresses.append(self.client_address)
+        self.content_lengths.append(int(self.headers['content-length']))
+        super().do_POST()
+
+    def do_PUT(self):
+        self.content_lengths.append(int(self.headers['content-length']))
+        super().do_PUT()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpDestination(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        # threaded to not block on kept alive connections
+        self.server = ThreadingHTTPServer(
+                ('127.0.0.1', 0),
+                partial(
+                    KeepAliveUploadHTTPRequestHandler,
+                    directory=self.work_dir.name))
+        self.server_thread = threading.Thread(
+                target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        KeepAliveUploadHTTPRequestHandler.client_addresses = []
+        KeepAliveUploadHTTPRequestHandler.content_lengths = []
+
+    def tearDown(self):
+        mtrupload.destination_for([self.url]).session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def test_destination_reused(self):
+        self.assertIs(
+                mtrupload.destination_for([self.url]),
+                mtrupload.destination_for([self.url]))
+
+    def test_upload_uses_warmed_up_connection(self):
+        log_file_name = os.path.join(self.work_dir.name, 'mtr.log')
+        with open(log_file_name, 'wb') as f:
+            f.write(b'line 1\n')
+        mtrupload.start_warm_up([self.url]).join()
+        mtrupload.upload_mtr_log_file(log_file_name, [self.url])
+        client_addresses = KeepAliveUploadHTTPRequestHandler.client_addresses
+        self.assertEqual(len(client_addresses), 2)
+        self.assertEqual(client_addresses[0], client_addresses[1])
+
+    def test_warm_up_failure_is_not_raised(self):
+        mtrupload.warm_up(['http://127.0.0.1:1/'])
+
+    def test_gzip_compressed_upload(self):
+        self.assertCompressedUpload('gzip')
+
+    @unittest.skipUnless(
+            mtrupload.is_compression_available('zstd'),
+            "zstandard not installed")
+    def test_zstd_compressed_upload(self):
+        self.assertCompressedUpload('zstd')
+
+    def create_log_file(self, content):
+        log_dir = os.path.join(self.work_dir.name, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        log_file_name = os.path.join(log_dir, 'mtr.log')
+        with open(log_file_name, 'wb') as f:
+            f.write(content)
+        return log_file_name
+
+    def uploaded_content(self, file_name):
+        with open(os.path.join(self.work_dir.name, file_name), 'rb') as f:
+            return f.read()
+
+    def test_resumable_upload(self):
+        content = os.urandom(2500)
+        log_file_name = self.create_log_file(content)
+        mtrupload.HttpDestination(
+                self.url, is_resumable=True, chunk_size=1000).upload(
+                    log_file_name)
+        self.assertEqual(self.uploaded_content('mtr.log'), content)
+        self.assertEqual(
+                KeepAliveUploadHTTPRequestHandler.content_lengths,
+                [1000, 1000, 500])
+        self.assertEqual(
+                [f for f in os.listdir(self.work_dir.name)
+                 if f.endswith('.part')],
+                [])
+
+    def test_resumable_upload_continues_at_received_offset(self):
+        content = os.urandom(2500)
+        log_file_name = self.create_log_file(content)
+        # as left by a connection dropped in the middle of a chunk
+        part_file_name = httpuploadserver.part_file_name_of(
+                os.path.join(self.work_dir.name, 'mtr.log'),
+                hashlib.sha256(content).hexdigest())
+        with open(part_file_name, 'wb') as f:
+            f.write(content[:1200])
+        mtrupload.HttpDestination(
+                self.url, is_resumable=True, chunk_size=1000).upload(
+                    log_file_name)
+        self.assertEqual(self.uploaded_content('mtr.log'), content)
+        self.assertEqual(
+                KeepAliveUploadHTTPRequestHandler.content_lengths,
+                [1000, 300])
+
+    def test_resumable_upload_of_uploaded_file_is_skipped(self):
+        log_file_name = self.create_log_file(b'line 1\n')
+        destination = mtrupload.HttpDestination(self.url, is_resumable=True)
+        destination.upload(log_file_name)
+        destination.upload(log_file_name)
+        self.assertEqual(
+                KeepAliveUploadHTTPRequestHandler.content_lengths, [7])
+
+    def test_resumable_compressed_upload(self):
+        log_file_name = self.create_log_file(b'000,00000,' * 1000)
+        mtrupload.HttpDestination(self.url, is_resumable=True).upload(
+                log_file_name, 'gzip')
+        self.assertEqual(
+                gzip.decompress(self.uploaded_content('mtr.log.gz')),
+                b'000,00000,' * 1000)
+
+    def test_create_resumable_destination(self):
+        destination = mtrupload.create_destination(
+                [self.url, 'resumable', 'chunk_size=1000'])
+        self.assertTrue(destination.is_resumable)
+        self.assertEqual(destination.chunk_size, 1000)
+
+    def assertCompressedUpload(self, compression):
+        content = b'0,000,00000,' * 1000 + b'\n'
+        log_dir = os.path.join(self.work_dir.name, 'logs')
+        os.makedirs(log_dir)
+        log_file_name = os.path.join(log_dir, 'mtr.log')
+        with open(log_file_name, 'wb') as f:
+            f.write(content)
+        mtrupload.upload_mtr_log_file(
+                log_file_name, [self.url], compression)
+        with open(os.path.join(self.work_dir.name, 'mtr.log'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertLess(
+                KeepAliveUploadHTTPRequestHandler.content_lengths[-1],
+                len(content) / 10)
+
+
+class TestDestinations(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_split_timeout(self):
+        self.assertEqual(
+                mtrupload.split_timeout(['local', '/mnt', 'timeout=2.5']),
+                (['local', '/mnt'], 2.5))
+        self.assertEqual(
+                mtrupload.split_timeout(['http://example.org/']),
+                (['http://example.org/'], None))
+
+    def test_destination_name_of(self):
+        self.assertEqual(
+                mtrupload.destination_name_of(['local', '/mnt', 'timeout=5']),
+                'local /mnt')
+
+    def test_create_http_destination(self):
+        destination = mtrupload.create_destination(
+                ['http://example.org/', 'timeout=5'])
+        self.assertIsInstance(destination, mtrupload.HttpDestination)
+        self.assertEqual(destination.url, 'http://example.org/')
+        self.assertEqual(destination.timeout_secs, 5)
+
+    def test_create_local_destination(self):
+        destination = mtrupload.create_destination(['local', '/mnt'])
+        self.assertIsInstance(destination, mtrupload.LocalDestination)
+        self.assertEqual(destination.directory, '/mnt')
+
+    def test_local_upload(self):
+        log_file_name = os.path.join(self.work_dir.name, 'mtr.log')
+        with open(log_file_name, 'wb') as f:
+            f.write(b'line 1\n')
+        upload_dir = os.path.join(self.work_dir.name, 'usb')
+        os.makedirs(upload_dir)
+        destination = mtrupload.LocalDestination(upload_dir)
+        destination.warm_up()
+        destination.upload(log_file_name)
+        destination.upload(log_file_name, 'gzip')
+        self.assertEqual(
+                sorted(os.listdir(upload_dir)), ['mtr.log', 'mtr.log.gz'])
+        with gzip.open(os.path.join(upload_dir, 'mtr.log.gz')) as f:
+            self.assertEqual(f.read(), b'line 1\n')
+
+    def test_refused_http_upload_is_permanent_failure(self):
+        response = requests.Response()
+        response.url = 'http://example.org/'
+        response.status_code = 403
+        with self.assertRaises(mtrupload.PermanentUploadError):
+            mtrupload.raise_for_status(response)
+        # also the response to a truncated upload
+        response.status_code = 400
+        with self.assertRaises(requests.HTTPError):
+            mtrupload.raise_for_status(response)
+
+    def test_local_warm_up_fails_without_directory(self):
+        destination = mtrupload.LocalDestination(
+                os.path.join(self.work_dir.name, 'missing'))
+        with self.assertRaises(FileNotFoundError):
+            destination.warm_up()
+
+
+class TestHttpUploadServer(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.server = ThreadingHTTPServer(
+                ('127.0.0.1', 0),
+                partial(
+                    KeepAliveUploadHTTPRequestHandler,
+                    directory=self.work_dir.name))
+        self.server_thread = threading.Thread(
+                target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.connection = http.client.HTTPConnection(
+                '127.0.0.1', self.server.server_port, timeout=5)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def multipart_body(self, content):
+        return (b'--XyZ\r\n'
+                b'Content-Disposition: form-data; name="file"; '
+                b'filename="mtr.log"\r\n\r\n'
+                + content
+                + b'\r\n--XyZ--\r\n')
+
+    def post(self, body, content_length):
+        self.connection.putrequest('POST', '/')
+        self.connection.putheader(
+                'Content-Type', 'multipart/form-data; boundary=XyZ')
+        self.connection.putheader('Content-Length', str(content_length))
+        self.connection.endheaders(body)
+
+    def test_post_with_boundary_like_content(self):
+        # large enough to span several reads
+        content = (b'\r\n--XyX-' + os.urandom(1000)) * 200
+        body = self.multipart_body(content)
+        self.post(body, len(body))
+        self.assertEqual(self.connection.getresponse().status, 200)
+        with open(os.path.join(self.work_dir.name, 'mtr.log'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_truncated_post_leaves_no_file(self):
+        body = self.multipart_body(b'line 1\n')
+        self.post(body[:-20], len(body))
+        self.connection.sock.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.connection.getresponse().status, 400)
+        self.assertEqual(os.listdir(self.work_dir.name), [])
+
+    def put(self, content_range, sha256, chunk):
+        self.connection.request(
+                'PUT', '/mtr.log', body=chunk,
+                headers={
+                    'Content-Range': content_range,
+                    'Upload-Sha256': sha256})
+        response = self.connection.getresponse()
+        response.read()
+        return response
+
+    def test_put_at_wrong_offset_is_refused(self):
+        sha256 = hashlib.sha256(b'0123456789').hexdigest()
+        response = self.put('bytes 5-9/10', sha256, b'56789')
+        self.assertEqual(response.status, 409)
+        self.assertEqual(response.headers['Upload-Offset'], '0')
+
+    def test_put_not_matching_hash_is_dropped(self):
+        sha256 = hashlib.sha256(b'0123456789').hexdigest()
+        self.assertEqual(
+                self.put('bytes 0-4/10', sha256, b'01234').status, 200)
+        self.assertEqual(
+                self.put('bytes 5-9/10', sha256, b'xxxxx').status, 400)
+        self.assertEqual(os.listdir(self.work_dir.name), [])
+
+
+class TestUploadCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.upload_dir = os.path.join(self.work_dir.name, 'uploaded')
+        os.makedirs(self.upload_dir)
+        self.event_log_file_name = os.path.join(
+                self.work_dir.name, 'event.log')
+        self.server = httpuploadserver.CollectorHTTPServer(
+                ('127.0.0.1', 0),
+                partial(
+                    KeepAliveUploadHTTPRequestHandler,
+                    directory=self.upload_dir))
+        self.server.collector = httpuploadserver.UploadCollector(
+                self.upload_dir,
+                httpuploadserver.EventLog(self.event_log_file_name))
+        self.server_thread = threading.Thread(
+                target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def upload(self, file_name, content, compression=None):
+        log_dir = os.path.join(self.work_dir.name, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        log_file_name = os.path.join(log_dir, file_name)
+        with open(log_file_name, 'wb') as f:
+            f.write(content)
+        destination = mtrupload.HttpDestination(self.url)
+        try:
+            destination.upload(log_file_name, compression)
+        finally:
+            destination.session.close()
+
+    def log_content(self, mtr_id, package_nums):
+        return ''.join(
+                '"M","0","%d","000001",%07d\n' % (mtr_id, package_num)
+                for package_num in package_nums).encode()
+
+    def event_log_content(self):
+        with open(self.event_log_file_name, 'rb') as f:
+            return f.read()
+
+    def test_identical_upload_is_stored_once(self):
+        self.upload('mtr-1.log', self.log_content(1, [1]))
+        self.upload('mtr-2.log', self.log_content(1, [1]))
+        self.assertEqual(os.listdir(self.upload_dir), ['mtr-1.log'])
+
+    def test_uploads_merged_into_event_log(self):
+        self.upload('mtr-1.log', self.log_content(1, [1, 2]))
+        self.upload('mtr-2.log', self.log_content(1, [2, 3]), 'gzip')
+        self.upload('mtr-3.log', self.log_content(2, [1]))
+        self.assertEqual(
+                self.event_log_content(),
+                self.log_content(1, [1, 2, 3]) + self.log_content(2, [1]))
+
+    def test_event_log_loaded_on_start(self):
+        self.upload('mtr-1.log', self.log_content(1, [1, 2]))
+        self.server.collector.event_log = httpuploadserver.EventLog(
+                self.event_log_file_name)
+        self.upload('mtr-2.log', self.log_content(1, [2, 3]))
+        self.assertEqual(
+                self.event_log_content(), self.log_content(1, [1, 2, 3]))
+
+    def test_concurrent_uploads(self):
+        errors = []
+
+        def upload(mtr_id):
+            try:
+                self.upload(
+                        'mtr-%d.log' % mtr_id,
+                        self.log_content(mtr_id, range(1, 101)))
+            except Exception as e:
+                errors.append(e)
+
+        uploaders = [
+                threading.Thread(target=upload, args=(mtr_id,))
+                for mtr_id in range(1, 21)]
+        for uploader in uploaders:
+            uploader.start()
+        for uploader in uploaders:
+            uploader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(os.listdir(self.upload_dir)), 20)
+        self.assertEqual(len(self.event_log_content().splitlines()), 2000)
+
+
+class FakeDropbox:
+    # Local fake of the parts of the Dropbox files API used for uploads
+
+    def __init__(self):
+        self.files = {}
+        self.sessions = {}
+        # names of the API methods called, in order
+        self.calls = []
+        # number of appends to succeed before failing like a dropped
+        # connection, None to never fail
+        self.num_appends_until_failure = None
+
+    def files_get_metadata(self, path):
+        self.calls.append('get_metadata')
+        if path not in self.files:
+            raise dropbox.exceptions.ApiError(
+                    'request-id',
+                    dropbox.files.GetMetadataError.path(
+                        dropbox.files.LookupError.not_found),
+                    None, None)
+        return dropbox.files.FileMetadata(
+                name=path.split('/')[-1],
+                content_hash=mtrupload.dropbox_content_hash(
+                    io.BytesIO(self.files[path])))
+
+    def files_upload(self, f, path):
+        self.calls.append('upload')
+        self.files[path] = f
+
+    def files_upload_session_start(self, f):
+        self.calls.append('start')
+        session_id = 'session-%d' % len(self.sessions)
+        self.sessions[session_id] = bytearray(f)
+        return dropbox.files.UploadSessionStartResult(session_id=session_id)
+
+    def files_upload_session_append_v2(self, f, cursor):
+        self.calls.append('append')
+        if self.num_appends_until_failure == 0:
+            self.num_appends_until_failure = None
+            raise requests.exceptions.ConnectionError("Connection dropped")
+        if self.num_appends_until_failure is not None:
+            self.num_appends_until_failure -= 1
+        correct_offset = len(self.sessions[cursor.session_id])
+        if cursor.offset != correct_offset:
+            raise dropbox.exceptions.ApiError(
+                    'request-id',
+                    dropbox.files.UploadSessionAppendError.incorrect_offset(
+                        dropbox.files.UploadSessionOffsetError(
+                            correct_offset=correct_offset)),
+                    None, None)
+        self.sessions[cursor.session_id] += f
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        self.calls.append('finish')
+        self.files[commit.path] = bytes(self.sessions[cursor.session_id] + f)
+
+
+class TestDropboxDestination(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.destination = mtrupload.DropboxDestination(
+                'token', '/mtr', chunk_size=10)
+        self.destination.dbx = FakeDropbox()
+        self.content = b'0123456789' * 3 + b'01234'
+        self.log_file_name = os.path.join(self.work_dir.name, 'mtr.log')
+        with open(self.log_file_name, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_small_file_single_upload(self):
+        self.destination.chunk_size = 100
+        self.destination.upload(self.log_file_name)
+        self.assertEqual(
+                self.destination.dbx.files['/mtr/mtr.log'], self.content)
+        self.assertEqual(
+                self.destination.dbx.calls, ['get_metadata', 'upload'])
+
+    def test_chunked_upload(self):
+        self.destination.upload(self.log_file_name)
+        self.assertEqual(
+                self.destination.dbx.files['/mtr/mtr.log'], self.content)
+        self.assertEqual(
+                self.destination.dbx.calls,
+                ['get_metadata', 'start', 'append', 'append', 'finish'])
+
+    def test_compressed_upload(self):
+        self.destination.upload(self.log_file_name, 'gzip')
+        self.assertEqual(
+                gzip.decompress(self.destination.dbx.files['/mtr/mtr.log.gz']),
+                self.content)
+
+    def test_identical_file_is_skipped(self):
+        self.destination.upload(self.log_file_name)
+        self.destination.dbx.calls = []
+        self.destination.upload(self.log_file_name)
+        self.assertEqual(self.destination.dbx.calls, ['get_metadata'])
+
+    def test_interrupted_upload_is_resumed(self):
+        resume_state = mtrupload.ResumeState({})
+        self.destination.dbx.num_appends_until_failure = 1
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.destination.upload(
+                    self.log_file_name, resume_state=resume_state)
+        self.assertEqual(resume_state.values['offset'], 20)
+        self.destination.dbx.calls = []
+        self.destination.upload(self.log_file_name, resume_state=resume_state)
+        self.assertEqual(
+                self.destination.dbx.files['/mtr/mtr.log'], self.content)
+        self.assertEqual(
+                self.destination.dbx.calls,
+                ['get_metadata', 'append', 'finish'])
+
+    def test_resume_at_offset_known_by_dropbox(self):
+        resume_state = mtrupload.ResumeState({})
+        self.destination.dbx.num_appends_until_failure = 1
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.destination.upload(
+                    self.log_file_name, resume_state=resume_state)
+        resume_state.values['offset'] = 10
+        with self.assertRaises(dropbox.exceptions.ApiError):
+            self.destination.upload(
+                    self.log_file_name, resume_state=resume_state)
+        self.assertEqual(resume_state.values['offset'], 20)
+        self.destination.upload(self.log_file_name, resume_state=resume_state)
+        self.assertEqual(
+                self.destination.dbx.files['/mtr/mtr.log'], self.content)
+
+    def test_changed_content_starts_new_session(self):
+        resume_state = mtrupload.ResumeState({})
+        self.destination.dbx.num_appends_until_failure = 1
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.destination.upload(
+                    self.log_file_name, resume_state=resume_state)
+        with open(self.log_file_name, 'ab') as f:
+            f.write(b'56789')
+        self.destination.upload(self.log_file_name, resume_state=resume_state)
+        self.assertEqual(
+                self.destination.dbx.files['/mtr/mtr.log'],
+                self.content + b'56789')
+        self.assertEqual(len(self.destination.dbx.sessions), 2)
+
+    def test_outbox_keeps_resume_state(self):
+        destination_args = ['dropbox', 'resume-test-token']
+        mtrupload.destinations[tuple(destination_args)] = self.destination
+        self.addCleanup(
+                mtrupload.destinations.pop, tuple(destination_args))
+        self.destination.dbx.num_appends_until_failure = 1
+        outbox_dir = os.path.join(self.work_dir.name, 'outbox')
+        outbox = mtrupload.UploadOutbox(
+                outbox_dir, initial_retry_delay_secs=0.05)
+        entry_file_name = outbox.add(self.log_file_name, destination_args)
+        outbox.attempt(entry_file_name)
+        self.assertEqual(
+                outbox.read_entry(entry_file_name)['resume']['offset'], 20)
+        outbox.start()
+        self.assertTrue(outbox.wait_until_empty(5))
+        outbox.stop()
+        self.assertEqual(
+                self.destination.dbx.files['/mtr/mtr.log'], self.content)
+        self.assertEqual(self.destination.dbx.calls.count('start'), 1)
+
+
+class TestCompress(unittest.TestCase):
+
+    def test_gzip_round_trip(self):
+        self.assertEqual(
+                gzip.decompress(mtrupload.compress(b'000,00000,', 'gzip')),
+                b'000,00000,')
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            mtrupload.compress(b'', 'lzma')
+
+
+class TestUploadOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.upload_dir = os.path.join(self.work_dir.name, 'uploaded')
+        os.makedirs(self.upload_dir)
+        self.outbox_dir = os.path.join(self.work_dir.name, 'outbox')
+        self.server = ThreadingHTTPServer(
+                ('127.0.0.1', 0),
+                partial(
+                    FailingUploadHTTPRequestHandler,
+                    directory=self.upload_dir))
+        self.server_thread = threading.Thread(
+                target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.outbox = None
+
+    def tearDown(self):
+        if self.outbox is not None:
+            self.outbox.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def create_outbox(self):
+        return mtrupload.UploadOutbox(
+                self.outbox_dir,
+                initial_retry_delay_secs=0.05,
+                max_retry_delay_secs=0.2)
+
+    def create_log_file(self, file_name, content):
+        log_file_name = os.path.join(self.work_dir.name, file_name)
+        with open(log_file_name, 'wb') as f:
+            f.write(content)
+        return log_file_name
+
+    def uploaded_content(self, file_name):
+        with open(os.path.join(self.upload_dir, file_name), 'rb') as f:
+            return f.read()
+
+    def test_upload(self):
+        log_file_name = self.create_log_file('mtr-1.log', b'line 1\nline 2\n')
+        self.outbox = self.create_outbox()
+        self.outbox.start()
+        self.outbox.add(log_file_name, [self.url])
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(
+                self.uploaded_content('mtr-1.log'), b'line 1\nline 2\n')
+        self.assertEqual(os.listdir(self.outbox_dir), [])
+
+    def test_retry_after_failures(self):
+        FailingUploadHTTPRequestHandler.num_failures = 3
+        log_file_name = self.create_log_file('mtr-2.log', b'line 1\n')
+        self.outbox = self.create_outbox()
+        self.outbox.start()
+        self.outbox.add(log_file_name, [self.url])
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(FailingUploadHTTPRequestHandler.num_failures, 0)
+        self.assertEqual(self.uploaded_content('mtr-2.log'), b'line 1\n')
+
+    def test_pending_uploads_kept_until_next_start(self):
+        FailingUploadHTTPRequestHandler.num_failures = 1000
+        log_file_name = self.create_log_file('mtr-3.log', b'line 1\n')
+        outbox = self.create_outbox()
+        outbox.start()
+        outbox.add(log_file_name, [self.url])
+        self.assertFalse(outbox.wait_until_empty(0.3))
+        outbox.stop()
+        self.assertEqual(len(os.listdir(self.outbox_dir)), 1)
+
+        FailingUploadHTTPRequestHandler.num_failures = 0
+        self.outbox = self.create_outbox()
+        self.outbox.start()
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(self.uploaded_content('mtr-3.log'), b'line 1\n')
+        self.assertEqual(os.listdir(self.outbox_dir), [])
+
+    def test_missing_log_file_is_dropped(self):
+        self.outbox = self.create_outbox()
+        self.outbox.start()
+        self.outbox.add(
+                os.path.join(self.work_dir.name, 'missing.log'), [self.url])
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(os.listdir(self.outbox_dir), [])
+
+    def test_one_upload_at_a_time_to_each_destination(self):
+        num_uploads_in_progress = collections.Counter()
+        max_num_uploads_in_progress = collections.Counter()
+        lock = threading.Lock()
+        release_uploads = threading.Event()
+
+        def slow_upload(
+                log_file_name, destination_args, compression, resume_state):
+            destination = destination_args[0]
+            with lock:
+                num_uploads_in_progress[destination] += 1
+                num_uploads_in_progress['all'] += 1
+                for key in [destination, 'all']:
+                    max_num_uploads_in_progress[key] = max(
+                            max_num_uploads_in_progress[key],
+                            num_uploads_in_progress[key])
+            release_uploads.wait(0.1)
+            with lock:
+                num_uploads_in_progress[destination] -= 1
+                num_uploads_in_progress['all'] -= 1
+
+        self.outbox = mtrupload.UploadOutbox(
+                self.outbox_dir, upload=slow_upload)
+        self.outbox.start()
+        for i in range(3):
+            log_file_name = self.create_log_file('mtr-%d.log' % i, b'')
+            self.outbox.add(log_file_name, ['a'])
+            self.outbox.add(log_file_name, ['b'])
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(
+                max_num_uploads_in_progress,
+                collections.Counter({'a': 1, 'b': 1, 'all': 2}))
+
+    def test_unreachable_destination_does_not_hold_up_others(self):
+        release_uploads = threading.Event()
+
+        def upload(
+                log_file_name, destination_args, compression, resume_state):
+            if destination_args == ['unreachable']:
+                # like a connection attempt that never gets an answer
+                release_uploads.wait(5)
+                raise ConnectionError("No answer")
+
+        log_file_name = self.create_log_file('mtr-1.log', b'')
+        # left by earlier runs
+        backlog_outbox = mtrupload.UploadOutbox(self.outbox_dir)
+        for i in range(3):
+            backlog_outbox.add(log_file_name, ['unreachable'])
+        backlog_outbox.add(log_file_name, ['reachable'])
+
+        outbox = mtrupload.UploadOutbox(self.outbox_dir, upload=upload)
+        outbox.start()
+        unreachable_entry = outbox.add(log_file_name, ['unreachable'])
+        reachable_entry = outbox.add(log_file_name, ['reachable'])
+        self.assertEqual(
+                outbox.wait_until_any_done(
+                    [unreachable_entry, reachable_entry], 1),
+                {reachable_entry})
+        release_uploads.set()
+        outbox.stop()
+
+    def test_entries_of_this_run_before_backlog(self):
+        uploaded = []
+
+        def upload(
+                log_file_name, destination_args, compression, resume_state):
+            uploaded.append(os.path.basename(log_file_name))
+
+        backlog_outbox = mtrupload.UploadOutbox(self.outbox_dir)
+        for i in range(2):
+            backlog_outbox.add(
+                    self.create_log_file('old-%d.log' % i, b''), [self.url])
+        self.outbox = mtrupload.UploadOutbox(self.outbox_dir, upload=upload)
+        self.outbox.add(self.create_log_file('new.log', b''), [self.url])
+        self.outbox.start()
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(uploaded, ['new.log', 'old-0.log', 'old-1.log'])
+
+    def test_next_attempt_kept_over_restart(self):
+        def failing_upload(
+                log_file_name, destination_args, compression, resume_state):
+            raise ConnectionError("No answer")
+
+        log_file_name = self.create_log_file('mtr-1.log', b'')
+        outbox = mtrupload.UploadOutbox(
+                self.outbox_dir,
+                upload=failing_upload,
+                initial_retry_delay_secs=10)
+        entry_file_name = outbox.add(log_file_name, [self.url])
+        outbox.attempt(entry_file_name)
+        self.assertGreater(
+                outbox.read_entry(entry_file_name)['next_attempt'],
+                time.time() + 4)
+
+        uploaded = []
+        self.outbox = mtrupload.UploadOutbox(
+                self.outbox_dir,
+                upload=lambda *args: uploaded.append(args))
+        self.outbox.start()
+        self.assertFalse(self.outbox.wait_until_empty(0.3))
+        self.assertEqual(uploaded, [])
+
+    def test_permanent_failure_is_not_retried(self):
+        uploads = []
+
+        def refused_upload(
+                log_file_name, destination_args, compression, resume_state):
+            uploads.append(log_file_name)
+            raise mtrupload.PermanentUploadError("Invalid token")
+
+        self.outbox = mtrupload.UploadOutbox(
+                self.outbox_dir,
+                upload=refused_upload,
+                initial_retry_delay_secs=0.05)
+        self.outbox.start()
+        entry_file_name = self.outbox.add(
+                self.create_log_file('mtr-1.log', b''), [self.url])
+        self.assertEqual(
+                self.outbox.wait_until_any_done([entry_file_name], 5),
+                {entry_file_name})
+        self.assertTrue(self.outbox.has_failed(entry_file_name))
+        time.sleep(0.2)
+        self.assertEqual(len(uploads), 1)
+        # retried by the next run
+        self.assertEqual(os.listdir(self.outbox_dir), [entry_file_name])
+
+    def test_wait_until_any_done(self):
+        release_slow_upload = threading.Event()
+
+        def upload(
+                log_file_name, destination_args, compression, resume_state):
+            if destination_args == ['slow']:
+                release_slow_upload.wait(5)
+
+        self.outbox = mtrupload.UploadOutbox(self.outbox_dir, upload=upload)
+        self.outbox.start()
+        log_file_name = self.create_log_file('mtr-1.log', b'')
+        slow_entry = self.outbox.add(log_file_name, ['slow'])
+        fast_entry = self.outbox.add(log_file_name, ['fast'])
+        self.assertEqual(
+                self.outbox.wait_until_any_done([slow_entry, fast_entry], 5),
+                {fast_entry})
+        self.assertEqual(
+                self.outbox.wait_until_any_done([slow_entry], 0.1), set())
+        release_slow_upload.set()
+        self.assertEqual(
+                self.outbox.wait_until_any_done([slow_entry], 5),
+                {slow_entry})
+
+    def create_delta_outbox(self, uploaded):
+        def recording_upload(
+                log_file_name, destination_args, compression, resume_state):
+            with open(log_file_name, 'r') as f:
+                uploaded.append((os.path.basename(log_file_name), f.read()))
+
+        return mtrupload.UploadOutbox(
+                self.outbox_dir,
+                upload=recording_upload,
+                ack_store=mtrstate.AcknowledgedPackageStore(
+                    os.path.join(self.work_dir.name, 'acks.json')))
+
+    def log_content(self, mtr_id, package_nums):
+        return ''.join(
+                '"M","0","%d","000001",%07d\n' % (mtr_id, package_num)
+                for package_num in package_nums)
+
+    def test_delta_upload(self):
+        uploaded = []
+        self.outbox = self.create_delta_outbox(uploaded)
+        self.outbox.start()
+        self.outbox.add(
+                self.create_log_file(
+                    'mtr-1.log', self.log_content(1, [1, 2]).encode()),
+                [self.url], mode='delta')
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.outbox.add(
+                self.create_log_file(
+                    'mtr-2.log', self.log_content(1, [1, 2, 3]).encode()),
+                [self.url], mode='delta')
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.outbox.add(
+                self.create_log_file(
+                    'mtr-3.log', self.log_content(1, [2, 3]).encode()),
+                [self.url], mode='delta')
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(uploaded, [
+            ('mtr-1.log', self.log_content(1, [1, 2])),
+            ('mtr-2-delta.log', self.log_content(1, [3]))])
+
+    def test_full_upload_sends_acknowledged_lines(self):
+        uploaded = []
+        self.outbox = self.create_delta_outbox(uploaded)
+        self.outbox.start()
+        log_file_name = self.create_log_file(
+                'mtr-1.log', self.log_content(1, [1, 2]).encode())
+        self.outbox.add(log_file_name, [self.url], mode='delta')
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.outbox.add(log_file_name, [self.url], mode='full')
+        self.assertTrue(self.outbox.wait_until_empty(5))
+        self.assertEqual(uploaded, 2 * [
+            ('mtr-1.log', self.log_content(1, [1, 2]))])
+
+    def test_retry_delay_grows_exponentially_with_jitter(self):
+        outbox = mtrupload.UploadOutbox(
+                self.outbox_dir,
+                initial_retry_delay_secs=1,
+                max_retry_delay_secs=30)
+        for (attempts, max_delay_secs) in [(1, 1), (2, 2), (4, 8), (10, 30)]:
+            delay_secs = outbox.retry_delay_secs(attempts)
+            self.assertGreaterEqual(delay_secs, max_delay_secs / 2)
+            self.assertLessEqual(delay_secs, max_delay_secs)
+
+
+if __name__ == '__main__':
+    unittest.main()